@@ -0,0 +1,47 @@
+import logging
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+stats_log_every = 1000
+
+
+def update_chat(update: types.Update):
+    if update.message:
+        return update.message.chat
+    if update.edited_message:
+        return update.edited_message.chat
+    if update.channel_post:
+        return update.channel_post.chat
+    if update.edited_channel_post:
+        return update.edited_channel_post.chat
+    if update.callback_query and update.callback_query.message:
+        return update.callback_query.message.chat
+    if update.chat_member:
+        return update.chat_member.chat
+    if update.my_chat_member:
+        return update.my_chat_member.chat
+    return None
+
+
+# Обновления из неодобренных групп отбрасываются до обработчиков и запросов к базе. Одобренные чаты
+# берутся из настроек chat_base в памяти (db.is_allowed_chat). Пропускаются личные чаты, обновления без
+# чата (оплата и т.п.) и сообщение о добавлении самого бота: на него бот отвечает и выходит из чата.
+class AllowedChatsMiddleware(BaseMiddleware):
+    def __init__(self, db):
+        super().__init__()
+        self.db = db
+        self.dropped = 0
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        chat = update_chat(update)
+        if chat is None or chat.type == types.ChatType.PRIVATE or self.db.is_allowed_chat(chat.id):
+            return
+        message = update.message
+        if message and any(member.id == message.bot.id for member in message.new_chat_members or ()):
+            return
+        self.dropped += 1
+        if self.dropped % stats_log_every == 1:
+            logging.info(f"Update from not allowed chat {chat.id} dropped ({self.dropped} total)")
+        raise CancelHandler()
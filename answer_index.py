@@ -0,0 +1,175 @@
+import logging
+import math
+import time
+from collections import OrderedDict, defaultdict
+from typing import List, NamedTuple, Optional, Tuple
+
+from verdict_cache import normalize_text
+
+faq_source = 'faq'
+history_source = 'history'
+private_scope = 'private'
+group_scope = 'group'
+stats_log_every = 100
+
+
+def user_scope(scope: str, user_id: int) -> str:
+    # Ответы в личке могут быть личными (юридическая ситуация пользователя): кэшируются только для того же
+    # пользователя. Ответы в группах и так видны всем участникам, FAQ (scope=None) подходит всем
+    return f'{scope}:{user_id}' if scope == private_scope else scope
+
+
+class CachedAnswer(NamedTuple):
+    id: int
+    question: str
+    answer: str
+    scope: Optional[str]  # None - подходит и для лички, и для групп (FAQ)
+    source: str
+    created_at: float
+    expires_at: Optional[float]
+
+
+def tokenize(text: str) -> List[str]:
+    return normalize_text(text).split()
+
+
+# Индекс вопросов с готовыми ответами: прошлые ответы GPT и FAQ из админки. Поиск по инвертированному
+# индексу, сходство - косинус TF-IDF по множествам слов (вопросы короткие, частота слова почти всегда 1).
+# Ответ из индекса отдается без запроса к LLM, если сходство не ниже threshold. Прошлых ответов хранится
+# не больше max_history: при переполнении и по истечении ttl старые удаляются из памяти и из базы.
+class AnswerIndex:
+    def __init__(self, db, threshold=0.8, ttl=7 * 86400, max_history=10000):
+        self.db = db
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_history = max_history
+        self._entries = {}  # id -> CachedAnswer
+        self._history = OrderedDict()  # id прошлых ответов в порядке добавления
+        self._terms = {}  # id -> множество слов вопроса
+        self._postings = defaultdict(set)  # слово -> id вопросов
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _add(self, entry: CachedAnswer):
+        terms = set(tokenize(entry.question))
+        if not terms:
+            return
+        self._entries[entry.id] = entry
+        self._terms[entry.id] = terms
+        if entry.source == history_source:
+            self._history[entry.id] = entry.expires_at
+        for term in terms:
+            self._postings[term].add(entry.id)
+
+    def _remove(self, answer_id):
+        self._entries.pop(answer_id, None)
+        self._history.pop(answer_id, None)
+        for term in self._terms.pop(answer_id, ()):
+            postings = self._postings[term]
+            postings.discard(answer_id)
+            if not postings:
+                del self._postings[term]
+
+    def _idf(self, term):
+        return math.log(1 + len(self._entries) / (1 + len(self._postings.get(term, ()))))
+
+    def search(self, question: str, scope: str) -> Optional[Tuple[CachedAnswer, float]]:
+        terms = set(tokenize(question))
+        if not terms:
+            return None
+        now = time.time()
+        idf = {term: self._idf(term) for term in terms}
+        dot = defaultdict(float)
+        for term in terms:
+            for answer_id in self._postings.get(term, ()):
+                dot[answer_id] += idf[term] ** 2
+        query_norm = math.sqrt(sum(weight ** 2 for weight in idf.values()))
+        best = None
+        for answer_id, value in dot.items():
+            entry = self._entries[answer_id]
+            if entry.scope is not None and entry.scope != scope:
+                continue
+            if entry.expires_at is not None and entry.expires_at < now:
+                self._remove(answer_id)
+                continue
+            entry_norm = math.sqrt(sum(self._idf(term) ** 2 for term in self._terms[answer_id]))
+            similarity = value / (query_norm * entry_norm)
+            # При равном сходстве FAQ важнее прошлых ответов
+            key = (similarity, entry.source == faq_source)
+            if best is None or key > best[0]:
+                best = (key, entry)
+        if best is None:
+            return None
+        return best[1], best[0][0]
+
+    def lookup(self, question: str, scope: str) -> Optional[str]:
+        found = self.search(question, scope)
+        if found is not None and found[1] >= self.threshold:
+            self.hits += 1
+            logging.info(f"Answer cache hit ({found[1]:.2f}, {found[0].source} #{found[0].id}) for: {question}")
+            answer = found[0].answer
+        else:
+            self.misses += 1
+            answer = None
+        if (self.hits + self.misses) % stats_log_every == 0:
+            stats = self.stats()
+            logging.info(f"Answer cache: {stats['faq']} FAQ, {stats['history']} past answers, "
+                         f"{stats['hits']} hits, {stats['misses']} misses, hit rate {stats['hit_rate']:.1%}")
+        return answer
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        faq = sum(1 for entry in self._entries.values() if entry.source == faq_source)
+        return {
+            'faq': faq,
+            'history': len(self._entries) - faq,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+    def faq(self) -> List[CachedAnswer]:
+        return sorted((entry for entry in self._entries.values() if entry.source == faq_source),
+                      key=lambda entry: entry.id)
+
+    async def load(self):
+        for row in await self.db.get_cached_answers(now=time.time()):
+            self._add(CachedAnswer(*row))
+        logging.info(f"Answer cache loaded: {len(self._entries)} answers")
+
+    async def add(self, question: str, answer: str, scope: Optional[str], source=history_source,
+                  ttl: Optional[float] = None) -> CachedAnswer:
+        # ttl=None: для прошлых ответов - self.ttl, для FAQ - бессрочно
+        if ttl is None and source == history_source:
+            ttl = self.ttl
+        created_at = time.time()
+        expires_at = created_at + ttl if ttl is not None else None
+        answer_id = await self.db.insert_cached_answer(question, answer, scope, source, created_at, expires_at)
+        entry = CachedAnswer(answer_id, question, answer, scope, source, created_at, expires_at)
+        self._add(entry)
+        await self._evict(created_at)
+        return entry
+
+    async def _evict(self, now):
+        # Самые старые прошлые ответы идут первыми: удаляем истекшие и лишние сверх max_history
+        evicted = []
+        for answer_id, expires_at in self._history.items():
+            if len(self._history) - len(evicted) <= self.max_history and (expires_at is None or expires_at >= now):
+                break
+            evicted.append(answer_id)
+        for answer_id in evicted:
+            self._remove(answer_id)
+            await self.db.delete_cached_answers(answer_id=answer_id)
+
+    async def remove(self, answer_id: int):
+        self._remove(answer_id)
+        await self.db.delete_cached_answers(answer_id=answer_id)
+
+    async def clear(self, source: Optional[str] = None):
+        for answer_id, entry in list(self._entries.items()):
+            if source is None or entry.source == source:
+                self._remove(answer_id)
+        await self.db.delete_cached_answers(source=source)
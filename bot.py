@@ -1,10 +1,12 @@
+import asyncio
 import logging
 import os
-from aiogram import Bot
+from aiogram import Bot, types
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.contrib.middlewares.logging import LoggingMiddleware
 from aiogram.dispatcher import Dispatcher
 
+import config
 from config import TOKEN
 from database import Database
 
@@ -13,19 +15,39 @@ lock_file = 'bot.lock'
 logging.basicConfig(level=logging.INFO)
 
 bot = Bot(token=TOKEN)
-db = Database()
+db = Database(query_plan_debug=getattr(config, 'DB_QUERY_PLAN_DEBUG', False))
 storage = MemoryStorage()
 dp = Dispatcher(bot, storage=storage)
+background_tasks = []
 
 
 async def on_startup(dp):
     await db.initialize()
-    from functions import get_models
+    from functions import (refresh_models, verdict_cache, spam_classifier, answer_index, delayed_actions, outbox,
+                           propagation)
 
-    await get_models()
+    outbox.start()
+    await delayed_actions.start()
+    await propagation.start()
+    spam_classifier.load()
+    await verdict_cache.load()
+    await answer_index.load()
+    # Список моделей обновляется в фоне, уже после начала polling
+    background_tasks.append(asyncio.create_task(refresh_models()))
 
 
 async def on_shutdown(dp):
+    from functions import gptunnel, delayed_actions, outbox, propagation
+
+    await propagation.close()
+    await delayed_actions.close()
+    # Оставшиеся в очереди удаления и ограничения отправляются до закрытия сессии бота
+    await outbox.close()
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await gptunnel.close()
+    await db.close()
     storage.close()
     bot.close()
     if os.path.isfile(lock_file):
@@ -34,6 +56,7 @@ async def on_shutdown(dp):
 
 if __name__ == '__main__':
     from aiogram import executor
+    from allowed_chats import AllowedChatsMiddleware
     from handlers.group_handlers import register_handlers_group
     from handlers.private_handlers import register_handlers_private
 
@@ -47,5 +70,9 @@ if __name__ == '__main__':
     register_handlers_group(dp)
     register_handlers_private(dp)
     dp.middleware.setup(LoggingMiddleware())
+    # Обновления из неодобренных групп отбрасываются раньше любых обработчиков
+    dp.middleware.setup(AllowedChatsMiddleware(db))
 
-    executor.start_polling(dp, on_startup=on_startup, on_shutdown=on_shutdown)
+    # chat_member приходит только если явно запрошен: по нему обновляется кэш админов чатов
+    executor.start_polling(dp, on_startup=on_startup, on_shutdown=on_shutdown,
+                           allowed_updates=types.AllowedUpdates.all())
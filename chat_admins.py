@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from aiogram import Bot
+from aiogram.types import ChatMemberStatus
+
+admin_statuses = (ChatMemberStatus.CREATOR, ChatMemberStatus.ADMINISTRATOR)
+# Точечные статусы для чатов, где список админов получить нельзя
+members_cache_size = 100000
+
+
+# Статусы участников чата без запроса к Telegram на каждое сообщение. Список админов чата загружается
+# через get_chat_administrators и живет ttl секунд: кого нет в списке, тот обычный участник. Если список
+# недоступен (нет прав и т.п.), статус запрашивается через get_chat_member и кэшируется по (chat_id, user_id).
+# Обновления chat_member (назначение и снятие админов) сразу правят кэш через update().
+class ChatAdminCache:
+    def __init__(self, bot: Bot, ttl=600):
+        self.bot = bot
+        self.ttl = ttl
+        self._admins: Dict[int, tuple] = {}  # chat_id -> (expires_at, {user_id: status} или None, если недоступен)
+        self._members = OrderedDict()  # (chat_id, user_id) -> (expires_at, status)
+        self._loading: Dict[int, asyncio.Future] = {}
+        self.api_calls = 0
+
+    async def _load_admins(self, chat_id) -> Optional[dict]:
+        self.api_calls += 1
+        try:
+            admins = await self.bot.get_chat_administrators(chat_id)
+        except Exception as e:
+            logging.warning(f"Can't get administrators of chat {chat_id}, falling back to get_chat_member: {e}")
+            return None
+        logging.info(f"Chat {chat_id} administrators cached: {len(admins)}")
+        return {admin.user.id: admin.status for admin in admins}
+
+    async def _chat_admins(self, chat_id) -> Optional[dict]:
+        entry = self._admins.get(chat_id)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        # Список админов одного чата загружается одним запросом, остальные сообщения его ждут
+        if chat_id in self._loading:
+            return await asyncio.shield(self._loading[chat_id])
+        future = asyncio.get_running_loop().create_future()
+        self._loading[chat_id] = future
+        try:
+            admins = await self._load_admins(chat_id)
+        except asyncio.CancelledError:
+            # Отменен только загружавший обработчик: остальные ожидающие переходят на get_chat_member
+            future.set_result(None)
+            raise
+        finally:
+            del self._loading[chat_id]
+        self._admins[chat_id] = (time.monotonic() + self.ttl, admins)
+        future.set_result(admins)
+        return admins
+
+    async def get_status(self, chat_id, user_id) -> str:
+        admins = await self._chat_admins(chat_id)
+        if admins is not None:
+            return admins.get(user_id, ChatMemberStatus.MEMBER)
+        key = (chat_id, user_id)
+        entry = self._members.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self._members.move_to_end(key)
+            return entry[1]
+        self.api_calls += 1
+        member = await self.bot.get_chat_member(chat_id, user_id)
+        self._remember(key, member.status)
+        return member.status
+
+    async def is_admin(self, chat_id, user_id) -> bool:
+        return await self.get_status(chat_id, user_id) in admin_statuses
+
+    def _remember(self, key, status):
+        self._members[key] = (time.monotonic() + self.ttl, status)
+        self._members.move_to_end(key)
+        if len(self._members) > members_cache_size:
+            self._members.popitem(last=False)
+
+    def update(self, chat_id, user_id, status):
+        entry = self._admins.get(chat_id)
+        if entry is not None and entry[1] is not None:
+            if status in admin_statuses:
+                entry[1][user_id] = status
+            else:
+                entry[1].pop(user_id, None)
+        if (chat_id, user_id) in self._members:
+            self._remember((chat_id, user_id), status)
+
+    def invalidate(self, chat_id):
+        self._admins.pop(chat_id, None)
+        for key in [key for key in self._members if key[0] == chat_id]:
+            del self._members[key]
@@ -1,29 +1,470 @@
+import asyncio
 import logging
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import NamedTuple, Optional, Sequence, Tuple
 
 import aiosqlite
 import os
 import datetime
 
+from spammer_registry import SpammerRegistry
+from username_directory import UsernameDirectory
+
 basedir = os.path.dirname(os.path.abspath(__file__))
 database_path = basedir + os.sep + "telegram.db"
 
+# Одно соединение на запись и небольшой пул соединений на чтение (WAL позволяет читать параллельно с записью)
+readers_pool_size = 4
+cached_statements = 256
+connection_pragmas = (
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -16000',
+    'PRAGMA mmap_size = 268435456',
+    'PRAGMA busy_timeout = 5000',
+)
+
+# Write-behind: история, наказания и спамеры пишутся пачками по write_batch_size строк или раз в write_flush_interval
+write_batch_size = 200
+write_flush_interval = 0.5
+
+# Миграции схемы применяются по порядку, номер последней примененной хранится в PRAGMA user_version
+schema_migrations = (
+    (
+        'CREATE INDEX IF NOT EXISTS idx_history_user_chat ON telegram_channel_history (user_id, chat_id)',
+        'CREATE INDEX IF NOT EXISTS idx_history_user_name ON telegram_channel_history (user_name)',
+        'CREATE INDEX IF NOT EXISTS idx_punishments_chat ON punishments_base (banned_in_channel)',
+    ),
+    (
+        '''
+            CREATE TABLE IF NOT EXISTS user_chat_stats (
+                user_id INTEGER,
+                chat_id INTEGER,
+                message_count INTEGER DEFAULT 0,
+                first_seen DATATIME,
+                last_seen DATATIME,
+                PRIMARY KEY (user_id, chat_id)
+            ) WITHOUT ROWID
+        ''',
+        '''
+            CREATE TRIGGER IF NOT EXISTS trg_history_user_chat_stats AFTER INSERT ON telegram_channel_history
+            BEGIN
+                INSERT INTO user_chat_stats (user_id, chat_id, message_count, first_seen, last_seen)
+                VALUES (NEW.user_id, NEW.chat_id, 1, NEW.date, NEW.date)
+                ON CONFLICT (user_id, chat_id) DO UPDATE
+                SET message_count = message_count + 1, last_seen = excluded.last_seen;
+            END
+        ''',
+        '''
+            INSERT OR REPLACE INTO user_chat_stats (user_id, chat_id, message_count, first_seen, last_seen)
+            SELECT user_id, chat_id, COUNT(*), MIN(date), MAX(date)
+            FROM telegram_channel_history GROUP BY user_id, chat_id
+        ''',
+    ),
+    (
+        '''
+            CREATE TABLE IF NOT EXISTS moderation_verdicts (
+                text_hash TEXT PRIMARY KEY,
+                simhash INTEGER,
+                verdict TEXT,
+                created_at REAL
+            )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_moderation_verdicts_created ON moderation_verdicts (created_at)',
+    ),
+    (
+        '''
+            CREATE TABLE IF NOT EXISTS answer_cache (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                question TEXT,
+                answer TEXT,
+                scope TEXT,
+                source TEXT,
+                created_at REAL,
+                expires_at REAL
+            )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_answer_cache_expires ON answer_cache (expires_at)',
+    ),
+    (
+        # Этапы модерации чата через запятую в порядке выполнения; NULL - этапы по умолчанию
+        'ALTER TABLE chat_base ADD COLUMN moderation_stages TEXT',
+    ),
+    (
+        '''
+            CREATE TABLE IF NOT EXISTS delayed_actions (
+                action TEXT,
+                chat_id INTEGER,
+                target_id INTEGER,
+                run_at REAL,
+                PRIMARY KEY (action, chat_id, target_id)
+            ) WITHOUT ROWID
+        ''',
+    ),
+    (
+        # Актуальный username каждого пользователя (в нижнем регистре; NULL - username нет)
+        '''
+            CREATE TABLE IF NOT EXISTS usernames (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT,
+                updated_at REAL
+            )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_usernames_updated ON usernames (updated_at)',
+        '''
+            INSERT OR REPLACE INTO usernames (user_id, username, updated_at)
+            SELECT user_id, lower(username), CAST(strftime('%s', join_date) AS REAL)
+            FROM users_base WHERE username IS NOT NULL
+        ''',
+        # Для написавших пользователей берется username из последнего сообщения (bare column с MAX в SQLite)
+        '''
+            INSERT OR REPLACE INTO usernames (user_id, username, updated_at)
+            SELECT user_id, lower(user_name), CAST(strftime('%s', MAX(date)) AS REAL)
+            FROM telegram_channel_history WHERE user_id IS NOT NULL GROUP BY user_id
+        ''',
+    ),
+    (
+        '''
+            CREATE TABLE IF NOT EXISTS propagation_jobs (
+                job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                action TEXT,
+                user_id INTEGER,
+                until_date REAL,
+                created_at REAL
+            )
+        ''',
+        # Чаты, в которых задача еще не выполнена
+        '''
+            CREATE TABLE IF NOT EXISTS propagation_targets (
+                job_id INTEGER,
+                chat_id INTEGER,
+                PRIMARY KEY (job_id, chat_id)
+            ) WITHOUT ROWID
+        ''',
+    ),
+    (
+        # id сообщения в Telegram уникален только внутри чата: ключ истории - (chat_id, message_id).
+        # Таблица пересоздается, триггер старой таблицы удаляется вместе с ней и создается заново
+        '''
+            CREATE TABLE telegram_channel_history_new (
+                message_id INTEGER,
+                date DATATIME,
+                chat_id INTEGER,
+                message_type TEXT,
+                message_text TEXT,
+                user_id INTEGER,
+                user_name TEXT,
+                PRIMARY KEY (chat_id, message_id)
+            )
+        ''',
+        '''
+            INSERT OR IGNORE INTO telegram_channel_history_new (message_id, date, chat_id, message_type,
+            message_text, user_id, user_name)
+            SELECT message_id, date, chat_id, message_type, message_text, user_id, user_name
+            FROM telegram_channel_history ORDER BY message_id
+        ''',
+        'DROP TABLE telegram_channel_history',
+        'ALTER TABLE telegram_channel_history_new RENAME TO telegram_channel_history',
+        '''
+            CREATE TRIGGER IF NOT EXISTS trg_history_user_chat_stats AFTER INSERT ON telegram_channel_history
+            BEGIN
+                INSERT INTO user_chat_stats (user_id, chat_id, message_count, first_seen, last_seen)
+                VALUES (NEW.user_id, NEW.chat_id, 1, NEW.date, NEW.date)
+                ON CONFLICT (user_id, chat_id) DO UPDATE
+                SET message_count = message_count + 1, last_seen = excluded.last_seen;
+            END
+        ''',
+    ),
+    (
+        # username ищутся в UsernameDirectory, а не в истории: индекс только замедлял каждую вставку
+        'DROP INDEX IF EXISTS idx_history_user_name',
+    ),
+    (
+        # Число сообщений пользователя в чате берется из user_chat_stats (триггер) и кэша в памяти;
+        # rebuild-stats разово группирует историю и без индекса
+        'DROP INDEX IF EXISTS idx_history_user_chat',
+    ),
+)
+
+# Сколько горячих пар (user_id, chat_id) держать в памяти для проверки новых участников
+stats_cache_size = 100000
+
+
+class ChatSettings(NamedTuple):
+    chat_id: int
+    chat_title: Optional[str]
+    manual_punishment_notifications: bool
+    auto_punishment_notifications: bool
+    removal_punishment_notifications: bool
+    moderation_stages: Optional[Tuple[str, ...]]
+
+
+def _chat_settings_from_row(row):
+    return ChatSettings(
+        chat_id=int(row['chat_id']),
+        chat_title=row['chat_title'],
+        manual_punishment_notifications=bool(int(row['manual_punishment_notifications'])),
+        auto_punishment_notifications=bool(int(row['auto_punishment_notifications'])),
+        removal_punishment_notifications=bool(int(row['removal_punishment_notifications'])),
+        moderation_stages=(tuple(name for name in row['moderation_stages'].split(',') if name)
+                           if row['moderation_stages'] is not None else None),
+    )
+
 
 class Database:
-    def __init__(self):
+    _batched_statements = {
+        'history': '''
+            INSERT OR IGNORE INTO telegram_channel_history (message_id, date, chat_id, message_type,
+            message_text, user_id, user_name)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''',
+        'punishments': '''
+            INSERT INTO punishments_base (user_id, username, date, banned_in_channel,
+            user_message, reason, source_reason)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''',
+        'spamers': '''
+            INSERT OR IGNORE INTO spamers_base (user_id, date, banned_in_channel, user_message, reason)
+            VALUES (?, ?, ?, ?, ?)
+        ''',
+        'verdicts': '''
+            INSERT OR REPLACE INTO moderation_verdicts (text_hash, simhash, verdict, created_at)
+            VALUES (?, ?, ?, ?)
+        ''',
+        # Вставка и удаление отложенных действий в одной очереди: в пачке удаления идут после вставок
+        'delayed_actions': '''
+            INSERT OR REPLACE INTO delayed_actions (action, chat_id, target_id, run_at)
+            VALUES (?, ?, ?, ?)
+        ''',
+        'delayed_actions_done': '''
+            DELETE FROM delayed_actions WHERE action = ? AND chat_id = ? AND target_id = ?
+        ''',
+        'usernames': '''
+            INSERT OR REPLACE INTO usernames (user_id, username, updated_at)
+            VALUES (?, ?, ?)
+        ''',
+        'propagation_targets_done': '''
+            DELETE FROM propagation_targets WHERE job_id = ? AND chat_id = ?
+        ''',
+        # Оставшиеся чаты удаленной задачи вычищаются при следующей загрузке задач
+        'propagation_jobs_done': '''
+            DELETE FROM propagation_jobs WHERE job_id = ?
+        ''',
+    }
+
+    def __init__(self, query_plan_debug=False):
         self.database_path = database_path
+        self.query_plan_debug = query_plan_debug
+        self._explain_conn = None
+        self._explain_lock = threading.Lock()
+        self._writer = None
+        self._readers = None
+        self._reader_connections = []
+        self._write_lock = asyncio.Lock()
+        # Строки, ожидающие записи, и строки пачки, которая пишется прямо сейчас (видны читателям до commit)
+        self._pending = {kind: [] for kind in self._batched_statements}
+        self._in_flight = {kind: [] for kind in self._batched_statements}
+        self._pending_rows = 0
+        self._flush_requested = asyncio.Event()
+        self._flush_task = None
+        self._closing = False
+        self._stats_cache = OrderedDict()
+        self.spammers = SpammerRegistry()
+        self.usernames = UsernameDirectory()
+        # Таблица chat_base целиком в памяти: настройки читаются на каждом сообщении, а меняются только из админки
+        self._chat_settings = {}
+
+    async def _connect(self, read_only=False):
+        conn = await aiosqlite.connect(self.database_path, cached_statements=cached_statements)
+        try:
+            # execute_fetchall дочитывает результат PRAGMA, иначе незавершенный запрос держит блокировку файла
+            for pragma in connection_pragmas:
+                await conn.execute_fetchall(pragma)
+            if read_only:
+                await conn.execute_fetchall('PRAGMA query_only = ON')
+            else:
+                await conn.execute_fetchall('PRAGMA journal_mode = WAL')
+            if self.query_plan_debug:
+                await conn.set_trace_callback(self._explain_query_plan)
+        except Exception:
+            await conn.close()
+            raise
+        return conn
+
+    async def _open(self):
+        if self.query_plan_debug:
+            self._explain_conn = sqlite3.connect(self.database_path, check_same_thread=False)
+        self._writer = await self._connect()
+        self._readers = asyncio.Queue()
+        try:
+            for _ in range(readers_pool_size):
+                conn = await self._connect(read_only=True)
+                self._reader_connections.append(conn)
+                self._readers.put_nowait(conn)
+        except Exception:
+            await self.close()
+            raise
+
+    def _explain_query_plan(self, statement):
+        # Вызывается из потока соединения aiosqlite для каждого выполненного запроса (режим отладки)
+        if not statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+            return
+        try:
+            with self._explain_lock:
+                plan = self._explain_conn.execute(f'EXPLAIN QUERY PLAN {statement}').fetchall()
+        except sqlite3.Error as e:
+            logging.debug(f"Cannot explain query {statement}: {e}")
+            return
+        details = [row[3] for row in plan]
+        full_scan = any(detail.startswith('SCAN') and 'INDEX' not in detail for detail in details)
+        logging.log(logging.WARNING if full_scan else logging.INFO,
+                    f"QUERY PLAN: {' | '.join(details)} <- {' '.join(statement.split())}")
+
+    async def _migrate(self, conn):
+        cursor = await conn.execute('PRAGMA user_version')
+        version = (await cursor.fetchone())[0]
+        for number, migration in enumerate(schema_migrations[version:], start=version + 1):
+            for statement in migration:
+                await conn.execute(statement)
+            await conn.execute(f'PRAGMA user_version = {number}')
+            logging.info(f"Database schema migrated to version {number}")
+        if version < len(schema_migrations):
+            await conn.execute('ANALYZE')
+        else:
+            await conn.execute('PRAGMA optimize')
+
+    async def _load_chat_settings(self, conn, chat_id=None):
+        cursor = await conn.cursor()
+        cursor.row_factory = aiosqlite.Row
+        if chat_id is None:
+            await cursor.execute('SELECT * FROM chat_base')
+            self._chat_settings = {}
+        else:
+            await cursor.execute('SELECT * FROM chat_base WHERE chat_id = ?', (chat_id,))
+        for row in await cursor.fetchall():
+            settings = _chat_settings_from_row(row)
+            self._chat_settings[settings.chat_id] = settings
+
+    @asynccontextmanager
+    async def _read(self):
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def _write(self):
+        async with self._write_lock:
+            try:
+                yield self._writer
+                await self._writer.commit()
+            except Exception:
+                await self._writer.rollback()
+                raise
+
+    def _enqueue(self, kind, row):
+        self._pending[kind].append(row)
+        self._pending_rows += 1
+        if self._pending_rows >= write_batch_size:
+            self._flush_requested.set()
+
+    def _queued_rows(self, kind):
+        return self._in_flight[kind] + self._pending[kind]
+
+    async def _flush_loop(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), timeout=write_flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Write-behind flush failed: {e}")
+
+    def _forget_message_counts(self, history_rows):
+        # Строки истории, не попавшие в таблицу (дубликат ключа, ошибка), не посчитаны триггером в user_chat_stats:
+        # счетчики этих пар сбрасываются и при следующем запросе читаются заново
+        for row in history_rows:
+            self._stats_cache.pop((row[5], row[2]), None)
+
+    async def flush(self):
+        if not self._pending_rows:
+            return
+        async with self._write_lock:
+            self._in_flight, self._pending = self._pending, {kind: [] for kind in self._batched_statements}
+            self._pending_rows = 0
+            try:
+                try:
+                    ignored_history = False
+                    for kind, rows in self._in_flight.items():
+                        if rows:
+                            cursor = await self._writer.executemany(self._batched_statements[kind], rows)
+                            ignored_history |= kind == 'history' and cursor.rowcount < len(rows)
+                    await self._writer.commit()
+                    if ignored_history:
+                        self._forget_message_counts(self._in_flight['history'])
+                except Exception as e:
+                    # Пачка откатывается целиком, поэтому пишем построчно, чтобы одна плохая строка не потеряла остальные
+                    logging.error(f"Batch insert failed, retrying row by row: {e}")
+                    await self._writer.rollback()
+                    for kind, rows in self._in_flight.items():
+                        for row in rows:
+                            try:
+                                cursor = await self._writer.execute(self._batched_statements[kind], row)
+                                if kind == 'history' and cursor.rowcount == 0:
+                                    self._forget_message_counts([row])
+                            except Exception as row_error:
+                                logging.error(f"Dropped {kind} row {row}: {row_error}")
+                                if kind == 'history':
+                                    self._forget_message_counts([row])
+                    await self._writer.commit()
+            finally:
+                self._in_flight = {kind: [] for kind in self._batched_statements}
+
+    async def close(self):
+        if self._flush_task is not None:
+            # Не отменяем задачу, а будим ее: отмена во время flush оставила бы транзакцию незавершенной
+            self._closing = True
+            self._flush_requested.set()
+            await self._flush_task
+            self._flush_task = None
+        if self._writer is not None:
+            await self.flush()
+        for conn in self._reader_connections:
+            await conn.close()
+        self._reader_connections = []
+        self._readers = None
+        if self._writer is not None:
+            await self._writer.close()
+            self._writer = None
+        if self._explain_conn is not None:
+            self._explain_conn.close()
+            self._explain_conn = None
+        logging.info("Database connections closed")
 
     async def initialize(self):
-        async with aiosqlite.connect(self.database_path) as conn:
+        if self._writer is None:
+            await self._open()
+        async with self._write() as conn:
             cursor = await conn.cursor()
             await cursor.execute('''
                 CREATE TABLE IF NOT EXISTS telegram_channel_history (
-                    message_id INTEGER PRIMARY KEY,
+                    message_id INTEGER,
                     date DATATIME,
                     chat_id INTEGER,
                     message_type TEXT,
                     message_text TEXT,
                     user_id INTEGER,
-                    user_name TEXT
+                    user_name TEXT,
+                    PRIMARY KEY (chat_id, message_id)
                 )
             ''')
             await cursor.execute('''
@@ -82,98 +523,105 @@ class Database:
                                         date DATATIME
                                     )
                                 ''')
-            await conn.commit()
-            logging.info("Database was successfully initialized")
+            await self._migrate(conn)
+            cursor = await conn.execute('SELECT user_id FROM spamers_base')
+            self.spammers.load(row[0] for row in await cursor.fetchall())
+            cursor = await conn.execute('SELECT user_id, username FROM usernames ORDER BY updated_at')
+            self.usernames.load(await cursor.fetchall())
+            await self._load_chat_settings(conn)
+        if self._flush_task is None:
+            self._closing = False
+            self._flush_task = asyncio.create_task(self._flush_loop())
+        logging.info("Database was successfully initialized")
 
     async def add_new_user(self, user_id):
         current_date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        async with aiosqlite.connect(self.database_path) as conn:
+        async with self._write() as conn:
             await conn.execute('''
                 INSERT INTO users_base (user_id, join_date)
                 VALUES (?, ?)
             ''', (user_id, current_date))
-            await conn.commit()
 
     async def add_user(self, user_id, username):
         join_date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        async with aiosqlite.connect(self.database_path) as conn:
+        async with self._write() as conn:
             await conn.execute('''
                 INSERT OR REPLACE INTO users_base (user_id, join_date, username)
                 VALUES (?, ?, ?)
             ''', (user_id, join_date, username))
-            await conn.commit()
+        self.remember_username(user_id, username)
+
+    def remember_username(self, user_id, username):
+        # Справочник обновляется в памяти сразу, а в таблицу пишется только смена username
+        if user_id is not None and self.usernames.update(user_id, username):
+            self._enqueue('usernames', (user_id, self.usernames.name_of(user_id), time.time()))
 
     async def get_user(self, user_id):
-        async with aiosqlite.connect(self.database_path) as conn:
-            await conn.execute('''
+        async with self._read() as conn:
+            cursor = await conn.execute('''
                 SELECT * FROM users_base WHERE user_id = ?
             ''', (user_id,))
-            await conn.commit()
+            return await cursor.fetchone()
 
     async def add_allowed_chat(self, chat_id):
         current_date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        async with aiosqlite.connect(self.database_path) as conn:
+        async with self._write() as conn:
             await conn.execute('''
                 INSERT INTO chat_base (chat_id, date)
                 VALUES (?, ?)
             ''', (chat_id, current_date))
-            await conn.commit()
+            await self._load_chat_settings(conn, chat_id)
 
     async def add_order(self, service_id, user_id, username, service_price):
         current_date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        async with aiosqlite.connect(self.database_path) as conn:
+        async with self._write() as conn:
             await conn.execute('''
                 INSERT INTO orders (service_id, user_id, username, service_price, date)
                 VALUES (?, ?, ?, ?, ?)
             ''', (service_price, service_id, user_id, username, current_date))
-            await conn.commit()
 
     async def add_chat_title(self, chat_id, chat_title):
-        async with aiosqlite.connect(self.database_path) as conn:
+        async with self._write() as conn:
             await conn.execute('''
                 UPDATE chat_base SET chat_title = ? WHERE chat_id = ?
             ''', (chat_title, chat_id))
-            await conn.commit()
+        settings = self._chat_settings.get(int(chat_id))
+        if settings is not None:
+            self._chat_settings[settings.chat_id] = settings._replace(chat_title=chat_title)
 
     async def get_allowed_groups(self):
-        async with aiosqlite.connect(self.database_path) as conn:
-            cursor = await conn.cursor()
-            await cursor.execute('SELECT ALL chat_id FROM chat_base')
-            allowed_chats = await cursor.fetchall()
-            allowed_chats = [chat[0] for chat in allowed_chats]
-            return allowed_chats
+        # Список одобренных чатов - ключи настроек chat_base, которые загружены в память при старте
+        return list(self._chat_settings)
+
+    def is_allowed_chat(self, chat_id) -> bool:
+        return int(chat_id) in self._chat_settings
 
     async def get_services(self):
-        async with aiosqlite.connect(self.database_path) as conn:
+        async with self._read() as conn:
             cursor = await conn.cursor()
             await cursor.execute('SELECT * FROM services')
             services = await cursor.fetchall()
             return services
 
     async def get_orders(self):
-        async with aiosqlite.connect(self.database_path) as conn:
+        async with self._read() as conn:
             cursor = await conn.cursor()
             await cursor.execute('SELECT * FROM orders')
             orders = await cursor.fetchall()
             return orders
 
     async def get_service(self, service_id):
-        async with aiosqlite.connect(self.database_path) as conn:
+        async with self._read() as conn:
             cursor = await conn.cursor()
             await cursor.execute('SELECT * FROM services WHERE service_id = ?', (service_id,))
             service = await cursor.fetchone()
             return service
 
-    async def get_chat_info(self, chat_id):
-        async with aiosqlite.connect(self.database_path) as conn:
-            conn.row_factory = aiosqlite.Row
-            cursor = await conn.cursor()
-            await cursor.execute('SELECT * FROM chat_base WHERE chat_id = ?', (chat_id,))
-            chat_info = await cursor.fetchone()
-            return chat_info
+    async def get_chat_info(self, chat_id) -> Optional[ChatSettings]:
+        return self._chat_settings.get(int(chat_id))
 
     async def toggle_notification_setting(self, chat_id, key):
-        async with aiosqlite.connect(self.database_path) as conn:
+        async with self._write() as conn:
             cursor = await conn.cursor()
 
             await cursor.execute(f"SELECT {key}_punishment_notifications FROM chat_base WHERE chat_id = ?", (chat_id,))
@@ -188,46 +636,64 @@ class Database:
                 f"WHERE chat_id = ?",
                 (chat_id,)
             )
+            await self._load_chat_settings(conn, chat_id)
 
-            # Commit the changes to the database
-            await conn.commit()
+    async def update_moderation_stages(self, chat_id, stages: Optional[Sequence[str]]):
+        async with self._write() as conn:
+            await conn.execute('UPDATE chat_base SET moderation_stages = ? WHERE chat_id = ?',
+                               (','.join(stages) if stages is not None else None, chat_id))
+            await self._load_chat_settings(conn, chat_id)
 
     async def delete_allowed_group(self, chat_id):
-        async with aiosqlite.connect(self.database_path) as conn:
+        async with self._write() as conn:
             cursor = await conn.cursor()
             await cursor.execute('DELETE FROM chat_base WHERE chat_id = ?', (chat_id,))
-            await conn.commit()
+        self._chat_settings.pop(int(chat_id), None)
 
     async def insert_chat_message(self, chat_id, message_id, message_text, user_id, user_name, message_type):
         current_date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        async with aiosqlite.connect(self.database_path) as conn:
-            await conn.execute('''
-                INSERT INTO telegram_channel_history (message_id, date, chat_id, message_type, 
-                message_text, user_id, user_name)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (message_id, current_date, chat_id, message_type, message_text, user_id, user_name))
-            await conn.commit()
+        self._enqueue('history', (message_id, current_date, chat_id, message_type, message_text, user_id, user_name))
+        self.remember_username(user_id, user_name)
+        if (user_id, chat_id) in self._stats_cache:
+            self._stats_cache[(user_id, chat_id)] += 1
 
     async def get_message_count_by_user(self, user_id, chat_id):
-        async with aiosqlite.connect(self.database_path) as conn:
+        key = (user_id, chat_id)
+        if key in self._stats_cache:
+            self._stats_cache.move_to_end(key)
+            return self._stats_cache[key]
+        async with self._read() as conn:
             cursor = await conn.cursor()
-            await cursor.execute('SELECT COUNT(*) FROM telegram_channel_history WHERE user_id = ? AND chat_id = ?',
+            await cursor.execute('SELECT message_count FROM user_chat_stats WHERE user_id = ? AND chat_id = ?',
                                  (user_id, chat_id))
             message_count = await cursor.fetchone()
-        return message_count[0] if message_count else 0
+        # Добавляем еще не записанные сообщения; очередь читаем после запроса, чтобы не посчитать строку дважды
+        queued_count = sum(1 for row in self._queued_rows('history') if row[5] == user_id and row[2] == chat_id)
+        message_count = (message_count[0] if message_count else 0) + queued_count
+        self._stats_cache[key] = message_count
+        if len(self._stats_cache) > stats_cache_size:
+            self._stats_cache.popitem(last=False)
+        return message_count
+
+    async def rebuild_user_chat_stats(self):
+        await self.flush()
+        async with self._write() as conn:
+            await conn.execute('DELETE FROM user_chat_stats')
+            await conn.execute('''
+                INSERT INTO user_chat_stats (user_id, chat_id, message_count, first_seen, last_seen)
+                SELECT user_id, chat_id, COUNT(*), MIN(date), MAX(date)
+                FROM telegram_channel_history GROUP BY user_id, chat_id
+            ''')
+        self._stats_cache.clear()
+        logging.info("user_chat_stats rebuilt from telegram_channel_history")
 
     async def insert_punishment(self, user_id, username, chat_id, message_text, reason, source_reason):
         current_date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        async with aiosqlite.connect(self.database_path) as conn:
-            await conn.execute('''
-                INSERT INTO punishments_base (user_id, username, date, banned_in_channel, 
-                user_message, reason, source_reason)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (user_id, username, current_date, chat_id, message_text, reason, source_reason))
-            await conn.commit()
+        self._enqueue('punishments', (user_id, username, current_date, chat_id, message_text, reason, source_reason))
 
     async def get_punishments_by_chat(self, chat_id):
-        async with aiosqlite.connect(self.database_path) as conn:
+        await self.flush()
+        async with self._read() as conn:
             cursor = await conn.cursor()
             await cursor.execute('SELECT * FROM punishments_base WHERE banned_in_channel = ?', (chat_id,))
             punishments = await cursor.fetchall()
@@ -235,39 +701,148 @@ class Database:
 
     async def insert_spamer(self, user_id, chat_id, message_text, reason):
         current_date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        async with aiosqlite.connect(self.database_path) as conn:
-            await conn.execute('''
-                INSERT INTO spamers_base (user_id, date, banned_in_channel, user_message, reason)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (user_id, current_date, chat_id, message_text, reason))
-            await conn.commit()
+        self._enqueue('spamers', (user_id, current_date, chat_id, message_text, reason))
+        self.spammers.add(user_id)
 
     async def remove_spamer(self, user_id):
-        async with aiosqlite.connect(self.database_path) as conn:
+        pending = [row for row in self._pending['spamers'] if row[0] != user_id]
+        self._pending_rows -= len(self._pending['spamers']) - len(pending)
+        self._pending['spamers'] = pending
+        self.spammers.remove(user_id)
+        async with self._write() as conn:
             cursor = await conn.cursor()
             await cursor.execute('''
                 DELETE FROM spamers_base
                 WHERE user_id = ? 
             ''', (user_id,))
-            await conn.commit()
 
     async def is_spamer(self, user_id):
-        async with aiosqlite.connect(self.database_path) as conn:
-            cursor = await conn.cursor()
-            await cursor.execute('SELECT * FROM spamers_base WHERE user_id = ?', (user_id,))
-            spamer_data = await cursor.fetchone()
-        return True if spamer_data is not None else False
+        return user_id in self.spammers
 
-    async def get_user_id_by_username(self, username):
-        async with aiosqlite.connect(self.database_path) as conn:
-            cursor = await conn.cursor()
-            # Выбираем user_id по username из последней записи в таблице
-            await cursor.execute(
-                'SELECT user_id FROM telegram_channel_history WHERE user_name = ? ORDER BY message_id DESC LIMIT 1',
-                (username,))
-            row = await cursor.fetchone()
-            if row:
-                user_id = row[0]
-                return int(user_id)
+    async def insert_moderation_verdict(self, text_hash, simhash, verdict, created_at):
+        self._enqueue('verdicts', (text_hash, simhash, verdict, created_at))
+
+    async def get_moderation_verdicts(self, since):
+        async with self._write() as conn:
+            await conn.execute('DELETE FROM moderation_verdicts WHERE created_at < ?', (since,))
+        async with self._read() as conn:
+            cursor = await conn.execute('SELECT text_hash, simhash, verdict, created_at FROM moderation_verdicts')
+            return await cursor.fetchall()
+
+    async def insert_delayed_action(self, action, chat_id, target_id, run_at):
+        self._enqueue('delayed_actions', (action, chat_id, target_id, run_at))
+
+    async def delete_delayed_action(self, action, chat_id, target_id):
+        self._enqueue('delayed_actions_done', (action, chat_id, target_id))
+
+    async def get_delayed_actions(self):
+        await self.flush()
+        async with self._read() as conn:
+            cursor = await conn.execute('SELECT action, chat_id, target_id, run_at FROM delayed_actions')
+            return await cursor.fetchall()
+
+    async def insert_propagation_job(self, action, user_id, until_date, chat_ids):
+        # Задача пишется сразу, а не через очередь: после перезапуска ее нужно продолжить
+        async with self._write() as conn:
+            cursor = await conn.execute('''
+                INSERT INTO propagation_jobs (action, user_id, until_date, created_at)
+                VALUES (?, ?, ?, ?)
+            ''', (action, user_id, until_date, time.time()))
+            job_id = cursor.lastrowid
+            await conn.executemany('INSERT INTO propagation_targets (job_id, chat_id) VALUES (?, ?)',
+                                   [(job_id, chat_id) for chat_id in chat_ids])
+        return job_id
+
+    async def delete_propagation_target(self, job_id, chat_id):
+        self._enqueue('propagation_targets_done', (job_id, chat_id))
+
+    async def delete_propagation_job(self, job_id):
+        self._enqueue('propagation_jobs_done', (job_id,))
+
+    async def get_propagation_jobs(self):
+        # [(job_id, action, user_id, until_date, [chat_id, ...])] незавершенных задач в порядке создания
+        await self.flush()
+        async with self._write() as conn:
+            await conn.execute('''
+                DELETE FROM propagation_targets WHERE job_id NOT IN (SELECT job_id FROM propagation_jobs)
+            ''')
+        async with self._read() as conn:
+            cursor = await conn.execute('SELECT job_id, action, user_id, until_date FROM propagation_jobs ORDER BY job_id')
+            jobs = {row[0]: (row[0], row[1], row[2], row[3], []) for row in await cursor.fetchall()}
+            cursor = await conn.execute('SELECT job_id, chat_id FROM propagation_targets')
+            for job_id, chat_id in await cursor.fetchall():
+                jobs[job_id][4].append(chat_id)
+        return list(jobs.values())
+
+    async def insert_cached_answer(self, question, answer, scope, source, created_at, expires_at):
+        async with self._write() as conn:
+            cursor = await conn.execute('''
+                INSERT INTO answer_cache (question, answer, scope, source, created_at, expires_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (question, answer, scope, source, created_at, expires_at))
+            return cursor.lastrowid
+
+    async def get_cached_answers(self, now):
+        async with self._write() as conn:
+            await conn.execute('DELETE FROM answer_cache WHERE expires_at < ?', (now,))
+        async with self._read() as conn:
+            cursor = await conn.execute(
+                'SELECT id, question, answer, scope, source, created_at, expires_at FROM answer_cache')
+            return await cursor.fetchall()
+
+    async def delete_cached_answers(self, answer_id=None, source=None):
+        async with self._write() as conn:
+            if answer_id is not None:
+                await conn.execute('DELETE FROM answer_cache WHERE id = ?', (answer_id,))
+            elif source is not None:
+                await conn.execute('DELETE FROM answer_cache WHERE source = ?', (source,))
             else:
-                return None
+                await conn.execute('DELETE FROM answer_cache')
+
+    async def get_training_messages(self, ham_limit):
+        # Спам: сообщения из базы спамеров и наказаний (кроме мутов за ссылки, за флуд и ручных мутов админом).
+        # Не спам: последние текстовые сообщения пользователей, которые не наказывались ни за что, кроме флуда:
+        # при флуде наказание дается за частоту, а не за текст ("ок", "+"), и текст остается обычным.
+        await self.flush()
+        async with self._read() as conn:
+            cursor = await conn.execute('''
+                SELECT user_message FROM spamers_base
+                WHERE user_message IS NOT NULL AND user_message != 'Unknown'
+                UNION
+                SELECT user_message FROM punishments_base
+                WHERE user_message IS NOT NULL AND user_message != 'Unknown'
+                AND reason != 'link in message' AND reason != 'flood' AND reason NOT LIKE 'muted by admin%'
+            ''')
+            spam_texts = [row[0] for row in await cursor.fetchall()]
+            cursor = await conn.execute('''
+                SELECT message_text FROM telegram_channel_history
+                WHERE message_type = 'text' AND message_text IS NOT NULL
+                AND user_id NOT IN (SELECT user_id FROM spamers_base)
+                AND user_id NOT IN (SELECT user_id FROM punishments_base WHERE reason IS NOT 'flood')
+                ORDER BY rowid DESC LIMIT ?
+            ''', (ham_limit,))
+            ham_texts = [row[0] for row in await cursor.fetchall()]
+        return spam_texts, ham_texts
+
+    async def get_user_id_by_username(self, username):
+        return self.usernames.get(username)
+
+
+async def _run_command(command):
+    db = Database()
+    await db.initialize()
+    try:
+        if command == 'rebuild-stats':
+            await db.rebuild_user_chat_stats()
+    finally:
+        await db.close()
+
+
+if __name__ == '__main__':
+    # python database.py rebuild-stats — пересчитать user_chat_stats по всей истории сообщений
+    logging.basicConfig(level=logging.INFO)
+    commands = ('rebuild-stats',)
+    if len(sys.argv) != 2 or sys.argv[1] not in commands:
+        print(f"Использование: python database.py [{' | '.join(commands)}]")
+        exit(1)
+    asyncio.run(_run_command(sys.argv[1]))
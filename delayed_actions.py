@@ -0,0 +1,92 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Awaitable, Callable, Dict
+
+delete_message_action = 'delete_message'
+
+
+# Отложенные действия ("удалить сообщение X в чате Y через N секунд") в одной куче по времени запуска
+# и одной фоновой задаче вместо спящей корутины на каждое действие. Действие определяется тройкой
+# (action, chat_id, target_id): повторное планирование заменяет прежнее, а его запись в куче пропускается.
+# Действия пишутся в таблицу delayed_actions и после перезапуска бота выполняются заново (просроченные - сразу).
+class DelayedActionScheduler:
+    def __init__(self, db, handlers: Dict[str, Callable[[int, int], Awaitable]]):
+        self.db = db
+        self.handlers = handlers
+        self._heap = []  # (run_at, порядковый номер, action, chat_id, target_id)
+        self._scheduled = {}  # (action, chat_id, target_id) -> (run_at, порядковый номер) актуальной записи в куче
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._closing = False
+        self._running = set()
+
+    def __len__(self):
+        return len(self._scheduled)
+
+    def _push(self, action, chat_id, target_id, run_at):
+        seq = next(self._counter)
+        self._scheduled[(action, chat_id, target_id)] = (run_at, seq)
+        heapq.heappush(self._heap, (run_at, seq, action, chat_id, target_id))
+        if len(self._heap) > 2 * len(self._scheduled) + 64:
+            # Устаревших записей стало больше, чем актуальных: куча собирается заново
+            self._heap = [entry for entry in self._heap
+                          if self._scheduled.get((entry[2], entry[3], entry[4])) == (entry[0], entry[1])]
+            heapq.heapify(self._heap)
+        if self._heap[0][0] == run_at:
+            self._wakeup.set()
+
+    async def start(self):
+        rows = await self.db.get_delayed_actions()
+        for action, chat_id, target_id, run_at in rows:
+            self._push(action, chat_id, target_id, run_at)
+        if rows:
+            logging.info(f"Delayed actions restored: {len(rows)}")
+        self._task = asyncio.create_task(self._loop())
+
+    async def schedule(self, action, chat_id, target_id, delay):
+        run_at = time.time() + delay
+        self._push(action, chat_id, target_id, run_at)
+        await self.db.insert_delayed_action(action, chat_id, target_id, run_at)
+
+    async def _loop(self):
+        while not self._closing:
+            self._wakeup.clear()
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                run_at, seq, action, chat_id, target_id = heapq.heappop(self._heap)
+                key = (action, chat_id, target_id)
+                if self._scheduled.get(key) != (run_at, seq):
+                    continue
+                del self._scheduled[key]
+                task = asyncio.create_task(self._run(action, chat_id, target_id))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+
+    async def _run(self, action, chat_id, target_id):
+        try:
+            await self.handlers[action](chat_id, target_id)
+        except Exception as e:
+            logging.warning(f"Delayed action {action} for {target_id} in chat {chat_id} failed: {e}")
+        # Если за время выполнения действие запланировали снова, его запись в таблице уже новая
+        if (action, chat_id, target_id) not in self._scheduled:
+            await self.db.delete_delayed_action(action, chat_id, target_id)
+
+    async def close(self):
+        # Невыполненные действия остаются в таблице и будут выполнены после перезапуска
+        self._closing = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+        if self._running:
+            await asyncio.gather(*self._running, return_exceptions=True)
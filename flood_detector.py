@@ -0,0 +1,144 @@
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Optional
+
+flood_started = 'flood'
+flood_continued = 'flood_continued'
+
+
+class _ChatState:
+    __slots__ = ('messages', 'joins', 'raid_until')
+
+    def __init__(self, chat_limit, join_limit):
+        self.messages = deque(maxlen=chat_limit)
+        self.joins = deque(maxlen=join_limit)
+        self.raid_until = 0.0
+
+
+class _UserState:
+    __slots__ = ('messages', 'flood_until')
+
+    def __init__(self, user_limit):
+        self.messages = deque(maxlen=user_limit)
+        self.flood_until = 0.0
+
+
+def _full_within(buffer: deque, count, window, now) -> bool:
+    # В кольцевом буфере есть count событий за последние window секунд
+    return len(buffer) >= count and now - buffer[-count] <= window
+
+
+# Флуд и рейды без запросов к SQLite и GPT: времена последних сообщений пользователя, сообщений чата и входов
+# в чат хранятся в кольцевых буферах фиксированной длины. Пользователь, отправивший user_limit сообщений
+# за user_window секунд, считается флудером. Чат переходит в режим рейда на raid_duration секунд, если за окно
+# в него вошло join_limit новых участников или пришло chat_limit сообщений; в режиме рейда порог флуда
+# ниже (raid_user_limit), а о включении режима сообщается через on_raid(chat_id, raid_until).
+# Число отслеживаемых пользователей и чатов ограничено, старые вытесняются (LRU).
+class FloodDetector:
+    def __init__(self, user_limit=5, user_window=10, raid_user_limit=3, chat_limit=60, chat_window=10,
+                 join_limit=10, join_window=60, raid_duration=600, max_users=100000, max_chats=10000,
+                 on_raid: Optional[Callable[[int, float], None]] = None):
+        self.user_limit = user_limit
+        self.user_window = user_window
+        self.raid_user_limit = min(raid_user_limit, user_limit)
+        self.chat_limit = chat_limit
+        self.chat_window = chat_window
+        self.join_limit = join_limit
+        self.join_window = join_window
+        self.raid_duration = raid_duration
+        self.max_users = max_users
+        self.max_chats = max_chats
+        self.on_raid = on_raid
+        self._users = OrderedDict()  # (chat_id, user_id) -> _UserState
+        self._chats = OrderedDict()  # chat_id -> _ChatState
+        self.floods = 0
+        self.flood_messages = 0
+        self.raids = 0
+
+    def _chat(self, chat_id) -> _ChatState:
+        state = self._chats.get(chat_id)
+        if state is None:
+            state = self._chats[chat_id] = _ChatState(self.chat_limit, self.join_limit)
+            if len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return state
+
+    def _user(self, chat_id, user_id) -> _UserState:
+        key = (chat_id, user_id)
+        state = self._users.get(key)
+        if state is None:
+            state = self._users[key] = _UserState(self.user_limit)
+            if len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(key)
+        return state
+
+    def _start_raid(self, chat_id, chat: _ChatState, now, cause) -> bool:
+        # True, если режим рейда только что включился (а не продлился)
+        started = chat.raid_until <= now
+        chat.raid_until = now + self.raid_duration
+        if started:
+            self.raids += 1
+            logging.warning(f"Raid mode enabled in chat {chat_id} for {self.raid_duration}s: {cause}")
+            if self.on_raid is not None:
+                self.on_raid(chat_id, chat.raid_until)
+        return started
+
+    def raid_until(self, chat_id, now: Optional[float] = None) -> Optional[float]:
+        # Время (time.time()) окончания режима рейда или None, если чат не в режиме рейда
+        now = time.time() if now is None else now
+        chat = self._chats.get(chat_id)
+        if chat is None or chat.raid_until <= now:
+            return None
+        return chat.raid_until
+
+    def in_raid(self, chat_id, now: Optional[float] = None) -> bool:
+        return self.raid_until(chat_id, now) is not None
+
+    def on_join(self, chat_id, count=1, now: Optional[float] = None) -> bool:
+        # Учитывает вход count участников; True - чат только что перешел в режим рейда
+        if count <= 0:
+            return False
+        now = time.time() if now is None else now
+        chat = self._chat(chat_id)
+        chat.joins.extend([now] * count)
+        if _full_within(chat.joins, self.join_limit, self.join_window, now):
+            return self._start_raid(chat_id, chat, now, f"{self.join_limit}+ joins in {self.join_window}s")
+        return False
+
+    def on_message(self, chat_id, user_id, now: Optional[float] = None) -> Optional[str]:
+        # flood_started - пользователь только что превысил лимит, flood_continued - сообщение флудера
+        # в течение окна после этого, None - все в порядке
+        now = time.time() if now is None else now
+        chat = self._chat(chat_id)
+        chat.messages.append(now)
+        if _full_within(chat.messages, self.chat_limit, self.chat_window, now):
+            self._start_raid(chat_id, chat, now, f"{self.chat_limit}+ messages in {self.chat_window}s")
+        user = self._user(chat_id, user_id)
+        user.messages.append(now)
+        if user.flood_until > now:
+            user.flood_until = now + self.user_window
+            self.flood_messages += 1
+            return flood_continued
+        limit = self.raid_user_limit if chat.raid_until > now else self.user_limit
+        if _full_within(user.messages, limit, self.user_window, now):
+            user.flood_until = now + self.user_window
+            self.floods += 1
+            self.flood_messages += 1
+            return flood_started
+        return None
+
+    def stats(self, now: Optional[float] = None) -> dict:
+        now = time.time() if now is None else now
+        return {
+            'users': len(self._users),
+            'chats': len(self._chats),
+            'floods': self.floods,
+            'flood_messages': self.flood_messages,
+            'raids': self.raids,
+            'raid_chats': sum(1 for chat in self._chats.values() if chat.raid_until > now),
+        }
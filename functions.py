@@ -1,37 +1,122 @@
+import asyncio
 import logging
 import os
 import re
+import time
 from datetime import datetime, timedelta
-from typing import Match, Optional, Any, List
+from functools import partial
+from typing import Match, Optional, Any, AsyncIterator, Callable, List, Tuple
 
-import requests
-from fuzzywuzzy import fuzz
 
 import openai
 from aiogram import types
 from aiogram.types import ChatPermissions
 from aiogram.types import Message
+from aiogram.utils.exceptions import MessageNotModified, RetryAfter
 from linkify_it import LinkifyIt
 
+import config
 from bot import bot, db
 from config import *
-from json_manager import load_api_model
+from answer_index import AnswerIndex, user_scope
+from chat_admins import ChatAdminCache
+from delayed_actions import DelayedActionScheduler, delete_message_action
+from flood_detector import FloodDetector
+from gptunnel import GPTunnelClient
+from llm_scheduler import LLMScheduler, moderation_priority, qa_priority
+from moderation_batcher import ModerationBatcher
+from propagation import PropagationExecutor, mute_action, unmute_action
+from spam_classifier import SpamClassifier
+from spam_wave import SpamWave, SpamWaveDetector, link_fingerprint, media_fingerprint, text_fingerprint
+from telegram_outbox import TelegramOutbox
+from verdict_cache import VerdictCache
+from json_manager import get_active_model, load_models_cache, save_models_cache
+from word_lists import WordListStore, ban_list, check_list
+from word_matcher import WordMatcher
 
 openai.api_key = OPENAI_API_KEY
 
 
-async def get_models():
+chat_admins = ChatAdminCache(bot, ttl=getattr(config, 'ADMIN_CACHE_TTL', 600))
+# Ограничения, удаления и уведомления о наказаниях идут в Telegram через очередь с лимитами запросов
+outbox = TelegramOutbox(
+    bot,
+    global_rate=getattr(config, 'OUTBOX_GLOBAL_RATE', 25),
+    chat_rate=getattr(config, 'OUTBOX_CHAT_RATE', 1.0),
+    chat_burst=getattr(config, 'OUTBOX_CHAT_BURST', 5),
+)
+delayed_actions = DelayedActionScheduler(db, {
+    delete_message_action: lambda chat_id, message_id: outbox.delete_message(chat_id, message_id),
+})
+unmute_permissions = ChatPermissions(
+    can_send_messages=True,
+    can_invite_users=True,
+    can_send_media_messages=True
+)
+propagation = PropagationExecutor(db, {
+    mute_action: lambda chat_id, user_id, until_date: outbox.restrict_chat_member(
+        chat_id, user_id, ChatPermissions(can_send_messages=False), until_date=until_date),
+    unmute_action: lambda chat_id, user_id, until_date: outbox.restrict_chat_member(
+        chat_id, user_id, unmute_permissions),
+})
+gptunnel = GPTunnelClient(
+    GPTUNNEL_API_KEY,
+    connect_timeout=getattr(config, 'GPTUNNEL_CONNECT_TIMEOUT', 5),
+    read_timeout=getattr(config, 'GPTUNNEL_READ_TIMEOUT', 60),
+    retries=getattr(config, 'GPTUNNEL_RETRIES', 3),
+    pool_size=getattr(config, 'GPTUNNEL_POOL_SIZE', 100),
+    failure_threshold=getattr(config, 'GPTUNNEL_FAILURE_THRESHOLD', 5),
+    reset_timeout=getattr(config, 'GPTUNNEL_RESET_TIMEOUT', 30),
+)
+llm_scheduler = LLMScheduler(
+    max_concurrency=getattr(config, 'LLM_MAX_CONCURRENCY', 8),
+    class_limits={
+        moderation_priority: getattr(config, 'LLM_MODERATION_CONCURRENCY', 8),
+        qa_priority: getattr(config, 'LLM_QA_CONCURRENCY', 4),
+    },
+)
+
+
+async def delete_message_later(chat_id: int, message_id: int, delay: float):
+    # Служебные сообщения удаляются фоновым планировщиком, обработчик не ждет
+    await delayed_actions.schedule(delete_message_action, chat_id, message_id, delay)
+
+
+def notify_raid(chat_id: int, raid_until: float):
+    minutes = max(round((raid_until - time.time()) / 60), 1)
+    outbox.send_message(chat_id, f"*В чате включен режим защиты от рейда на {minutes} мин.*\n"
+                                 "_Новые участники временно не могут писать, лимит сообщений снижен_",
+                        dedup_key=('raid', chat_id), parse_mode='Markdown')
+
+
+flood_detector = FloodDetector(
+    user_limit=getattr(config, 'FLOOD_USER_LIMIT', 5),
+    user_window=getattr(config, 'FLOOD_USER_WINDOW', 10),
+    raid_user_limit=getattr(config, 'FLOOD_RAID_USER_LIMIT', 3),
+    chat_limit=getattr(config, 'RAID_CHAT_MESSAGES', 60),
+    chat_window=getattr(config, 'RAID_CHAT_WINDOW', 10),
+    join_limit=getattr(config, 'RAID_JOIN_LIMIT', 10),
+    join_window=getattr(config, 'RAID_JOIN_WINDOW', 60),
+    raid_duration=getattr(config, 'RAID_DURATION', 600),
+    on_raid=notify_raid,
+)
+flood_mute_days = getattr(config, 'FLOOD_MUTE_MINUTES', 60) / 1440
+
+
+models_cache_ttl = getattr(config, 'GPTUNNEL_MODELS_TTL', 86400)
+models_cache = load_models_cache()
+
+
+async def get_models(force: bool = False):
+    # Список моделей берется из data/gptunnel_models.json, пока он моложе models_cache_ttl
+    global models_cache
+    if not force and models_cache and time.time() - models_cache['fetched_at'] < models_cache_ttl:
+        return models_cache['models']
     try:
-        url = 'https://gptunnel.ru/v1/models'
-        headers = {
-            'Authorization': GPTUNNEL_API_KEY,  # Замените на ваш API ключ
-        }
-
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()  # Вызовет исключение для кода ответа 4xx/5xx
-
-        result = response.json()
-        print(result)
+        result = await gptunnel.get_models()
+        logging.info(f'GPTunnel models: {result}')
+        models_cache = {'fetched_at': time.time(), 'models': result}
+        save_models_cache(models_cache)
         return result
 
     except Exception as e:
@@ -39,31 +124,33 @@ async def get_models():
         raise e
 
 
-async def gptunnel_private_question(prompt):
+async def refresh_models():
+    # Фоновое обновление списка моделей: запускается после старта бота и не задерживает polling.
+    # При ошибке остается прежний кэш, следующая попытка - через минуту.
+    while True:
+        try:
+            await get_models()
+            delay = max(models_cache['fetched_at'] + models_cache_ttl - time.time(), 60)
+        except Exception:
+            delay = 60
+        await asyncio.sleep(delay)
+
+
+async def gptunnel_request(system_prompt: str, prompt: str, model: Optional[str] = None,
+                           priority: int = qa_priority, chat_id: Optional[int] = None) -> str:
+    # Общий запрос к GPTunnel для вопросов в личке (API_ROLE_PRIVATE), в группах (API_ROLE_GROUP)
+    # и для модерации (API_PROMPT). Запрос ждет слот в llm_scheduler: модерация идет вперед вопросов,
+    # а вопросы из разных чатов обслуживаются по очереди. По умолчанию - модель, выбранная в админке
     logging.info(f"Received prompt: {prompt}")
-    url = 'https://gptunnel.ru/v1/chat/completions'
-    headers = {
-        'Authorization': GPTUNNEL_API_KEY,  # Замените на ваш API ключ
-    }
-    data = {
-        "model": "gpt-3.5-turbo",
-        "useWalletBalance": True,
-        "messages": [
-            {"role": "system", "content": API_ROLE_PRIVATE},
-            {"role": "user", "content": prompt}
-        ],
-    }
+    model = model or get_active_model()
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": prompt}
+    ]
     try:
-        logging.info(f'send request to gptunnel')
-        response = requests.post(url, headers=headers, json=data)
-        logging.info(f'request to gptunnel done')
-        response.raise_for_status()  # Вызовет исключение для кода ответа 4xx/5xx
-
-        result = response.json()
-        print(result)
+        result = await llm_scheduler.run(priority, chat_id, gptunnel.chat_completion, messages, model)
         message = result['choices'][0]['message']['content']
-        print(message, 'ANSWER!!')
-        print(result['choices'][0]['finish_reason'], ' - finish reason ######')
+        logging.info(f"GPTunnel answer: {message}, finish reason: {result['choices'][0]['finish_reason']}")
         if not message:
             message = "Я не могу ответить на ваш вопрос. Пожалуйста, попробуйте переформулировать его."
 
@@ -74,76 +161,127 @@ async def gptunnel_private_question(prompt):
         raise e
 
 
-async def gptunnel_group_question(prompt):
-    logging.info(f"Received prompt: {prompt}")
-    url = 'https://gptunnel.ru/v1/chat/completions'
-    headers = {
-        'Authorization': GPTUNNEL_API_KEY,  # Замените на ваш API ключ
-    }
-    data = {
-        "model": "gpt-3.5-turbo",
-        "useWalletBalance": True,
-        "messages": [
-            {"role": "system", "content": API_ROLE_GROUP},
-            {"role": "user", "content": prompt}
-        ],
-    }
-    try:
-        logging.info(f'send request to gptunnel')
-        response = requests.post(url, headers=headers, json=data)
-        logging.info(f'request to gptunnel done')
-        response.raise_for_status()  # Вызовет исключение для кода ответа 4xx/5xx
+stream_answers = getattr(config, 'GPTUNNEL_STREAM', True)
+# Не чаще одной правки сообщения за столько секунд, чтобы укладываться в лимиты Telegram на чат
+stream_edit_interval = getattr(config, 'STREAM_EDIT_INTERVAL', 1.0)
+# Пока ответ короче, его не показываем: служебный ответ 'check' не должен мелькнуть в чате
+stream_min_chars = 10
+stream_placeholder = "Думаю над ответом..."
+telegram_text_limit = 4096
 
-        result = response.json()
-        print(result)
-        message = result['choices'][0]['message']['content']
-        print(message, 'ANSWER!!')
-        print(result['choices'][0]['finish_reason'], ' - finish reason ######')
-        if not message:
-            message = "Я не могу ответить на ваш вопрос. Пожалуйста, попробуйте переформулировать его."
-
-        return message
 
-    except Exception as e:
-        logging.error(f'ERROR GPTUNNEL REQUEST: {e}')
-        raise e
-
-
-async def gptunnel_moderate_message(prompt):
+async def gptunnel_stream(system_prompt: str, prompt: str, model: Optional[str] = None,
+                          priority: int = qa_priority, chat_id: Optional[int] = None) -> AsyncIterator[str]:
+    # То же, что gptunnel_request, но отдает накопленный текст ответа после каждого полученного фрагмента
+    logging.info(f"Received prompt: {prompt}")
+    model = model or get_active_model()
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": prompt}
+    ]
+    text = ''
+    async with llm_scheduler.slot(priority, chat_id):
+        async for content in gptunnel.stream_chat_completion(messages, model):
+            text += content
+            yield text
+    logging.info(f"GPTunnel streamed answer: {text}")
+
+
+async def edit_answer(reply: Message, text: str, reply_markup=None):
+    text = text[:telegram_text_limit]
     try:
-        url = 'https://gptunnel.ru/v1/chat/completions'
-        headers = {
-            'Authorization': GPTUNNEL_API_KEY,  # Замените на ваш API ключ
-        }
-        data = {
-            "model": "gpt-3.5-turbo",
-            "useWalletBalance": True,
-            "messages": [
-                {"role": "system", "content": API_PROMPT},
-                {"role": "user", "content": prompt}
-            ],
-        }
-
-        response = requests.post(url, headers=headers, json=data)
-        response.raise_for_status()  # Вызовет исключение для кода ответа 4xx/5xx
-
-        result = response.json()
-        message = result['choices'][0]['message']['content']
-        print(message, 'ANSWER!!')
-        print(result['choices'][0]['finish_reason'], ' - finish reason ######')
-        if not message:
-            message = "Я не могу ответить на ваш вопрос. Пожалуйста, попробуйте переформулировать его."
-
-        return message
-
-    except Exception as e:
-        logging.error(f'ERROR GPTUNNEL REQUEST: {e}')
-        raise e
+        await reply.edit_text(text, reply_markup=reply_markup)
+    except MessageNotModified:
+        pass
+    except RetryAfter as e:
+        await asyncio.sleep(e.timeout)
+        await reply.edit_text(text, reply_markup=reply_markup)
+
+
+async def stream_answer(message: Message, system_prompt: str, question: str,
+                        render: Callable[[str], str]) -> Tuple[str, Message]:
+    # Сразу отвечает заглушкой и дописывает ее по мере генерации ответа (не чаще stream_edit_interval).
+    # Возвращает полный ответ и сообщение-ответ; окончательный текст с кнопками ставит вызывающий
+    # через edit_answer. При ошибке заглушка удаляется, а исключение пробрасывается дальше.
+    reply = await message.reply(stream_placeholder)
+    try:
+        if not stream_answers:
+            return await gptunnel_request(system_prompt, question, chat_id=message.chat.id), reply
+        answer = ''
+        next_edit = time.monotonic()
+        async for answer in gptunnel_stream(system_prompt, question, chat_id=message.chat.id):
+            now = time.monotonic()
+            if len(answer) < stream_min_chars or now < next_edit:
+                continue
+            next_edit = now + stream_edit_interval
+            try:
+                await reply.edit_text(render(answer)[:telegram_text_limit])
+            except MessageNotModified:
+                pass
+            except RetryAfter as e:
+                next_edit = now + e.timeout
+        if not answer:
+            answer = "Я не могу ответить на ваш вопрос. Пожалуйста, попробуйте переформулировать его."
+        return answer, reply
+    except Exception:
+        await reply.delete()
+        raise
+
+
+answer_index = AnswerIndex(
+    db,
+    threshold=getattr(config, 'ANSWER_CACHE_THRESHOLD', 0.8),
+    ttl=getattr(config, 'ANSWER_CACHE_TTL', 7 * 86400),
+    max_history=getattr(config, 'ANSWER_CACHE_SIZE', 10000),
+)
+# Ответы, которые не стоит отдавать из кэша
+uncacheable_answers = ('check', "Я не могу ответить на ваш вопрос. Пожалуйста, попробуйте переформулировать его.")
+
+
+async def answer_question(message: Message, system_prompt: str, question: str, render: Callable[[str], str],
+                          scope: str) -> Tuple[str, Message]:
+    # Похожий вопрос уже задавали (или он есть в FAQ) - отвечаем сразу из answer_index, иначе стримим
+    # ответ GPT и запоминаем его для следующих таких же вопросов
+    scope = user_scope(scope, message.from_user.id)
+    answer = answer_index.lookup(question, scope)
+    if answer is not None:
+        return answer, await message.reply(render(answer)[:telegram_text_limit])
+    answer, reply = await stream_answer(message, system_prompt, question, render)
+    if answer.strip() not in uncacheable_answers:
+        await answer_index.add(question, answer, scope)
+    return answer, reply
+
+
+verdict_cache = VerdictCache(db, ttl=getattr(config, 'VERDICT_CACHE_TTL', 86400))
+moderation_batcher = ModerationBatcher(
+    partial(gptunnel_request, priority=moderation_priority), API_PROMPT,
+    max_batch_size=getattr(config, 'MODERATION_BATCH_SIZE', 20),
+    max_wait=getattr(config, 'MODERATION_BATCH_WAIT', 0.3),
+)
+
+
+spam_classifier = SpamClassifier(
+    spam_threshold=getattr(config, 'CLASSIFIER_SPAM_THRESHOLD', 0.97),
+    ham_threshold=getattr(config, 'CLASSIFIER_HAM_THRESHOLD', 0.03),
+)
+
+
+async def classify_or_ask_gpt(text: str) -> str:
+    verdict = spam_classifier.verdict(text)
+    if verdict is not None:
+        logging.info(f"Local classifier verdict: {verdict}")
+        return verdict
+    return await moderation_batcher.check(text)
+
+
+async def moderate_text(text: str) -> str:
+    # Вердикт 'spam'/'ok' для текста: из кэша (в том числе по почти-дубликату), от локального классификатора,
+    # если он уверен, иначе запросом к GPTunnel, который во время наплыва сообщений собирается в пачки
+    return await verdict_cache.get_or_check(text, classify_or_ask_gpt)
 
 
 async def openai_request(prompt):
     try:
-        api_model = load_api_model()
         response = openai.ChatCompletion.create(
             model='gpt-3.5',
             messages=[
@@ -227,31 +365,40 @@ async def mute_user(chat_id: int, user_id: int, mute_duration_days: int or float
     timestamp = dt.timestamp()
     permissions = ChatPermissions(can_send_messages=False)
 
-    await bot.restrict_chat_member(chat_id, user_id, permissions, until_date=timestamp)
+    await outbox.restrict_chat_member(chat_id, user_id, permissions, until_date=timestamp)
 
 
 async def unmute_user(chat_id: int, user_id: int) -> Any:
-    permissions = ChatPermissions(
-        can_send_messages=True,
-        can_invite_users=True,
-        can_send_media_messages=True
-    )
-
     try:
         chats = await db.get_allowed_groups()
-        for chat in chats:
-            logging.info(f"Unmuting user {user_id} in chat {chat}")
-            await bot.restrict_chat_member(chat_id=chat, user_id=user_id, permissions=permissions)
+        logging.info(f"Unmuting user {user_id} in {len(chats)} chats")
+        # Из базы спамеров пользователь убирается до запуска задачи: задача хранится в базе и может
+        # завершиться уже после перезапуска бота, без этой корутины. Новый мут, отменяющий снятие,
+        # сам заново добавляет пользователя в базу (insert_spamer перед ban_everywhere)
         try:
             await db.remove_spamer(user_id)
         except Exception as e:
             print(f'{user_id} не был в базе спамеров, {e}')
+        job = await propagation.submit(unmute_action, user_id, chats)
+        await job.wait()
+        if job.superseded:
+            return f"Unmute interrupted by a newer action for this user after {job.done} of {job.total} chats."
+        if job.failed:
+            return f"User unmuted in {job.done} of {job.total} chats."
         return "User unmuted successfully."
     except Exception as e:
         logging.error(f"Failed to unmute user {user_id}: {e}")
         return "Failed to unmute user."
 
 
+async def ban_everywhere(user_id: int, origin_chat_id: int, mute_duration_days: int or float = 367):
+    # База спамеров общая, поэтому бан из одного чата распространяется на остальные управляемые чаты
+    chats = [chat for chat in await db.get_allowed_groups() if chat != origin_chat_id]
+    if chats:
+        until_date = (datetime.now() + timedelta(days=mute_duration_days)).timestamp()
+        await propagation.submit(mute_action, user_id, chats, until_date=until_date)
+
+
 async def order_alert(admins_id, service_id: int):
     for admin in admins_id:
         try:
@@ -260,52 +407,65 @@ async def order_alert(admins_id, service_id: int):
             print(e)
 
 
-async def get_gpt_check_words(file_name: str = 'gpt_check_words.txt') -> List[str]:
-    data_dir = os.path.join(os.path.dirname(__file__), 'data')
-    sw_file = os.path.join(data_dir, file_name)
-    try:
-        with open(sw_file, 'r', encoding='utf-8') as file:
-            check_words = [word.strip().lower() for word in file if word.strip()]
-        return check_words
-    except Exception as e:
-        logging.error(f'ERROR READING FILE "{file_name}": {e}')
-        raise ValueError(f'ERROR READING FILE "{file_name}": {e}\n{e.with_traceback}')
+word_lists = WordListStore(os.path.join(os.path.dirname(__file__), 'data'), B_ACCURACY, C_ACCURACY)
 
 
-async def get_ban_words(file_name: str = 'ban_words.txt') -> List[str]:
-    data_dir = os.path.join(os.path.dirname(__file__), 'data')
-    sw_file = os.path.join(data_dir, file_name)
-    try:
-        with open(sw_file, 'r', encoding='utf-8') as file:
-            ban_words = [word.strip().lower() for word in file if word.strip()]
-        return ban_words
-    except Exception as e:
-        logging.error(f'ERROR READING FILE "{file_name}": {e}')
-        raise ValueError(f'ERROR READING FILE "{file_name}": {e}\n{e.with_traceback}')
+async def get_gpt_check_words() -> List[str]:
+    return await word_lists.words(check_list)
+
+
+async def get_ban_words() -> List[str]:
+    return await word_lists.words(ban_list)
+
+
+async def get_word_matcher() -> WordMatcher:
+    return await word_lists.matcher()
+
+
+async def find_ban_and_check_words(message: str) -> Tuple[Optional[str], Optional[str]]:
+    # Одна токенизация сообщения на оба списка: (запрещенное слово, слово для проверки GPT)
+    matcher = await get_word_matcher()
+    return matcher.match(message)
 
 
 async def has_check_words(message: str) -> str or None:
-    check_words = await get_gpt_check_words()
-    # logging.info(f'Check words: {check_words}')
-    words = message.lower().split()
-    for word in words:
-        for check_word in check_words:
-            if fuzz.ratio(word, check_word) > C_ACCURACY:
-                return check_word
-    # logging.info(f'No check word found in message: {message}')
-    return None
+    matcher = await get_word_matcher()
+    return matcher.check_index.find(message.lower().split())
 
 
 async def has_ban_words(message: str) -> str or None:
-    ban_words = await get_ban_words()
-    # logging.info(f'Ban words: {ban_words}')
-    words = message.lower().split()
-    for word in words:
-        for ban_word in ban_words:
-            if fuzz.ratio(word, ban_word) > B_ACCURACY:
-                return ban_word
-    # logging.info(f'No ban word found in message: {message}')
-    return None
+    matcher = await get_word_matcher()
+    return matcher.ban_index.find(message.lower().split())
+
+
+spam_wave = SpamWaveDetector(
+    min_chats=getattr(config, 'SPAM_WAVE_MIN_CHATS', 3),
+    window=getattr(config, 'SPAM_WAVE_WINDOW', 600),
+    min_users=getattr(config, 'SPAM_WAVE_MIN_USERS', 2),
+    solo_chats=getattr(config, 'SPAM_WAVE_SOLO_CHATS', 10),
+)
+# Один экземпляр на все сообщения: LinkifyIt компилирует регулярные выражения при создании
+message_linkify = LinkifyIt()
+
+
+def message_fingerprints(message: Message) -> list:
+    text = message.text or message.caption
+    fingerprints = [text_fingerprint(text)]
+    if text:
+        fingerprints.extend(link_fingerprint(match.url) for match in message_linkify.match(text) or ())
+    if message.photo:
+        fingerprints.append(media_fingerprint(message.photo[-1].file_unique_id))
+    for media in (message.video, message.document):
+        if media:
+            fingerprints.append(media_fingerprint(media.file_unique_id))
+    return fingerprints
+
+
+def observe_spam_wave(message: Message) -> Optional[SpamWave]:
+    # Волна спама, если сообщение - копия текста, ссылки или файла, разосланного по нескольким чатам.
+    # Сообщения админов сюда не передаются: их объявления в нескольких чатах - не рассылка
+    return spam_wave.observe(message_fingerprints(message), message.chat.id, message.message_id,
+                             message.from_user.id)
 
 
 async def save_message_in_db(message: Message):
@@ -0,0 +1,212 @@
+import asyncio
+import json
+import logging
+import random
+import time
+from typing import AsyncIterator, Optional
+
+import aiohttp
+
+gptunnel_url = 'https://gptunnel.ru/v1'
+
+
+class GPTunnelError(Exception):
+    pass
+
+
+class CircuitOpenError(GPTunnelError):
+    pass
+
+
+class _RetryableStatus(Exception):
+    def __init__(self, status, retry_after=0.0):
+        super().__init__(f'HTTP {status}')
+        self.status = status
+        self.retry_after = retry_after
+
+
+# После failure_threshold неудач подряд запросы сразу отклоняются на reset_timeout секунд,
+# затем пропускается один пробный запрос: успех закрывает цепь, неудача снова ее размыкает.
+class CircuitBreaker:
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_progress = False
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def before_request(self) -> bool:
+        # True - запрос пробный (цепь полуоткрыта), вызывающий обязан завершить его через release_trial()
+        if self._opened_at is None:
+            return False
+        if self._trial_in_progress or time.monotonic() - self._opened_at < self.reset_timeout:
+            raise CircuitOpenError('GPTunnel circuit is open, request rejected')
+        self._trial_in_progress = True
+        return True
+
+    def release_trial(self):
+        # Пробный запрос завершился без record_success/record_failure (отмена, непредвиденная ошибка) - это сбой
+        if self._trial_in_progress:
+            self.record_failure()
+
+    def record_success(self):
+        if self._opened_at is not None:
+            logging.info("GPTunnel circuit closed")
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_progress = False
+
+    def record_failure(self):
+        self._failures += 1
+        self._trial_in_progress = False
+        if self._failures >= self.failure_threshold:
+            if self._opened_at is None:
+                logging.error(f"GPTunnel circuit opened after {self._failures} failures")
+            self._opened_at = time.monotonic()
+
+
+class GPTunnelClient:
+    def __init__(self, api_key, base_url=gptunnel_url, connect_timeout=5.0, read_timeout=60.0, retries=3,
+                 backoff_base=0.5, backoff_max=8.0, pool_size=100, failure_threshold=5, reset_timeout=30.0):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.timeout = aiohttp.ClientTimeout(total=None, connect=connect_timeout, sock_read=read_timeout)
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.pool_size = pool_size
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # Сессия создается лениво, уже внутри работающего event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout,
+                                                  headers={'Authorization': self.api_key})
+        return self._session
+
+    def _backoff(self, attempt, retry_after=0.0):
+        # Full jitter: случайная пауза до base * 2^attempt, чтобы повторы разных запросов не совпадали
+        return max(retry_after, random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt)))
+
+    @staticmethod
+    def _check_status(response: aiohttp.ClientResponse):
+        if response.status == 429 or response.status >= 500:
+            retry_after = response.headers.get('Retry-After', '0')
+            raise _RetryableStatus(response.status, float(retry_after) if retry_after.isdigit() else 0.0)
+        response.raise_for_status()
+
+    def _retry_delay(self, path, attempt, error) -> float:
+        self.breaker.record_failure()
+        if attempt == self.retries:
+            raise GPTunnelError(f'GPTunnel request {path} failed after {attempt + 1} attempts: {error!r}') from error
+        delay = self._backoff(attempt, getattr(error, 'retry_after', 0.0))
+        logging.warning(f"GPTunnel request {path} failed ({error!r}), retry in {delay:.2f}s")
+        return delay
+
+    def _rejected(self, path, error: aiohttp.ClientResponseError) -> GPTunnelError:
+        # 4xx (кроме 429) повторять бесполезно, и это не признак недоступности сервиса
+        self.breaker.record_success()
+        return GPTunnelError(f'GPTunnel request {path} rejected: {error.status} {error.message}')
+
+    async def request(self, method, path, payload=None) -> dict:
+        url = f'{self.base_url}{path}'
+        for attempt in range(self.retries + 1):
+            trial = self.breaker.before_request()
+            try:
+                async with self._get_session().request(method, url, json=payload) as response:
+                    self._check_status(response)
+                    result = await response.json(content_type=None)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError, _RetryableStatus) as e:
+                await asyncio.sleep(self._retry_delay(path, attempt, e))
+            except aiohttp.ClientResponseError as e:
+                raise self._rejected(path, e) from e
+            except Exception:
+                # Битый ответ (JSON, обрыв тела) - тоже сбой сервиса
+                self.breaker.record_failure()
+                raise
+            else:
+                self.breaker.record_success()
+                return result
+            finally:
+                if trial:
+                    self.breaker.release_trial()
+
+    async def stream(self, path, payload) -> AsyncIterator[dict]:
+        # Ответ в формате server-sent events: каждый "data: {...}" отдается по мере получения.
+        # Повторяется только установка соединения; после первого фрагмента ошибка уходит вызывающему.
+        url = f'{self.base_url}{path}'
+        response = None
+        trial = False
+        try:
+            for attempt in range(self.retries + 1):
+                trial = self.breaker.before_request()
+                try:
+                    response = await self._get_session().post(url, json=payload)
+                    self._check_status(response)
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError, _RetryableStatus) as e:
+                    if response is not None:
+                        response.release()
+                        response = None
+                    await asyncio.sleep(self._retry_delay(path, attempt, e))
+                except aiohttp.ClientResponseError as e:
+                    response.release()
+                    response = None
+                    raise self._rejected(path, e) from e
+                else:
+                    break
+            try:
+                async for line in response.content:
+                    line = line.decode('utf-8').strip()
+                    if not line.startswith('data:'):
+                        continue
+                    data = line[len('data:'):].strip()
+                    if data == '[DONE]':
+                        break
+                    yield json.loads(data)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.breaker.record_failure()
+                raise GPTunnelError(f'GPTunnel stream {path} interrupted: {e!r}') from e
+            except ValueError:
+                self.breaker.record_failure()
+                raise
+            else:
+                self.breaker.record_success()
+        finally:
+            # Отмена, закрытие генератора вызывающим или непредвиденная ошибка не должны оставить пробный
+            # запрос незавершенным: иначе цепь останется открытой навсегда
+            if trial:
+                self.breaker.release_trial()
+            if response is not None:
+                response.release()
+
+    async def chat_completion(self, messages, model) -> dict:
+        return await self.request('POST', '/chat/completions', {
+            "model": model,
+            "useWalletBalance": True,
+            "messages": messages,
+        })
+
+    async def stream_chat_completion(self, messages, model) -> AsyncIterator[str]:
+        async for chunk in self.stream('/chat/completions', {
+            "model": model,
+            "useWalletBalance": True,
+            "messages": messages,
+            "stream": True,
+        }):
+            choices = chunk.get('choices') or [{}]
+            content = (choices[0].get('delta') or {}).get('content')
+            if content:
+                yield content
+
+    async def get_models(self) -> dict:
+        return await self.request('GET', '/models')
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
@@ -2,41 +2,43 @@ import re
 import logging
 import time
 from datetime import datetime, timedelta
-import asyncio
 from functools import partial
 
 from aiogram import types
 from aiogram.dispatcher import Dispatcher
 from aiogram.dispatcher.filters import BoundFilter
-from aiogram.types import ChatMemberStatus, ChatActions
+from aiogram.types import ChatActions
 from aiogram.types import ChatType
 from aiogram.utils.callback_data import CallbackData
 
 import config
+from answer_index import group_scope
 from bot import bot, db
-from functions import (openai_request, has_ban_words, has_check_words, has_link, mute_user, unmute_user,
-                       save_message_in_db, get_link, get_reaction_count, openai_question, gptunnel_group_question,
-                       gptunnel_moderate_message)
+from functions import (openai_request, mute_user, unmute_user, get_reaction_count, openai_question, moderate_text,
+                       answer_question, edit_answer, chat_admins, delete_message_later, outbox, flood_detector,
+                       ban_everywhere)
+from moderation_pipeline import moderate
+from propagation import min_mute_left
 
 
 class AdminOrCreatorFilter(BoundFilter):
     async def check(self, message):
-        chat_member = await message.chat.get_member(message.from_user.id)
-        return chat_member.status in (types.ChatMemberStatus.CREATOR, types.ChatMemberStatus.ADMINISTRATOR)
-
-
-ALLOWED_GROUPS = None
+        return await chat_admins.is_admin(message.chat.id, message.from_user.id)
 
 
 # @dp.message_handler(content_types=[types.ContentType.NEW_CHAT_MEMBERS])
 async def on_new_chat_member(message: types.Message):
     new_members = message.new_chat_members
     bot_id = bot.id
-    global ALLOWED_GROUPS
-    ALLOWED_GROUPS = await db.get_allowed_groups()
-    ALLOWED_GROUPS = [item[0] for item in ALLOWED_GROUPS]
     chat_id = message.chat.id
+    flood_detector.on_join(chat_id, count=sum(1 for member in new_members if not member.is_bot))
+    raid_until = flood_detector.raid_until(chat_id)
     for member in new_members:
+        if raid_until is not None and not member.is_bot:
+            # Во время рейда новые участники не могут писать до его окончания. Мут короче 30 секунд
+            # Telegram считает бессрочным, поэтому срок не меньше min_mute_left
+            logging.info(f"User {member.full_name} joined chat {message.chat.title} during raid, muted")
+            await mute_user(chat_id, member.id, max(raid_until - time.time(), min_mute_left) / 86400)
         chat_member = await bot.get_chat_member(chat_id, member.id)
         if types.ChatMemberStatus.KICKED in chat_member.status:
             await bot.kick_chat_member(chat_id, member.id)
@@ -48,7 +50,7 @@ async def on_new_chat_member(message: types.Message):
             # Бот был добавлен в чат
             logging.info(f"Bot added to chat {message.chat.title}, id: {message.chat.id}")
             # Проверяем, есть ли чат в списке одобренных
-            if chat_id in ALLOWED_GROUPS:
+            if db.is_allowed_chat(chat_id):
                 logging.info(f"Chat {message.chat.title}, id: {message.chat.id} approved")
                 await message.answer(f"Привет, чат *{chat_title}*!\n"
                                      "Для того, чтобы я мог выполнять свою работу, я должен быть администратором",
@@ -63,8 +65,7 @@ async def on_new_chat_member(message: types.Message):
             await db.add_user(user_id=member.id, username=member.username)
             logging.info(f"User {member.full_name} added to chat {message.chat.title}, id: {message.chat.id}")
 
-        await asyncio.sleep(1)
-        await bot.delete_message(chat_id, message.message_id)
+        await delete_message_later(chat_id, message.message_id, 1)
 
 
 # @dp.message_handler(content_types=[types.ContentType.LEFT_CHAT_MEMBER])
@@ -72,8 +73,7 @@ async def on_left_chat_member(message: types.Message):
     chat_id = message.chat.id
     message_id = message.message_id
 
-    await asyncio.sleep(1)
-    await bot.delete_message(chat_id, message_id)
+    await delete_message_later(chat_id, message_id, 1)
 
 
 # @dp.message_handler(commands=["q"], chat_type=(ChatType.GROUP, ChatType.SUPERGROUP, ChatType.CHANNEL))
@@ -89,15 +89,19 @@ async def bot_question(message: types.Message):
         print(question_text, '#')
 
         try:
-            answer = await gptunnel_group_question(question_text)
+            def render(answer_text):
+                return (f"Ответ: \n{answer_text}\n\n"
+                        f"Если вы хотите задать еще вопрос, то напишите его снова через команду '/q'")
+
+            answer, reply = await answer_question(message, config.API_ROLE_GROUP, question_text, render, group_scope)
             if answer == 'check':
                 result = await moderate_message(message)
                 if result == 'ok':
                     pass
                 else:
+                    await reply.delete()
                     return
-            await message.reply(
-                f"Ответ: \n{answer}\n\nЕсли вы хотите задать еще вопрос, то напишите его снова через команду '/q'")
+            await edit_answer(reply, render(answer))
             status = 'complete'
             await db.insert_chat_message(chat_id, user_message_id, question_text, message.from_user.id,
                                          message.from_user.username, status)
@@ -114,22 +118,19 @@ async def bot_question(message: types.Message):
 
     elif len(command_parts) == 1 or len(command_parts) == 0:
         bot_message = await message.answer("Пожалуйста, задайте ваш вопрос после /q")
-        time.sleep(1.5)
-        await bot.delete_message(chat_id=message.chat.id, message_id=user_message_id)
-        await bot.delete_message(chat_id=message.chat.id, message_id=bot_message.message_id)
+        await delete_message_later(message.chat.id, user_message_id, 1.5)
+        await delete_message_later(message.chat.id, bot_message.message_id, 1.5)
 
     elif len(command_parts) == 2:
         bot_message = await message.answer("Пожалуйста, задайте более осознаный вопрос")
-        time.sleep(1.5)
-        await bot.delete_message(chat_id=message.chat.id, message_id=user_message_id)
-        await bot.delete_message(chat_id=message.chat.id, message_id=bot_message.message_id)
+        await delete_message_later(message.chat.id, user_message_id, 1.5)
+        await delete_message_later(message.chat.id, bot_message.message_id, 1.5)
 
 
 # @dp.message_handler(commands = ["m"], chat_type=(ChatType.GROUP, ChatType.SUPERGROUP, ChatType.CHANNEL))
 async def mute_command(message: types.Message):
     logging.info(f"Mute command from user {message.from_user.username}, id: {message.from_user.id}")
-    chat_member = await bot.get_chat_member(message.chat.id, message.from_user.id)
-    if chat_member.status in (ChatMemberStatus.CREATOR, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER):
+    if await chat_admins.is_admin(message.chat.id, message.from_user.id):
         chat_id = message.chat.id
         user_id = None
         message_text = None
@@ -164,7 +165,7 @@ async def mute_command(message: types.Message):
                     f"User @{username} muted for {mute_duration_days} days by admin {message.from_user.username}")
 
                 chat_info = await db.get_chat_info(chat_id=message.chat.id)
-                manual_punishment_notifications = chat_info['manual_punishment_notifications']
+                manual_punishment_notifications = chat_info.manual_punishment_notifications
                 if manual_punishment_notifications:
                     await message.reply(f"Пользователь @{username} замучен на {mute_duration_days} дней")
                 else:
@@ -183,8 +184,7 @@ async def mute_command(message: types.Message):
 # @dp.message_handler(commands = ["b"], chat_type=(ChatType.GROUP, ChatType.SUPERGROUP, ChatType.CHANNEL))
 async def ban_command(message: types.Message):
     logging.info(f"Ban command from user {message.from_user.username}, id: {message.from_user.id}")
-    chat_member = await bot.get_chat_member(message.chat.id, message.from_user.id)
-    if chat_member.status in (ChatMemberStatus.CREATOR, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER):
+    if await chat_admins.is_admin(message.chat.id, message.from_user.id):
         chat_id = message.chat.id
         user_id = None
         message_text = None
@@ -213,7 +213,7 @@ async def ban_command(message: types.Message):
                 logging.info(f"User @{username} banned by admin {message.from_user.username}")
 
                 chat_info = await db.get_chat_info(chat_id=message.chat.id)
-                manual_punishment_notifications = chat_info['manual_punishment_notifications']
+                manual_punishment_notifications = chat_info.manual_punishment_notifications
                 if manual_punishment_notifications:
                     await message.reply(f"_Пользователю @{username} была перманентно отключена "
                                         f"возможность отправлять сообщения_"
@@ -227,6 +227,7 @@ async def ban_command(message: types.Message):
                 await db.insert_punishment(user_id=user_id, username=username, chat_id=chat_id,
                                            message_text=message_text, reason=reason, source_reason=reason)
                 await db.insert_spamer(user_id=user_id, chat_id=chat_id, message_text=message_text, reason=reason)
+                await ban_everywhere(user_id, chat_id)
         except Exception as e:
             print(e.with_traceback, e, '-не удалось замутить пользователя!!!')
     else:
@@ -236,10 +237,9 @@ async def ban_command(message: types.Message):
 # @dp.message_handler(commands = ["um"], chat_type=(ChatType.GROUP, ChatType.SUPERGROUP, ChatType.CHANNEL))
 async def unmute_command(message: types.Message):
     logging.info(f"Unmute command from user {message.from_user.username}, id: {message.from_user.id}")
-    chat_member = await bot.get_chat_member(message.chat.id, message.from_user.id)
-    if chat_member.status not in (ChatMemberStatus.CREATOR, ChatMemberStatus.ADMINISTRATOR):
+    if not await chat_admins.is_admin(message.chat.id, message.from_user.id):
         await moderate_message(message)
-    elif chat_member.status in (ChatMemberStatus.CREATOR, ChatMemberStatus.ADMINISTRATOR):
+    else:
         chat_id = message.chat.id
         user_id = None
 
@@ -256,7 +256,7 @@ async def unmute_command(message: types.Message):
                 await unmute_user(chat_id, user_id)
                 logging.info(f"User @{username} unmuted by admin {message.from_user.username}")
                 chat_info = await db.get_chat_info(chat_id=message.chat.id)
-                removal_punishment_notifications = chat_info['removal_punishment_notifications']
+                removal_punishment_notifications = chat_info.removal_punishment_notifications
                 if removal_punishment_notifications:
                     await message.reply(f"Пользователь @{username} размучен ")
                 else:
@@ -274,30 +274,31 @@ async def report_command(message: types.Message):
         try:
             user_id = message.reply_to_message.from_user.id
             message_text = message.reply_to_message.text
-            chat_member = await bot.get_chat_member(message.chat.id, user_id)
-            if chat_member.status in (ChatMemberStatus.CREATOR, ChatMemberStatus.ADMINISTRATOR):
+            if await chat_admins.is_admin(message.chat.id, user_id):
                 # тут можно вывести сообщение, мол на админов жаловаться не надо, но я посчитал это лишним
                 return
-            gpt_answer = await gptunnel_moderate_message(message_text)
+            gpt_answer = await moderate_text(message_text)
             chat_info = await db.get_chat_info(chat_id=message.chat.id)
-            auto_punishment_notifications = chat_info['auto_punishment_notifications']
+            auto_punishment_notifications = chat_info.auto_punishment_notifications
             if gpt_answer == 'spam':
                 logging.info(f"User @{message.reply_to_message.from_user.username} was baned by report")
                 if auto_punishment_notifications:
-                    await message.answer(
+                    outbox.send_message(
+                        message.chat.id,
                         f"@{message.reply_to_message.from_user.username}, ваше сообщение расценено как спам\n"
                         "_Вам была отключена возможность отправлять сообщения\n"
                         "Если считаете блокировку несправедливой, обратитесь к администратору группы_",
-                        parse_mode='Markdown')
+                        dedup_key=('punishment', message.chat.id, user_id), parse_mode='Markdown')
                 else:
                     logging.info(f"User {message.from_user.username}, "
                                  f"id: {message.from_user.id},chat: {message.chat.title} "
                                  f"--- no notification punishment")
                 await mute_user(chat_id=message.chat.id, user_id=user_id, mute_duration_days=367)
                 reason = 'by_report'
-                await bot.delete_message(chat_id=message.chat.id, message_id=message.reply_to_message.message_id)
+                outbox.delete_message(message.chat.id, message.reply_to_message.message_id)
                 await db.insert_spamer(user_id=user_id, chat_id=message.chat.id, message_text=message_text,
                                        reason=reason)
+                await ban_everywhere(user_id, message.chat.id)
                 await db.insert_punishment(user_id=user_id, username=message.reply_to_message.from_user.username,
                                            chat_id=message.chat.id, message_text=message_text, reason=reason,
                                            source_reason=f'f{reason}, gpt answer:{gpt_answer}')
@@ -315,141 +316,16 @@ async def report_command(message: types.Message):
 # @dp.message_handler(content_types=types.ContentTypes.TEXT,
 #                     chat_type=(ChatType.GROUP, ChatType.SUPERGROUP, ChatType.CHANNEL))
 async def moderate_message(message: types.Message):
-    logging.info(f"Handle message from user {message.from_user.username}, id: {message.from_user.id}")
-    await save_message_in_db(message)
-    chat_member = await bot.get_chat_member(message.chat.id, message.from_user.id)
-    if chat_member.status not in (ChatMemberStatus.CREATOR, ChatMemberStatus.ADMINISTRATOR):
-        logging.info(f"Start moderate message from user {message.from_user.username}, id: {message.from_user.id}")
-        user_message_id = message.message_id
-        user_messages_count = await db.get_message_count_by_user(user_id=message.from_user.id, chat_id=message.chat.id)
-        chat_info = await db.get_chat_info(chat_id=message.chat.id)
-        auto_punishment_notifications = chat_info['auto_punishment_notifications']
-
-        if await db.is_spamer(user_id=message.from_user.id):
-            logging.info(f"User {message.from_user.username} was baned by spam base")
-            await mute_user(chat_id=message.chat.id, user_id=message.from_user.id, mute_duration_days=367)
-            reason = 'spamer_from_base'
-            await bot.delete_message(chat_id=message.chat.id, message_id=user_message_id)
-            await db.insert_punishment(user_id=message.from_user.id, username=message.from_user.username,
-                                       chat_id=message.chat.id, message_text=message.text, reason=reason,
-                                       source_reason=f'f{reason}, username:{message.from_user.username}')
-            return
+    # Этапы проверки и их порядок - в moderation_pipeline, порядок и набор этапов настраиваются для каждого чата
+    return await moderate(message)
 
-        if message.text:
-            b_words = await has_ban_words(message.text)
-            if b_words is not None:
-                logging.info(f"User {message.from_user.username}, id: {message.from_user.id} "
-                             f"was baned by ban words in his message {message.message_id}")
-                if auto_punishment_notifications:
-                    await message.answer(
-                        f"@{message.from_user.username}, в вашем сообщении обнаружены запрещенные слова\n"
-                        "_Вам была отключена возможность отправлять сообщения\n"
-                        "Если считаете блокировку несправедливой, обратитесь к администратору группы_",
-                        parse_mode='Markdown')
-                else:
-                    logging.info(f"User {message.from_user.username}, "
-                                 f"id: {message.from_user.id},chat: {message.chat.title} "
-                                 f"--- no notification punishment")
-                await mute_user(chat_id=message.chat.id, user_id=message.from_user.id, mute_duration_days=367)
-                reason = 'ban_word'
-                await bot.delete_message(chat_id=message.chat.id, message_id=user_message_id)
-                await db.insert_spamer(user_id=message.from_user.id, chat_id=message.chat.id, message_text=message.text,
-                                       reason=reason)
-                await db.insert_punishment(user_id=message.from_user.id, username=message.from_user.username,
-                                           chat_id=message.chat.id, message_text=message.text, reason=reason,
-                                           source_reason=b_words)
-                return
 
-            if user_messages_count < config.MESSAGES_COUNT_ON_CHECK:
-                logging.info(f"New-member check for user {message.from_user.username}, id: {message.from_user.id}")
-                gpt_answer = await gptunnel_moderate_message(message.text)
-                if gpt_answer == 'spam':
-                    logging.info(f"Message {message.message_id} from @{message.from_user.username} detected as spam")
-                    if auto_punishment_notifications:
-                        await message.answer(f"@{message.from_user.username}, ваше сообщение расценено как спам\n"
-                                             "_Вам была отключена возможность отправлять сообщения\n"
-                                             "Если считаете блокировку несправедливой, "
-                                             "обратитесь к администратору группы_",
-                                             parse_mode='Markdown')
-                    else:
-                        logging.info(f"User {message.from_user.username}, "
-                                     f"id: {message.from_user.id},chat: {message.chat.title} "
-                                     f"--- no notification punishment")
-
-                    await mute_user(chat_id=message.chat.id, user_id=message.from_user.id, mute_duration_days=367)
-                    reason = 'by_gpt_newmember_control'
-                    logging.info(
-                        f"User @{message.from_user.username} was baned by gpt detect. gpt_answer: {gpt_answer}")
-                    await db.insert_spamer(user_id=message.from_user.id, chat_id=message.chat.id,
-                                           message_text=message.text,
-                                           reason=reason)
-                    await db.insert_punishment(user_id=message.from_user.id, username=message.from_user.username,
-                                               chat_id=message.chat.id, message_text=message.text, reason=reason,
-                                               source_reason=reason)
-                    await bot.delete_message(chat_id=message.chat.id, message_id=user_message_id)
-                    return
-                elif gpt_answer == 'ok':
-                    logging.info(f"gpt_answer: {gpt_answer}, message accepted")
-                else:
-                    logging.info(f"gpt_answer: {gpt_answer} - gpt answer is not template")
-            c_words = await has_check_words(message.text)
-            if c_words is not None:
-                logging.info(f"Message {message.message_id} from @{message.from_user.username} "
-                             f"has check-words. Start checking")
-                gpt_answer = await gptunnel_moderate_message(message.text)
-                if gpt_answer == 'spam':
-                    logging.info(f"Message {message.message_id} from @{message.from_user.username} detected as spam")
-                    if auto_punishment_notifications:
-                        await message.answer(f"@{message.from_user.username}, ваше сообщение расценено как спам\n"
-                                             "_Вам была отключена возможность отправлять сообщения_",
-                                             parse_mode='Markdown')
-                    else:
-                        logging.info(f"User {message.from_user.username}, "
-                                     f"id: {message.from_user.id},chat: {message.chat.title} "
-                                     f"--- no notification punishment")
-
-                    await mute_user(chat_id=message.chat.id, user_id=message.from_user.id, mute_duration_days=367)
-                    reason = 'spam-message'
-                    logging.info(
-                        f"User @{message.from_user.username}, id: {message.from_user.id} was baned by gpt detect")
-                    await bot.delete_message(chat_id=message.chat.id, message_id=user_message_id)
-                    await db.insert_spamer(user_id=message.from_user.id, chat_id=message.chat.id,
-                                           message_text=message.text,
-                                           reason=reason)
-                    await db.insert_punishment(user_id=message.from_user.id, username=message.from_user.username,
-                                               chat_id=message.chat.id, message_text=message.text, reason=reason,
-                                               source_reason=f'{reason} by gpt check; trigger words: {c_words}')
-                    return
-                elif gpt_answer == 'ok':
-                    logging.info(f"gpt_answer: {gpt_answer}, message accepted")
-                else:
-                    logging.info(f"gpt_answer: {gpt_answer} - gpt answer is not template")
-
-            if await has_link(message.text):
-                logging.info(f"Message {message.message_id} from @{message.from_user.username} has link")
-                if auto_punishment_notifications:
-                    await message.answer(
-                        f"@{message.from_user.username}, для новых пользователей *запрещена отправка ссылок*\n"
-                        "_Вам была временно отключена возможность отправлять сообщения_",
-                        parse_mode='Markdown')
-                else:
-                    logging.info(f"User {message.from_user.username}, "
-                                 f"id: {message.from_user.id},chat: {message.chat.title} "
-                                 f"--- no notification punishment")
-
-                await mute_user(chat_id=message.chat.id, user_id=message.from_user.id, mute_duration_days=3)
-                logging.info(f"User @{message.from_user.username}, id: {message.from_user.id} was muted by link")
-                reason = 'link in message'
-                source = await get_link(message.text)
-                await bot.delete_message(chat_id=message.chat.id, message_id=user_message_id)
-                await db.insert_punishment(user_id=message.from_user.id, username=message.from_user.username,
-                                           chat_id=message.chat.id, message_text=message.text, reason=reason,
-                                           source_reason=source)
-
-            else:
-                logging.info(f"Message {message.message_id} from @{message.from_user.username} is ok")
-                result = 'ok'
-                return result
+# @dp.chat_member_handler()
+async def on_chat_member_updated(update: types.ChatMemberUpdated):
+    # Назначение и снятие админов сразу отражается в кэше статусов
+    logging.info(f"Chat member {update.new_chat_member.user.id} in chat {update.chat.id}: "
+                 f"{update.old_chat_member.status} -> {update.new_chat_member.status}")
+    chat_admins.update(update.chat.id, update.new_chat_member.user.id, update.new_chat_member.status)
 
 
 def register_handlers_group(dp: Dispatcher):
@@ -465,6 +341,8 @@ def register_handlers_group(dp: Dispatcher):
                                 chat_type=(ChatType.GROUP, ChatType.SUPERGROUP, ChatType.CHANNEL))
     dp.register_message_handler(bot_question, commands=["q"],
                                 chat_type=(ChatType.GROUP, ChatType.SUPERGROUP, ChatType.CHANNEL))
+    dp.register_chat_member_handler(on_chat_member_updated)
+    dp.register_my_chat_member_handler(on_chat_member_updated)
     dp.register_message_handler(moderate_message, content_types=types.ContentTypes.ANY,
                                 chat_type=(ChatType.GROUP, ChatType.SUPERGROUP, ChatType.CHANNEL))
     logging.info("Group handlers registered")
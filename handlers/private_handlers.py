@@ -6,19 +6,23 @@ from aiogram import types, Dispatcher
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.types import ChatType
-from aiogram.utils.exceptions import ChatNotFound
+from aiogram.utils.exceptions import ChatNotFound, MessageNotModified
 
+from answer_index import private_scope, faq_source, history_source
 from bot import bot, dp, db
 from config import *
-from functions import openai_question, order_alert, gptunnel_private_question
+from functions import (openai_question, order_alert, word_lists, llm_scheduler, answer_question, edit_answer,
+                       answer_index, outbox, flood_detector, propagation, spam_wave)
 from json_manager import api_model, save_api_model, load_api_model
-
-ALLOWED_GROUPS = None
+from moderation_pipeline import moderation_pipeline
+from word_lists import ban_list, check_list
 
 
 class BotState(StatesGroup):
     waiting_for_question = State()  # Состояние для ожидания вопроса
     waiting_for_chat_id = State()  # Состояние для ожидания id чата
+    waiting_for_words = State()  # Состояние для ожидания слов для списка
+    waiting_for_faq = State()  # Состояние для ожидания нового вопроса и ответа FAQ
 
 
 # @dp.message_handler(commands = ["start"], chat_type=ChatType.PRIVATE)
@@ -98,12 +102,14 @@ async def handle_question(message: types.Message, state: FSMContext):
         print(question_text, '#')
 
         try:
-            answer = await gptunnel_private_question(question_text)
+            def render(answer_text):
+                return (f"Ответ: \n\n{answer_text}\n\n"
+                        f"Если вы не хотите больше задавать вопросы, нажмите на кнопку 'Вернуться'")
+
+            answer, reply = await answer_question(message, API_ROLE_PRIVATE, question_text, render, private_scope)
             keyboard.add(services_button)
             keyboard.add(return_button)
-            await message.reply(
-                f"Ответ: \n\n{answer}\n\nЕсли вы не хотите больше задавать вопросы, нажмите на кнопку 'Вернуться'",
-                reply_markup=keyboard)
+            await edit_answer(reply, render(answer), reply_markup=keyboard)
             status = 'complete'
 
         except Exception as e:
@@ -224,11 +230,9 @@ async def admin_panel(callback_query: types.CallbackQuery):
     logging.info(f"User {callback_query.from_user.id} opened admin panel")
 
     message_text = "Выберите действие:"
-    global ALLOWED_GROUPS
-    ALLOWED_GROUPS = await db.get_allowed_groups()
     # Создаем inline-кнопки для каждого чата
     keyboard = types.InlineKeyboardMarkup(row_width=1)
-    for group_id in ALLOWED_GROUPS:
+    for group_id in await db.get_allowed_groups():
         try:
             group_info = await bot.get_chat(str(group_id))
             button_text = f"Чат - {group_info['title']}"
@@ -243,8 +247,12 @@ async def admin_panel(callback_query: types.CallbackQuery):
     model_button = types.InlineKeyboardButton(f"Модель: {openai_api_model['openaimodel']}",
                                               callback_data="model_change")
     orders_button = types.InlineKeyboardButton("Заказы", callback_data="orders_list")
+    word_lists_button = types.InlineKeyboardButton("Списки слов", callback_data="word_lists")
+    llm_stats_button = types.InlineKeyboardButton("Нагрузка", callback_data="llm_stats")
+    answer_cache_button = types.InlineKeyboardButton("FAQ и кэш ответов", callback_data="answer_cache")
     back_button = types.InlineKeyboardButton("Вернуться", callback_data="return_to_start")
-    keyboard.add(add_chat_button, model_button, orders_button, back_button)
+    keyboard.add(add_chat_button, model_button, orders_button, word_lists_button, llm_stats_button,
+                 answer_cache_button, back_button)
 
     await bot.edit_message_text(chat_id=callback_query.message.chat.id,
                                 message_id=callback_query.message.message_id,
@@ -296,10 +304,8 @@ async def handle_chat_id_input(message: types.Message, state: FSMContext):
     admin_button = types.InlineKeyboardButton("Вернуться", callback_data="admin_panel")
     keyboard = types.InlineKeyboardMarkup().add(admin_button)
     await state.finish()
-    global ALLOWED_GROUPS
     try:
         await db.add_allowed_chat(int(chat_id))
-        ALLOWED_GROUPS = await db.get_allowed_groups()
         await message.answer(f"Чат {chat_id} успешно добавлен", reply_markup=keyboard)
         logging.info(f"User {message.from_user.id} successfully added chat {chat_id}")
     except Exception as e:
@@ -327,7 +333,10 @@ async def chat_details(callback_query: types.CallbackQuery):
         back_button = types.InlineKeyboardButton("Вернуться", callback_data="admin_panel")
         notification_settings_button = types.InlineKeyboardButton("Настройки уведомлений",
                                                                   callback_data=f"notification_settings_{chat_id}")
-        keyboard.add(delete_button, get_punishments_button, notification_settings_button, back_button)
+        moderation_stages_button = types.InlineKeyboardButton("Этапы модерации",
+                                                              callback_data=f"mstages_{chat_id}")
+        keyboard.add(delete_button, get_punishments_button, notification_settings_button, moderation_stages_button,
+                     back_button)
 
         await bot.edit_message_text(chat_id=callback_query.message.chat.id,
                                     message_id=callback_query.message.message_id,
@@ -337,15 +346,71 @@ async def chat_details(callback_query: types.CallbackQuery):
         await bot.answer_callback_query(callback_query.id, text=f"Чат {chat_id} не найден.")
 
 
+# @dp.callback_query_handler(lambda query: query.data.startswith("mstages_"))
+async def moderation_stages(callback_query: types.CallbackQuery, chat_id=None):
+    logging.info(f"Received callback '{callback_query.data}' by user {callback_query.from_user.id}")
+    if chat_id is None:
+        chat_id = int(callback_query.data.split("_")[1])
+    chat_info = await db.get_chat_info(chat_id=chat_id)
+    enabled = moderation_pipeline.stage_names(chat_info)
+    stats = moderation_pipeline.stats()
+    message_text = (f"Этапы модерации для чата {chat_info.chat_title if chat_info else chat_id}.\n"
+                    f"Порядок меняется внутри группы: локальные проверки всегда выполняются раньше GPT.\n\n")
+    keyboard = types.InlineKeyboardMarkup(row_width=2)
+    disabled = [name for name in moderation_pipeline.default_order if name not in enabled]
+    for name in enabled + tuple(disabled):
+        stage = moderation_pipeline.stages[name]
+        is_enabled = name in enabled
+        message_text += (f"{'🟢' if is_enabled else '🔴'} {stage.title}: {stats[name]['runs']} проверок, "
+                         f"{stats[name]['verdicts']} наказаний, в среднем {stats[name]['avg'] * 1000:.0f} мс\n")
+        toggle_button = types.InlineKeyboardButton(f"{'🟢' if is_enabled else '🔴'} {stage.title}",
+                                                   callback_data=f"mstage_toggle_{chat_id}_{name}")
+        if is_enabled:
+            keyboard.add(toggle_button, types.InlineKeyboardButton("⬆", callback_data=f"mstage_up_{chat_id}_{name}"))
+        else:
+            keyboard.add(toggle_button)
+    keyboard.add(types.InlineKeyboardButton("По умолчанию", callback_data=f"mstage_reset_{chat_id}"))
+    keyboard.add(types.InlineKeyboardButton("Вернуться", callback_data=f"group_details_{chat_id}"))
+    try:
+        await bot.edit_message_text(chat_id=callback_query.message.chat.id,
+                                    message_id=callback_query.message.message_id,
+                                    text=message_text, reply_markup=keyboard)
+    except MessageNotModified:
+        pass
+
+
+# @dp.callback_query_handler(lambda query: query.data.startswith("mstage_"))
+async def switch_moderation_stage(callback_query: types.CallbackQuery):
+    logging.info(f"Received callback '{callback_query.data}' by user {callback_query.from_user.id}")
+    parts = callback_query.data.split("_", 3)
+    action, chat_id = parts[1], int(parts[2])
+    chat_info = await db.get_chat_info(chat_id=chat_id)
+    stages = list(moderation_pipeline.stage_names(chat_info))
+    if action == "reset":
+        stages = None
+    elif action == "toggle":
+        name = parts[3]
+        if name in stages:
+            stages.remove(name)
+        else:
+            stages.append(name)
+    elif action == "up":
+        index = stages.index(parts[3])
+        if index > 0:
+            stages[index - 1], stages[index] = stages[index], stages[index - 1]
+    await db.update_moderation_stages(chat_id, stages)
+    logging.info(f"User {callback_query.from_user.id} set moderation stages for chat {chat_id}: {stages}")
+    await callback_query.answer()
+    await moderation_stages(callback_query, chat_id=chat_id)
+
+
 # @dp.callback_query_handler(lambda query: query.data.startswith("delete_chat_"))
 async def delete_chat(callback_query: types.CallbackQuery):
     logging.info(f"Received callback 'delete_chat' by user {callback_query.from_user.id}")
     chat_id = str(callback_query.data.split("_")[2])  # Получаем идентификатор чата из callback
-    global ALLOWED_GROUPS
 
     try:
         await db.delete_allowed_group(int(chat_id))
-        ALLOWED_GROUPS = await db.get_allowed_groups()
         await bot.answer_callback_query(callback_query.id, text=f"Чат {chat_id} удален.")
         logging.info(f"Chat {chat_id} deleted.")
     except Exception as e:
@@ -406,9 +471,9 @@ async def notification_settings(callback_query: types.CallbackQuery):
     logging.info(f"Received callback 'notification_settings' by user {callback_query.from_user.id}")
     chat_id = int(callback_query.data.split("_")[2])
     chat_info = await db.get_chat_info(chat_id=chat_id)
-    manual_punishment_notifications = chat_info['manual_punishment_notifications']
-    auto_punishment_notifications = chat_info['auto_punishment_notifications']
-    removal_punishment_notifications = chat_info['removal_punishment_notifications']
+    manual_punishment_notifications = chat_info.manual_punishment_notifications
+    auto_punishment_notifications = chat_info.auto_punishment_notifications
+    removal_punishment_notifications = chat_info.removal_punishment_notifications
     keyboard = types.InlineKeyboardMarkup()
     keyboard.add(
         types.InlineKeyboardButton("🟢" + " Aвтоматические наказания" if auto_punishment_notifications
@@ -427,16 +492,16 @@ async def notification_settings(callback_query: types.CallbackQuery):
     await bot.edit_message_text(
         chat_id=callback_query.message.chat.id,
         message_id=callback_query.message.message_id,
-        text=f"Настройки уведомлений для чата {chat_info['chat_title']}:",
+        text=f"Настройки уведомлений для чата {chat_info.chat_title}:",
         reply_markup=keyboard
     )
 
 
 async def update_notification_button_text(chat_id):
     chat_info = await db.get_chat_info(chat_id=chat_id)
-    manual_punishment_notifications = chat_info['manual_punishment_notifications']
-    auto_punishment_notifications = chat_info['auto_punishment_notifications']
-    removal_punishment_notifications = chat_info['removal_punishment_notifications']
+    manual_punishment_notifications = chat_info.manual_punishment_notifications
+    auto_punishment_notifications = chat_info.auto_punishment_notifications
+    removal_punishment_notifications = chat_info.removal_punishment_notifications
     keyboard = types.InlineKeyboardMarkup()
     keyboard.add(
         types.InlineKeyboardButton("🟢" + " Aвтоматические наказания" if auto_punishment_notifications
@@ -493,6 +558,171 @@ async def choose_gpt_4(callback_query: types.CallbackQuery):
     await bot.answer_callback_query(callback_query.id, text="Модель изменена на GPT-4")
 
 
+LLM_CLASS_TITLES = {
+    'moderation': "Модерация",
+    'qa': "Вопросы",
+}
+
+
+# @dp.callback_query_handler(lambda query: query.data == "llm_stats")
+async def show_llm_stats(callback_query: types.CallbackQuery):
+    logging.info(f"Received callback 'llm_stats' by user {callback_query.from_user.id}")
+    message_text = ""
+    for name, stats in llm_scheduler.stats().items():
+        message_text += (f"{LLM_CLASS_TITLES[name]}:\n"
+                         f"в очереди {stats['queued']} (чатов: {stats['queued_chats']}), "
+                         f"выполняется {stats['running']}, выполнено {stats['completed']}\n"
+                         f"ожидание: среднее {stats['wait_avg']:.2f} с, p95 {stats['wait_p95']:.2f} с, "
+                         f"макс. {stats['wait_max']:.2f} с\n\n")
+    stats = outbox.stats()
+    message_text += (f"Действия в Telegram:\n"
+                     f"в очереди {stats['queued']}, отправлено {stats['sent']}, ошибок {stats['failed']}, "
+                     f"ограничено Telegram {stats['throttled']}\n"
+                     f"задержка: средняя {stats['latency_avg']:.2f} с, p95 {stats['latency_p95']:.2f} с, "
+                     f"макс. {stats['latency_max']:.2f} с\n"
+                     f"склеено удалений {stats['coalesced_deletes']}, заменено ограничений "
+                     f"{stats['replaced_restricts']}, пропущено повторных уведомлений {stats['dropped_notifications']}\n\n")
+    stats = flood_detector.stats()
+    message_text += (f"Флуд и рейды:\n"
+                     f"флудеров {stats['floods']} (удалено сообщений {stats['flood_messages']}), рейдов {stats['raids']}, "
+                     f"сейчас в режиме рейда чатов: {stats['raid_chats']}\n"
+                     f"отслеживается пользователей {stats['users']}, чатов {stats['chats']}\n\n")
+    stats = spam_wave.stats()
+    message_text += (f"Рассылки по чатам: волн {stats['waves']} (сейчас активно {stats['active_waves']}), "
+                     f"сообщений из волн {stats['wave_messages']}, отпечатков {stats['fingerprints']}\n\n")
+    message_text += f"Ограничения во всех чатах: выполнено задач {propagation.completed}"
+    for job in propagation.jobs():
+        message_text += (f"\n#{job.job_id} {job.action} {job.user_id}: {job.done + job.failed}/{job.total} чатов, "
+                         f"ошибок {job.failed}")
+    keyboard = types.InlineKeyboardMarkup(row_width=1)
+    keyboard.add(types.InlineKeyboardButton("Обновить", callback_data="llm_stats"),
+                 types.InlineKeyboardButton("Вернуться", callback_data="admin_panel"))
+    try:
+        await bot.edit_message_text(chat_id=callback_query.message.chat.id,
+                                    message_id=callback_query.message.message_id,
+                                    text=message_text, reply_markup=keyboard)
+    except MessageNotModified:
+        await bot.answer_callback_query(callback_query.id, text="Без изменений")
+
+
+WORD_LIST_TITLES = {
+    ban_list: "Запрещенные слова",
+    check_list: "Слова для проверки GPT",
+}
+
+
+# @dp.callback_query_handler(lambda query: query.data == "word_lists", state="*")
+async def show_word_lists(callback_query: types.CallbackQuery, state: FSMContext):
+    logging.info(f"Received callback 'word_lists' by user {callback_query.from_user.id}")
+    await state.finish()
+    message_text = ""
+    keyboard = types.InlineKeyboardMarkup(row_width=1)
+    for list_name, title in WORD_LIST_TITLES.items():
+        words = await word_lists.words(list_name)
+        preview = ', '.join(words[:50]) + (' ...' if len(words) > 50 else '')
+        message_text += f"{title} ({len(words)}):\n{preview}\n\n"
+        keyboard.add(types.InlineKeyboardButton(f"Добавить: {title.lower()}", callback_data=f"words_add_{list_name}"),
+                     types.InlineKeyboardButton(f"Удалить: {title.lower()}",
+                                                callback_data=f"words_remove_{list_name}"))
+    keyboard.add(types.InlineKeyboardButton("Вернуться", callback_data="admin_panel"))
+    await bot.edit_message_text(chat_id=callback_query.message.chat.id,
+                                message_id=callback_query.message.message_id,
+                                text=message_text, reply_markup=keyboard)
+
+
+# @dp.callback_query_handler(lambda query: query.data.startswith("words_"))
+async def edit_word_list(callback_query: types.CallbackQuery, state: FSMContext):
+    logging.info(f"Received callback '{callback_query.data}' by user {callback_query.from_user.id}")
+    _, action, list_name = callback_query.data.split("_", 2)
+    await BotState.waiting_for_words.set()
+    await state.update_data(word_action=action, word_list=list_name)
+    keyboard = types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("Вернуться", callback_data="word_lists"))
+    action_text = "добавить в список" if action == "add" else "удалить из списка"
+    await bot.edit_message_text(chat_id=callback_query.message.chat.id,
+                                message_id=callback_query.message.message_id,
+                                text=f"Отправьте слова, которые нужно {action_text} "
+                                     f"«{WORD_LIST_TITLES[list_name]}», через пробел или с новой строки:",
+                                reply_markup=keyboard)
+
+
+# @dp.message_handler(lambda message: message.text and message.from_user.id in ADMIN_ID,
+#                     state=BotState.waiting_for_words)
+async def handle_words_input(message: types.Message, state: FSMContext):
+    data = await state.get_data()
+    await state.finish()
+    list_name = data['word_list']
+    keyboard = types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("Вернуться", callback_data="word_lists"))
+    if data['word_action'] == 'add':
+        changed = await word_lists.add_words(list_name, message.text.split())
+        result_text = "Добавлены слова"
+    else:
+        changed = await word_lists.remove_words(list_name, message.text.split())
+        result_text = "Удалены слова"
+    logging.info(f"User {message.from_user.id} updated word list {list_name}: {data['word_action']} {changed}")
+    if changed:
+        await message.answer(f"{result_text}: {', '.join(changed)}", reply_markup=keyboard)
+    else:
+        await message.answer("Список не изменился", reply_markup=keyboard)
+
+
+# @dp.callback_query_handler(lambda query: query.data == "answer_cache", state="*")
+async def show_answer_cache(callback_query: types.CallbackQuery, state: FSMContext):
+    logging.info(f"Received callback 'answer_cache' by user {callback_query.from_user.id}")
+    await state.finish()
+    stats = answer_index.stats()
+    message_text = (f"Сохраненных ответов GPT: {stats['history']}, вопросов FAQ: {stats['faq']}\n"
+                    f"Ответов из кэша: {stats['hits']}, запросов к GPT: {stats['misses']} "
+                    f"(доля ответов из кэша {stats['hit_rate']:.1%})\n\n")
+    keyboard = types.InlineKeyboardMarkup(row_width=1)
+    for entry in answer_index.faq()[:30]:
+        message_text += f"#{entry.id}: {entry.question}\n"
+        keyboard.add(types.InlineKeyboardButton(f"Удалить FAQ #{entry.id}", callback_data=f"faq_delete_{entry.id}"))
+    keyboard.add(types.InlineKeyboardButton("Добавить вопрос в FAQ", callback_data="faq_add"),
+                 types.InlineKeyboardButton("Очистить сохраненные ответы GPT", callback_data="faq_clear_history"),
+                 types.InlineKeyboardButton("Вернуться", callback_data="admin_panel"))
+    try:
+        await bot.edit_message_text(chat_id=callback_query.message.chat.id,
+                                    message_id=callback_query.message.message_id,
+                                    text=message_text, reply_markup=keyboard)
+    except MessageNotModified:
+        pass
+
+
+# @dp.callback_query_handler(lambda query: query.data.startswith("faq_"))
+async def edit_answer_cache(callback_query: types.CallbackQuery, state: FSMContext):
+    logging.info(f"Received callback '{callback_query.data}' by user {callback_query.from_user.id}")
+    if callback_query.data == "faq_add":
+        await BotState.waiting_for_faq.set()
+        keyboard = types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("Вернуться",
+                                                                               callback_data="answer_cache"))
+        await bot.edit_message_text(chat_id=callback_query.message.chat.id,
+                                    message_id=callback_query.message.message_id,
+                                    text="Отправьте вопрос в первой строке, а ответ - со второй строки:",
+                                    reply_markup=keyboard)
+        return
+    if callback_query.data == "faq_clear_history":
+        await answer_index.clear(source=history_source)
+        await bot.answer_callback_query(callback_query.id, text="Сохраненные ответы GPT удалены")
+    else:
+        answer_id = int(callback_query.data.split("_")[-1])
+        await answer_index.remove(answer_id)
+        await bot.answer_callback_query(callback_query.id, text=f"Вопрос FAQ #{answer_id} удален")
+    await show_answer_cache(callback_query, state)
+
+
+# @dp.message_handler(lambda message: message.text, state=BotState.waiting_for_faq)
+async def handle_faq_input(message: types.Message, state: FSMContext):
+    await state.finish()
+    keyboard = types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("Вернуться", callback_data="answer_cache"))
+    question, _, answer = message.text.partition("\n")
+    if not question.strip() or not answer.strip():
+        await message.answer("Нужны и вопрос, и ответ: вопрос в первой строке, ответ со второй", reply_markup=keyboard)
+        return
+    entry = await answer_index.add(question.strip(), answer.strip(), scope=None, source=faq_source)
+    logging.info(f"User {message.from_user.id} added FAQ #{entry.id}: {entry.question}")
+    await message.answer(f"Вопрос добавлен в FAQ (#{entry.id})", reply_markup=keyboard)
+
+
 # @dp.callback_query_handler(lambda query: query.data == "return_to_admin", state="*")
 async def return_to_admin_panel(callback_query: types.CallbackQuery, state: FSMContext):
     logging.info(f"Received callback 'return_to_admin' by user {callback_query.from_user.id}")
@@ -542,4 +772,24 @@ def register_handlers_private(dp: Dispatcher):
     dp.register_callback_query_handler(notification_settings,
                                        lambda query: query.data.startswith("notification_settings_"))
     dp.register_callback_query_handler(switch_notification_settings, lambda query: query.data.startswith("switch_"))
+    dp.register_callback_query_handler(moderation_stages,
+                                       lambda query: query.data.startswith("mstages_") and query.from_user.id in ADMIN_ID)
+    dp.register_callback_query_handler(switch_moderation_stage,
+                                       lambda query: query.data.startswith("mstage_") and query.from_user.id in ADMIN_ID)
+    dp.register_callback_query_handler(show_llm_stats,
+                                       lambda query: query.data == "llm_stats" and query.from_user.id in ADMIN_ID)
+    dp.register_callback_query_handler(show_answer_cache,
+                                       lambda query: query.data == "answer_cache" and query.from_user.id in ADMIN_ID,
+                                       state="*")
+    dp.register_callback_query_handler(edit_answer_cache,
+                                       lambda query: query.data.startswith("faq_") and query.from_user.id in ADMIN_ID)
+    dp.register_message_handler(handle_faq_input, lambda message: message.text and message.from_user.id in ADMIN_ID,
+                                state=BotState.waiting_for_faq)
+    dp.register_callback_query_handler(show_word_lists,
+                                       lambda query: query.data == "word_lists" and query.from_user.id in ADMIN_ID,
+                                       state="*")
+    dp.register_callback_query_handler(edit_word_list,
+                                       lambda query: query.data.startswith("words_") and query.from_user.id in ADMIN_ID)
+    dp.register_message_handler(handle_words_input, lambda message: message.text and message.from_user.id in ADMIN_ID,
+                                state=BotState.waiting_for_words)
     logging.info("Private handlers registered")
@@ -23,14 +23,13 @@ def save_texts(custom_texts):
 custom_texts = load_texts()
 
 api_model_json_path = os.path.join(data_dir, 'openaimodel.json')
+models_json_path = os.path.join(data_dir, 'gptunnel_models.json')
 
 
-def load_api_model() -> dict:
-    api_engine_model: dict = {}
+def _read_api_model() -> dict:
     try:
         with open(api_model_json_path, 'r', encoding='utf-8') as json_file:
-            api_engine_model = json.load(json_file)
-            return api_engine_model
+            return json.load(json_file)
     except FileNotFoundError:
         logging.error(f'File {api_model_json_path} not found')
         raise ValueError(
@@ -38,9 +37,38 @@ def load_api_model() -> dict:
         )
 
 
+# Настройка модели читается с диска один раз; дальше все берут этот словарь из памяти,
+# а save_api_model меняет его на месте и записывает файл
+api_model = _read_api_model()
+
+
+def load_api_model() -> dict:
+    return api_model
+
+
+def get_active_model() -> str:
+    return api_model['openaimodel']
+
+
 def save_api_model(api_engine_model):
+    if api_engine_model is not api_model:
+        api_model.clear()
+        api_model.update(api_engine_model)
     with open(api_model_json_path, 'w', encoding='utf-8') as json_file:
-        json.dump(api_engine_model, json_file, ensure_ascii=False, indent=4)
+        json.dump(api_model, json_file, ensure_ascii=False, indent=4)
+
+
+def load_models_cache() -> dict:
+    # {'fetched_at': время загрузки, 'models': ответ GPTunnel /models} или {}, если кэша еще нет
+    try:
+        with open(models_json_path, 'r', encoding='utf-8') as json_file:
+            return json.load(json_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
 
 
-api_model = load_api_model()
+def save_models_cache(models_cache):
+    tmp_path = f'{models_json_path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as json_file:
+        json.dump(models_cache, json_file, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, models_json_path)
@@ -0,0 +1,114 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Hashable, Optional
+
+# Классы приоритета: чем меньше число, тем раньше запрос получает слот
+moderation_priority = 0
+qa_priority = 1
+priority_names = {
+    moderation_priority: 'moderation',
+    qa_priority: 'qa',
+}
+# Сколько последних ожиданий в очереди хранить на класс для расчета среднего и p95
+wait_samples = 1000
+stats_log_every = 100
+
+
+# Общий планировщик запросов к LLM: не больше max_concurrency запросов одновременно и не больше
+# class_limits[priority] запросов одного класса. Освободившийся слот всегда получает более приоритетный
+# класс, а внутри класса чаты обслуживаются по кругу, чтобы один шумный чат не занимал очередь целиком.
+class LLMScheduler:
+    def __init__(self, max_concurrency=8, class_limits: Optional[dict] = None):
+        self.max_concurrency = max_concurrency
+        self.class_limits = class_limits or {}
+        self._queues = {priority: OrderedDict() for priority in priority_names}  # chat_id -> deque ожидающих
+        self._running = {priority: 0 for priority in priority_names}
+        self._total_running = 0
+        self._waits = {priority: deque(maxlen=wait_samples) for priority in priority_names}
+        self._completed = {priority: 0 for priority in priority_names}
+
+    def _can_start(self, priority):
+        return (self._total_running < self.max_concurrency
+                and self._running[priority] < self.class_limits.get(priority, self.max_concurrency))
+
+    def _has_waiters(self, up_to_priority):
+        return any(self._queues[priority] for priority in self._queues if priority <= up_to_priority)
+
+    def _start(self, priority, enqueued_at):
+        self._running[priority] += 1
+        self._total_running += 1
+        self._waits[priority].append(time.monotonic() - enqueued_at)
+
+    def _wake(self):
+        for priority in sorted(self._queues):
+            queue = self._queues[priority]
+            while queue and self._can_start(priority):
+                chat_id, waiters = queue.popitem(last=False)
+                future, enqueued_at = waiters.popleft()
+                if waiters:
+                    # Чат с оставшимися запросами уходит в конец круга
+                    queue[chat_id] = waiters
+                if future.done():
+                    continue
+                self._start(priority, enqueued_at)
+                future.set_result(None)
+
+    def _release(self, priority):
+        self._running[priority] -= 1
+        self._total_running -= 1
+        self._completed[priority] += 1
+        self._wake()
+        if sum(self._completed.values()) % stats_log_every == 0:
+            self._log_stats()
+
+    async def _acquire(self, priority, chat_id):
+        enqueued_at = time.monotonic()
+        if self._can_start(priority) and not self._has_waiters(priority):
+            self._start(priority, enqueued_at)
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._queues[priority].setdefault(chat_id, deque()).append((future, enqueued_at))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Слот мог быть выдан в момент отмены: возвращаем его следующему в очереди
+            if future.done() and not future.cancelled():
+                self._release(priority)
+            raise
+
+    @asynccontextmanager
+    async def slot(self, priority: int, chat_id: Hashable):
+        await self._acquire(priority, chat_id)
+        try:
+            yield
+        finally:
+            self._release(priority)
+
+    async def run(self, priority: int, chat_id: Hashable, func: Callable[..., Awaitable], *args, **kwargs):
+        async with self.slot(priority, chat_id):
+            return await func(*args, **kwargs)
+
+    def stats(self) -> dict:
+        result = {}
+        for priority, name in priority_names.items():
+            waits = sorted(self._waits[priority])
+            result[name] = {
+                'queued': sum(len(waiters) for waiters in self._queues[priority].values()),
+                'queued_chats': len(self._queues[priority]),
+                'running': self._running[priority],
+                'completed': self._completed[priority],
+                'wait_avg': sum(waits) / len(waits) if waits else 0.0,
+                'wait_p95': waits[int(len(waits) * 0.95)] if waits else 0.0,
+                'wait_max': waits[-1] if waits else 0.0,
+            }
+        return result
+
+    def _log_stats(self):
+        for name, stats in self.stats().items():
+            logging.info(f"LLM scheduler [{name}]: {stats['queued']} queued from {stats['queued_chats']} chats, "
+                         f"{stats['running']} running, {stats['completed']} completed, "
+                         f"wait avg {stats['wait_avg']:.2f}s / p95 {stats['wait_p95']:.2f}s / "
+                         f"max {stats['wait_max']:.2f}s")
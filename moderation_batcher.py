@@ -0,0 +1,108 @@
+import asyncio
+import json
+import logging
+import re
+from typing import Awaitable, Callable, List, Optional
+
+batch_verdicts = ('spam', 'ok')
+batch_instruction = (
+    "\n\nТебе придет JSON-массив из нескольких сообщений. Оцени каждое сообщение отдельно по правилам выше "
+    "и ответь только JSON-массивом той же длины и в том же порядке, где каждый элемент - строка "
+    "\"spam\" или \"ok\". Никакого другого текста."
+)
+
+
+# Собирает запросы модерации в пачки: пока к GPTunnel уже идет запрос, новые сообщения копятся до
+# max_batch_size штук / max_batch_chars символов / max_wait секунд и уходят одним запросом с общим
+# системным промптом. Без нагрузки сообщение отправляется сразу, как и раньше, по одному.
+class ModerationBatcher:
+    def __init__(self, request: Callable[[str, str], Awaitable[str]], system_prompt: str,
+                 max_batch_size=20, max_batch_chars=12000, max_wait=0.3):
+        self.request = request
+        self.system_prompt = system_prompt
+        self.max_batch_size = max_batch_size
+        self.max_batch_chars = max_batch_chars
+        self.max_wait = max_wait
+        self._pending = []
+        self._pending_chars = 0
+        self._timer = None
+        self._running = 0
+        self._tasks = set()
+        self.batches = 0
+        self.batched_items = 0
+        self.fallbacks = 0
+
+    async def check(self, text: str) -> str:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((text, future))
+        self._pending_chars += len(text)
+        if (not self._running or len(self._pending) >= self.max_batch_size
+                or self._pending_chars >= self.max_batch_chars):
+            self._dispatch()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_wait, self._dispatch)
+        return await future
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending, self._pending_chars = self._pending, [], 0
+        if batch:
+            self._running += 1
+            task = asyncio.ensure_future(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    @staticmethod
+    def _parse(answer: str, size: int) -> List[Optional[str]]:
+        match = re.search(r'\[.*\]', answer, re.S)
+        try:
+            items = json.loads(match.group()) if match else None
+        except json.JSONDecodeError:
+            items = None
+        if not isinstance(items, list) or len(items) != size:
+            return [None] * size
+        verdicts = [str(item).strip().lower() for item in items]
+        return [verdict if verdict in batch_verdicts else None for verdict in verdicts]
+
+    async def _run(self, batch):
+        texts = [text for text, _ in batch]
+        try:
+            if len(batch) == 1:
+                verdicts = [None]
+            else:
+                answer = await self.request(self.system_prompt + batch_instruction,
+                                            json.dumps(texts, ensure_ascii=False))
+                verdicts = self._parse(answer, len(texts))
+                self.batches += 1
+                self.batched_items += len(texts)
+            # Одиночные сообщения и то, что не удалось разобрать из ответа на пачку, проверяем по одному
+            missing = [index for index, verdict in enumerate(verdicts) if verdict is None]
+            if len(batch) > 1 and missing:
+                self.fallbacks += len(missing)
+                logging.warning(f"Moderation batch of {len(batch)}: {len(missing)} verdicts not parsed, "
+                                f"checking them one by one")
+            results = await asyncio.gather(*[self.request(self.system_prompt, texts[index]) for index in missing],
+                                           return_exceptions=True)
+            for index, result in zip(missing, results):
+                verdicts[index] = result
+            if len(batch) > 1:
+                logging.info(f"Moderation batch of {len(batch)} messages done "
+                             f"(total: {self.batches} batches, {self.batched_items} messages, "
+                             f"{self.fallbacks} fallbacks)")
+            for (_, future), verdict in zip(batch, verdicts):
+                if future.done():
+                    continue
+                if isinstance(verdict, Exception):
+                    future.set_exception(verdict)
+                else:
+                    future.set_result(verdict)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self._running -= 1
+            if self._pending and self._timer is None:
+                self._dispatch()
@@ -0,0 +1,300 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, List, NamedTuple, Optional, Sequence, Tuple
+
+from aiogram import types
+
+import config
+from bot import db
+from flood_detector import flood_started
+from functions import (ban_everywhere, chat_admins, find_ban_and_check_words, flood_detector, flood_mute_days, get_link,
+                       has_link, moderate_text, mute_user, observe_spam_wave, outbox, save_message_in_db,
+                       spam_wave)
+from spam_wave import SpamWave
+
+# Относительная стоимость этапа: локальные проверки всегда идут раньше запросов к LLM
+local_cost = 1
+llm_cost = 100
+stats_log_every = 1000
+
+
+class Verdict(NamedTuple):
+    reason: str
+    mute_days: float
+    notification: Optional[str]  # текст после @username; None - без уведомления в чате
+    source_reason: str
+    add_to_spamers: bool = True
+
+
+class ModerationContext:
+    def __init__(self, message: types.Message, chat_info, messages_count: int, is_spamer: bool,
+                 wave: Optional[SpamWave] = None):
+        self.message = message
+        self.text = message.text
+        self.wave = wave
+        self.chat_info = chat_info
+        self.messages_count = messages_count
+        self.is_spamer = is_spamer
+        self._words = None
+
+    async def words(self) -> Tuple[Optional[str], Optional[str]]:
+        # (запрещенное слово, слово для проверки GPT): одна токенизация на все этапы
+        if self._words is None:
+            self._words = await find_ban_and_check_words(self.text) if self.text else (None, None)
+        return self._words
+
+
+class Stage(NamedTuple):
+    name: str
+    title: str
+    cost: int
+    check: Callable[[ModerationContext], Awaitable[Optional[Verdict]]]
+    # False - вердикт откладывается и применяется, только если остальные этапы ничего не нашли
+    short_circuit: bool = True
+
+
+async def check_spam_base(ctx: ModerationContext) -> Optional[Verdict]:
+    if not ctx.is_spamer:
+        return None
+    reason = 'spamer_from_base'
+    return Verdict(reason, 367, None, f'{reason}, username:{ctx.message.from_user.username}', add_to_spamers=False)
+
+
+async def check_spam_wave(ctx: ModerationContext) -> Optional[Verdict]:
+    if ctx.wave is None:
+        return None
+    reason = 'spam_wave'
+    # Одинаковая ссылка или файл, как и текст одного отправителя, еще не доказывают спам: по ним бан
+    # только в этом чате, без базы спамеров и распространения на другие чаты
+    global_ban = ctx.wave.fingerprint[0] == 'text' and ctx.wave.users >= spam_wave.min_users
+    return Verdict(reason, 367,
+                   "такое же сообщение разослано во многие чаты и расценено как спам\n"
+                   "_Вам была отключена возможность отправлять сообщения\n"
+                   "Если считаете блокировку несправедливой, обратитесь к администратору группы_",
+                   f'{reason}: {ctx.wave.fingerprint[0]} in {ctx.wave.chats} chats from {ctx.wave.users} users',
+                   add_to_spamers=global_ban)
+
+
+async def check_ban_words(ctx: ModerationContext) -> Optional[Verdict]:
+    ban_word, _ = await ctx.words()
+    if ban_word is None:
+        return None
+    return Verdict('ban_word', 367,
+                   "в вашем сообщении обнаружены запрещенные слова\n"
+                   "_Вам была отключена возможность отправлять сообщения\n"
+                   "Если считаете блокировку несправедливой, обратитесь к администратору группы_",
+                   ban_word)
+
+
+async def check_link(ctx: ModerationContext) -> Optional[Verdict]:
+    if not ctx.text or not await has_link(ctx.text):
+        return None
+    return Verdict('link in message', 3,
+                   "для новых пользователей *запрещена отправка ссылок*\n"
+                   "_Вам была временно отключена возможность отправлять сообщения_",
+                   await get_link(ctx.text), add_to_spamers=False)
+
+
+async def ask_gpt(ctx: ModerationContext) -> bool:
+    gpt_answer = await moderate_text(ctx.text)
+    if gpt_answer == 'ok':
+        logging.info(f"gpt_answer: {gpt_answer}, message accepted")
+    elif gpt_answer != 'spam':
+        logging.info(f"gpt_answer: {gpt_answer} - gpt answer is not template")
+    return gpt_answer == 'spam'
+
+
+async def check_new_member_gpt(ctx: ModerationContext) -> Optional[Verdict]:
+    if not ctx.text or ctx.messages_count >= config.MESSAGES_COUNT_ON_CHECK:
+        return None
+    logging.info(f"New-member check for user {ctx.message.from_user.username}, id: {ctx.message.from_user.id}")
+    if not await ask_gpt(ctx):
+        return None
+    reason = 'by_gpt_newmember_control'
+    return Verdict(reason, 367,
+                   "ваше сообщение расценено как спам\n"
+                   "_Вам была отключена возможность отправлять сообщения\n"
+                   "Если считаете блокировку несправедливой, обратитесь к администратору группы_",
+                   reason)
+
+
+async def check_check_words_gpt(ctx: ModerationContext) -> Optional[Verdict]:
+    _, check_word = await ctx.words()
+    if check_word is None:
+        return None
+    logging.info(f"Message {ctx.message.message_id} from @{ctx.message.from_user.username} "
+                 f"has check-words. Start checking")
+    if not await ask_gpt(ctx):
+        return None
+    reason = 'spam-message'
+    return Verdict(reason, 367,
+                   "ваше сообщение расценено как спам\n"
+                   "_Вам была отключена возможность отправлять сообщения_",
+                   f'{reason} by gpt check; trigger words: {check_word}')
+
+
+# Этапы в порядке по умолчанию. Ссылка проверяется дешево и рано, но ее вердикт (мут на 3 дня) отложенный:
+# если GPT признает то же сообщение спамом, применяется более строгое наказание, как и раньше.
+default_stages = (
+    Stage('spam_base', "База спамеров", local_cost, check_spam_base),
+    Stage('spam_wave', "Рассылка по чатам", local_cost, check_spam_wave),
+    Stage('ban_words', "Запрещенные слова", local_cost, check_ban_words),
+    Stage('link', "Ссылки", local_cost, check_link, short_circuit=False),
+    Stage('new_member_gpt', "Проверка новичков GPT", llm_cost, check_new_member_gpt),
+    Stage('check_words_gpt', "Слова для проверки GPT", llm_cost, check_check_words_gpt),
+)
+
+
+class ModerationPipeline:
+    def __init__(self, stages: Sequence[Stage]):
+        self.stages = {stage.name: stage for stage in stages}
+        self.default_order = tuple(stage.name for stage in stages)
+        self._timings = {name: [0, 0.0, 0.0, 0] for name in self.stages}  # запуски, сумма, максимум, вердикты
+        self._runs = 0
+
+    def stage_names(self, chat_info) -> Tuple[str, ...]:
+        # Включенные этапы чата в заданном им порядке; None в настройках - этапы по умолчанию
+        if chat_info is None or chat_info.moderation_stages is None:
+            return self.default_order
+        return tuple(name for name in chat_info.moderation_stages if name in self.stages)
+
+    def stages_for(self, chat_info) -> List[Stage]:
+        # Порядок чата соблюдается внутри одной стоимости: локальные проверки всегда раньше LLM
+        return sorted((self.stages[name] for name in self.stage_names(chat_info)), key=lambda stage: stage.cost)
+
+    async def run(self, ctx: ModerationContext) -> Optional[Tuple[str, Verdict]]:
+        held = None
+        for stage in self.stages_for(ctx.chat_info):
+            started = time.perf_counter()
+            try:
+                verdict = await stage.check(ctx)
+            except Exception as e:
+                logging.error(f"Moderation stage {stage.name} failed for message {ctx.message.message_id}: {e}")
+                verdict = None
+            self._record(stage.name, time.perf_counter() - started, verdict is not None)
+            if verdict is None:
+                continue
+            if stage.short_circuit:
+                return stage.name, verdict
+            if held is None:
+                held = (stage.name, verdict)
+        return held
+
+    def _record(self, name, elapsed, has_verdict):
+        timing = self._timings[name]
+        timing[0] += 1
+        timing[1] += elapsed
+        timing[2] = max(timing[2], elapsed)
+        timing[3] += has_verdict
+        self._runs += 1
+        if self._runs % stats_log_every == 0:
+            for stage_name, stats in self.stats().items():
+                logging.info(f"Moderation stage {stage_name}: {stats['runs']} runs, {stats['verdicts']} verdicts, "
+                             f"avg {stats['avg'] * 1000:.1f}ms, max {stats['max'] * 1000:.1f}ms")
+
+    def stats(self) -> dict:
+        return {name: {'runs': runs, 'avg': total / runs if runs else 0.0, 'max': maximum, 'verdicts': verdicts}
+                for name, (runs, total, maximum, verdicts) in self._timings.items()}
+
+
+moderation_pipeline = ModerationPipeline(default_stages)
+
+
+async def punish(ctx: ModerationContext, verdict: Verdict):
+    message = ctx.message
+    if verdict.notification is not None:
+        if ctx.chat_info is not None and ctx.chat_info.auto_punishment_notifications:
+            # Одно уведомление на пользователя, даже если он успел отправить несколько сообщений подряд
+            outbox.send_message(message.chat.id, f"@{message.from_user.username}, {verdict.notification}",
+                                dedup_key=('punishment', message.chat.id, message.from_user.id),
+                                parse_mode='Markdown')
+        else:
+            logging.info(f"User {message.from_user.username}, "
+                         f"id: {message.from_user.id},chat: {message.chat.title} "
+                         f"--- no notification punishment")
+    await mute_user(chat_id=message.chat.id, user_id=message.from_user.id, mute_duration_days=verdict.mute_days)
+    outbox.delete_message(message.chat.id, message.message_id)
+    if verdict.add_to_spamers:
+        await db.insert_spamer(user_id=message.from_user.id, chat_id=message.chat.id, message_text=message.text,
+                               reason=verdict.reason)
+        await ban_everywhere(message.from_user.id, message.chat.id, verdict.mute_days)
+    await db.insert_punishment(user_id=message.from_user.id, username=message.from_user.username,
+                               chat_id=message.chat.id, message_text=message.text, reason=verdict.reason,
+                               source_reason=verdict.source_reason)
+
+
+async def clean_up_wave(ctx: ModerationContext, verdict: Verdict):
+    # Копии, разосланные до того, как отпечаток стал волной: удаляются, авторы наказываются как за спам.
+    # В базу спамеров и в другие чаты наказание идет только для волн текста от нескольких отправителей
+    # (verdict.add_to_spamers).
+    # Админы и чаты с выключенным этапом spam_wave не трогаются
+    banned_users = {ctx.message.from_user.id}
+    for copy in ctx.wave.earlier:
+        chat_info = await db.get_chat_info(copy.chat_id)
+        if 'spam_wave' not in moderation_pipeline.stage_names(chat_info) or \
+                await chat_admins.is_admin(copy.chat_id, copy.user_id):
+            continue
+        outbox.delete_message(copy.chat_id, copy.message_id)
+        await mute_user(chat_id=copy.chat_id, user_id=copy.user_id, mute_duration_days=verdict.mute_days)
+        await db.insert_punishment(user_id=copy.user_id, username=None, chat_id=copy.chat_id,
+                                   message_text=ctx.text, reason=verdict.reason,
+                                   source_reason=f'{verdict.source_reason}, earlier copy')
+        if verdict.add_to_spamers and copy.user_id not in banned_users:
+            banned_users.add(copy.user_id)
+            await db.insert_spamer(user_id=copy.user_id, chat_id=copy.chat_id, message_text=ctx.text,
+                                   reason=verdict.reason)
+            await ban_everywhere(copy.user_id, copy.chat_id, verdict.mute_days)
+    logging.info(f"Spam wave cleanup: {len(ctx.wave.earlier)} earlier copies, "
+                 f"{len(banned_users) - 1} more users banned everywhere")
+
+
+async def punish_flood(message: types.Message, flood: str):
+    # Флуд обрабатывается без истории, базы спамеров и GPT: сообщение удаляется, при первом превышении
+    # лимита пользователь получает мут
+    outbox.delete_message(message.chat.id, message.message_id)
+    if flood != flood_started:
+        return
+    logging.info(f"User {message.from_user.username}, id: {message.from_user.id} is flooding "
+                 f"in chat {message.chat.id}")
+    await mute_user(chat_id=message.chat.id, user_id=message.from_user.id, mute_duration_days=flood_mute_days)
+    outbox.send_message(message.chat.id, f"@{message.from_user.username}, *слишком много сообщений подряд*\n"
+                                         "_Вам была временно отключена возможность отправлять сообщения_",
+                        dedup_key=('punishment', message.chat.id, message.from_user.id), parse_mode='Markdown')
+    reason = 'flood'
+    await db.insert_punishment(user_id=message.from_user.id, username=message.from_user.username,
+                               chat_id=message.chat.id, message_text=message.text, reason=reason,
+                               source_reason=reason)
+
+
+async def moderate(message: types.Message):
+    logging.info(f"Handle message from user {message.from_user.username}, id: {message.from_user.id}")
+    flood = flood_detector.on_message(message.chat.id, message.from_user.id)
+    if flood is not None and not await chat_admins.is_admin(message.chat.id, message.from_user.id):
+        await punish_flood(message, flood)
+        return
+    # Запись в историю только ставится в очередь, поэтому счетчик сообщений ниже уже учитывает это сообщение
+    await save_message_in_db(message)
+    is_admin, messages_count, chat_info, is_spamer = await asyncio.gather(
+        chat_admins.is_admin(message.chat.id, message.from_user.id),
+        db.get_message_count_by_user(user_id=message.from_user.id, chat_id=message.chat.id),
+        db.get_chat_info(chat_id=message.chat.id),
+        db.is_spamer(user_id=message.from_user.id),
+    )
+    if is_admin:
+        return
+    wave = observe_spam_wave(message)
+    logging.info(f"Start moderate message from user {message.from_user.username}, id: {message.from_user.id}")
+    ctx = ModerationContext(message, chat_info, messages_count, is_spamer, wave)
+    result = await moderation_pipeline.run(ctx)
+    if result is not None:
+        stage_name, verdict = result
+        logging.info(f"Message {message.message_id} from @{message.from_user.username}, id: {message.from_user.id} "
+                     f"punished by stage {stage_name}: {verdict.reason}")
+        await punish(ctx, verdict)
+        if stage_name == 'spam_wave' and wave.earlier:
+            await clean_up_wave(ctx, verdict)
+        return
+    if message.text:
+        logging.info(f"Message {message.message_id} from @{message.from_user.username} is ok")
+        return 'ok'
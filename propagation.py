@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+
+mute_action = 'mute'
+unmute_action = 'unmute'
+# Telegram считает ограничение меньше чем на 30 секунд бессрочным: такие задачи при возобновлении отбрасываются
+min_mute_left = 60
+progress_log_every = 50
+
+
+class PropagationJob:
+    def __init__(self, job_id, action, user_id, until_date, chat_ids: Iterable[int]):
+        self.job_id = job_id
+        self.action = action
+        self.user_id = user_id
+        self.until_date = until_date
+        self.pending = set(chat_ids)
+        self.total = len(self.pending)
+        self.done = 0
+        self.failed = 0
+        self.started_at = time.monotonic()
+        self.finished = asyncio.get_running_loop().create_future()
+        self.task = None
+        # Задачу отменила более новая задача для того же пользователя; wait() в этом случае возвращает задачу
+        self.superseded = False
+
+    async def wait(self) -> 'PropagationJob':
+        return await asyncio.shield(self.finished)
+
+
+# Применение ограничения пользователя сразу во всех чатах (мут, снятие мута, бан на всех площадках).
+# Запросы ко всем чатам уходят одновременно через handlers, скорость ограничивает очередь Telegram.
+# Ошибка в одном чате не останавливает остальные. Задача и список еще не обработанных чатов хранятся
+# в базе: после перезапуска бота незавершенные задачи продолжаются с оставшихся чатов.
+class PropagationExecutor:
+    def __init__(self, db, handlers: Dict[str, Callable[[int, int, Optional[float]], Awaitable]]):
+        self.db = db
+        self.handlers = handlers
+        self._jobs: Dict[int, PropagationJob] = {}
+        self.completed = 0
+
+    async def start(self):
+        resumed = 0
+        for job_id, action, user_id, until_date, chat_ids in await self.db.get_propagation_jobs():
+            if action == mute_action and until_date is not None and until_date - time.time() < min_mute_left:
+                await self.db.delete_propagation_job(job_id)
+                continue
+            self._run(PropagationJob(job_id, action, user_id, until_date, chat_ids))
+            resumed += 1
+        if resumed:
+            logging.info(f"Propagation jobs resumed: {resumed}")
+
+    async def submit(self, action, user_id, chat_ids: Iterable[int], until_date: Optional[float] = None) \
+            -> PropagationJob:
+        # Новая задача для пользователя отменяет его незавершенные: в чатах должно остаться последнее решение.
+        # Ожидающие отмененную задачу получают ее с superseded = True, а не CancelledError
+        superseded = [job for job in self._jobs.values() if job.user_id == user_id and not job.finished.done()]
+        for job in superseded:
+            logging.info(f"Propagation job #{job.job_id} ({job.action} {user_id}) superseded")
+            job.superseded = True
+            job.finished.set_result(job)
+            job.task.cancel()
+        for job in superseded:
+            await self.db.delete_propagation_job(job.job_id)
+        chat_ids = list(dict.fromkeys(chat_ids))
+        job_id = await self.db.insert_propagation_job(action, user_id, until_date, chat_ids)
+        job = PropagationJob(job_id, action, user_id, until_date, chat_ids)
+        self._run(job)
+        return job
+
+    def _run(self, job: PropagationJob):
+        self._jobs[job.job_id] = job
+        job.task = asyncio.create_task(self._execute(job))
+        job.task.add_done_callback(lambda _: self._jobs.pop(job.job_id, None))
+
+    async def _apply(self, job: PropagationJob, chat_id):
+        try:
+            await self.handlers[job.action](chat_id, job.user_id, job.until_date)
+            job.done += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            job.failed += 1
+            logging.warning(f"Propagation job #{job.job_id}: {job.action} {job.user_id} in chat {chat_id} failed: {e}")
+        job.pending.discard(chat_id)
+        await self.db.delete_propagation_target(job.job_id, chat_id)
+        processed = job.done + job.failed
+        if processed % progress_log_every == 0 and processed < job.total:
+            logging.info(f"Propagation job #{job.job_id}: {processed}/{job.total} chats, {job.failed} failed")
+
+    async def _execute(self, job: PropagationJob):
+        logging.info(f"Propagation job #{job.job_id}: {job.action} user {job.user_id} in {job.total} chats")
+        try:
+            await asyncio.gather(*[self._apply(job, chat_id) for chat_id in list(job.pending)])
+        except asyncio.CancelledError:
+            if not job.finished.done():
+                job.finished.cancel()
+            raise
+        await self.db.delete_propagation_job(job.job_id)
+        self.completed += 1
+        logging.info(f"Propagation job #{job.job_id} finished in {time.monotonic() - job.started_at:.1f}s: "
+                     f"{job.done} chats, {job.failed} failed")
+        job.finished.set_result(job)
+
+    async def close(self):
+        # Незавершенные задачи остаются в базе и продолжатся после перезапуска
+        tasks = [job.task for job in self._jobs.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def jobs(self) -> List[PropagationJob]:
+        return sorted(self._jobs.values(), key=lambda job: job.job_id)
@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import os
+import sys
+import zlib
+from typing import List, Optional
+
+import numpy as np
+
+from database import Database
+from verdict_cache import normalize_text
+
+feature_bits = 18
+smoothing = 1.0
+# Доля сообщений, отложенных для проверки модели (выбирается по crc32 текста, поэтому стабильна между запусками)
+holdout_share = 0.2
+training_ham_limit = 500000
+model_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'spam_model.npz')
+
+
+def extract_features(text: str) -> np.ndarray:
+    # Хэшированные признаки: слова, пары соседних слов и символьные триграммы слов (ловят замену букв)
+    words = normalize_text(text).split()
+    features = set(words)
+    features.update(f'{first} {second}' for first, second in zip(words, words[1:]))
+    for word in words:
+        padded = f' {word} '
+        features.update(f'#{padded[i:i + 3]}' for i in range(len(padded) - 2))
+    mask = (1 << feature_bits) - 1
+    return np.fromiter((zlib.crc32(feature.encode('utf-8')) & mask for feature in features),
+                       dtype=np.int64, count=len(features))
+
+
+# Мультиномиальный наивный Байес по бинарным хэшированным признакам. Модель хранится как вектор
+# весов log P(f|spam) - log P(f|ham) и смещение, так что предсказание - одна сумма по индексам признаков.
+class SpamClassifier:
+    def __init__(self, spam_threshold=0.97, ham_threshold=0.03):
+        self.spam_threshold = spam_threshold
+        self.ham_threshold = ham_threshold
+        self.weights: Optional[np.ndarray] = None
+        self.bias = 0.0
+        self.report = ''
+
+    @property
+    def is_trained(self):
+        return self.weights is not None
+
+    def train(self, spam_texts: List[str], ham_texts: List[str]):
+        size = 1 << feature_bits
+        counts = []
+        for texts in (spam_texts, ham_texts):
+            features = [extract_features(text) for text in texts]
+            class_counts = np.bincount(np.concatenate(features), minlength=size) if features else np.zeros(size)
+            counts.append(class_counts.astype(np.float64) + smoothing)
+        log_spam = np.log(counts[0] / counts[0].sum())
+        log_ham = np.log(counts[1] / counts[1].sum())
+        self.weights = (log_spam - log_ham).astype(np.float32)
+        self.bias = float(np.log(max(len(spam_texts), 1) / max(len(ham_texts), 1)))
+
+    def predict_proba(self, text: str) -> float:
+        score = self.bias + float(self.weights[extract_features(text)].sum())
+        return float(1.0 / (1.0 + np.exp(-np.clip(score, -50, 50))))
+
+    def verdict(self, text: str) -> Optional[str]:
+        # 'spam' / 'ok', если модель уверена, иначе None - решение остается за GPT
+        if not self.is_trained or not text:
+            return None
+        probability = self.predict_proba(text)
+        if probability >= self.spam_threshold:
+            return 'spam'
+        if probability <= self.ham_threshold:
+            return 'ok'
+        return None
+
+    def evaluate(self, spam_texts: List[str], ham_texts: List[str]) -> str:
+        probabilities = np.array([self.predict_proba(text) for text in spam_texts + ham_texts])
+        labels = np.array([True] * len(spam_texts) + [False] * len(ham_texts))
+        lines = [f"Held-out: {len(spam_texts)} spam, {len(ham_texts)} ham"]
+        for name, predicted in (('p >= 0.5', probabilities >= 0.5),
+                                (f'spam p >= {self.spam_threshold}', probabilities >= self.spam_threshold)):
+            true_positive = int((predicted & labels).sum())
+            precision = true_positive / max(int(predicted.sum()), 1)
+            recall = true_positive / max(int(labels.sum()), 1)
+            lines.append(f"{name}: precision {precision:.3f}, recall {recall:.3f}")
+        confident_ham = probabilities <= self.ham_threshold
+        ham_precision = int((confident_ham & ~labels).sum()) / max(int(confident_ham.sum()), 1)
+        ham_recall = int((confident_ham & ~labels).sum()) / max(int((~labels).sum()), 1)
+        lines.append(f"ham p <= {self.ham_threshold}: precision {ham_precision:.3f}, recall {ham_recall:.3f}")
+        uncertain = ~(probabilities >= self.spam_threshold) & ~confident_ham
+        lines.append(f"Sent to GPT (uncertain band): {uncertain.mean() if len(labels) else 0:.1%}")
+        return '\n'.join(lines)
+
+    def save(self, path=model_path):
+        np.savez_compressed(path, weights=self.weights, bias=np.array([self.bias]), report=np.array([self.report]))
+
+    def load(self, path=model_path):
+        if not os.path.isfile(path):
+            logging.info(f"Spam classifier model {path} not found, all checks go to GPT")
+            return
+        with np.load(path) as model:
+            self.weights = model['weights']
+            self.bias = float(model['bias'][0])
+            self.report = str(model['report'][0])
+        logging.info(f"Spam classifier loaded:\n{self.report}")
+
+
+def _is_holdout(text: str) -> bool:
+    return zlib.crc32(text.encode('utf-8')) % 100 < holdout_share * 100
+
+
+async def train_from_database(db, classifier: SpamClassifier, path=model_path) -> str:
+    spam_texts, ham_texts = await db.get_training_messages(ham_limit=training_ham_limit)
+    train_spam = [text for text in spam_texts if not _is_holdout(text)]
+    train_ham = [text for text in ham_texts if not _is_holdout(text)]
+    classifier.train(train_spam, train_ham)
+    classifier.report = classifier.evaluate([text for text in spam_texts if _is_holdout(text)],
+                                            [text for text in ham_texts if _is_holdout(text)])
+    classifier.save(path)
+    logging.info(f"Spam classifier trained on {len(train_spam)} spam / {len(train_ham)} ham messages:\n"
+                 f"{classifier.report}")
+    return classifier.report
+
+
+async def _train():
+    db = Database()
+    await db.initialize()
+    try:
+        print(await train_from_database(db, SpamClassifier()))
+    finally:
+        await db.close()
+
+
+if __name__ == '__main__':
+    # python spam_classifier.py train — обучить модель по базе и вывести precision/recall на отложенной истории
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) != 2 or sys.argv[1] != 'train':
+        print("Использование: python spam_classifier.py train")
+        exit(1)
+    asyncio.run(_train())
@@ -0,0 +1,164 @@
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from verdict_cache import normalize_text
+
+# Текст короче этого числа слов не сравнивается: короткие фразы ("всем привет") повторяются и без спама
+min_text_words = 6
+shingle_words = 4
+# Отпечаток текста - несколько наименьших хэшей шинглов: почти одинаковые тексты чаще всего дают те же минимумы
+sketch_size = 2
+stats_log_every = 10000
+# Параметры ссылок, которые добавляют счетчики переходов и не меняют адрес страницы
+tracking_params = ('utm_', 'fbclid', 'gclid', 'yclid', 'si', 'feature')
+
+
+def text_fingerprint(text: Optional[str]) -> Optional[tuple]:
+    if not text:
+        return None
+    words = normalize_text(text).split()
+    if len(words) < min_text_words:
+        return None
+    hashes = {hash(tuple(words[i:i + shingle_words])) for i in range(len(words) - shingle_words + 1)}
+    return 'text', tuple(sorted(hashes)[:sketch_size])
+
+
+def link_fingerprint(url: str) -> Optional[tuple]:
+    # Полный адрес без схемы, www, якоря и меток отслеживания: разные видео youtube.com/watch?v=...
+    # или поиски google.com/search?q=... дают разные отпечатки
+    try:
+        parts = urlsplit(url if '//' in url else f'//{url}')
+        host = (parts.hostname or '').removeprefix('www.')
+    except ValueError:
+        return None
+    if not host:
+        return None
+    query = sorted((key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+                   if not key.lower().startswith(tracking_params))
+    fingerprint = f'{host}{parts.path.rstrip("/")}'
+    if query:
+        fingerprint = f'{fingerprint}?{urlencode(query)}'
+    return 'link', fingerprint
+
+
+def media_fingerprint(file_unique_id: Optional[str]) -> Optional[tuple]:
+    return ('media', file_unique_id) if file_unique_id else None
+
+
+class Copy(NamedTuple):
+    seen_at: float
+    chat_id: int
+    message_id: int
+    user_id: int
+
+
+class SpamWave(NamedTuple):
+    fingerprint: tuple
+    chats: int
+    users: int
+    # Ранние копии, отправленные до того, как отпечаток стал волной; непусто только для сообщения, включившего волну
+    earlier: List[Copy]
+
+
+class _FingerprintState:
+    __slots__ = ('buckets', 'copies', 'wave_until')
+
+    def __init__(self, max_copies):
+        self.buckets = deque()  # (номер интервала, {chat_id}, {user_id})
+        self.copies = deque(maxlen=max_copies)
+        self.wave_until = 0.0
+
+
+# Волны спама между чатами: одинаковый текст (с точностью до мелких правок), ссылка или файл в нескольких
+# управляемых чатах за короткое время. Для каждого отпечатка хранятся чаты и отправители копий в интервалах
+# по bucket_size секунд за последние window секунд и последние копии сообщений. Когда отпечаток встречается
+# в min_chats разных чатах, он становится волной на window секунд: ранние копии возвращаются для удаления,
+# а следующие копии наказываются сразу, без запроса к LLM. Для этого нужно еще min_users разных отправителей
+# либо solo_chats чатов от одного: один пользователь, написавший то же самое в пару чатов, - еще не рассылка.
+# Число отпечатков ограничено (LRU).
+class SpamWaveDetector:
+    def __init__(self, min_chats=3, window=600, bucket_size=60, max_fingerprints=100000, max_copies=50,
+                 min_users=2, solo_chats=10):
+        self.min_chats = min_chats
+        self.min_users = min_users
+        self.solo_chats = max(solo_chats, min_chats)
+        self.window = window
+        self.bucket_size = bucket_size
+        self.max_fingerprints = max_fingerprints
+        self.max_copies = max_copies
+        self._fingerprints = OrderedDict()  # отпечаток -> _FingerprintState
+        self.observed = 0
+        self.waves = 0
+        self.wave_messages = 0
+
+    def _state(self, fingerprint) -> _FingerprintState:
+        state = self._fingerprints.get(fingerprint)
+        if state is None:
+            state = self._fingerprints[fingerprint] = _FingerprintState(self.max_copies)
+            if len(self._fingerprints) > self.max_fingerprints:
+                self._fingerprints.popitem(last=False)
+        else:
+            self._fingerprints.move_to_end(fingerprint)
+        return state
+
+    def _count(self, state: _FingerprintState, chat_id, user_id, now) -> Tuple[int, int]:
+        # Добавляет копию в текущий интервал и возвращает число разных чатов и отправителей за окно
+        bucket = int(now // self.bucket_size)
+        oldest = int((now - self.window) // self.bucket_size)
+        while state.buckets and state.buckets[0][0] <= oldest:
+            state.buckets.popleft()
+        if not state.buckets or state.buckets[-1][0] != bucket:
+            state.buckets.append((bucket, set(), set()))
+        state.buckets[-1][1].add(chat_id)
+        state.buckets[-1][2].add(user_id)
+        return len(set().union(*(chats for _, chats, _ in state.buckets))), \
+            len(set().union(*(users for _, _, users in state.buckets)))
+
+    def _is_wave(self, chats, users) -> bool:
+        return chats >= self.min_chats and (users >= self.min_users or chats >= self.solo_chats)
+
+    def observe(self, fingerprints: Iterable[Optional[tuple]], chat_id, message_id, user_id,
+                now: Optional[float] = None) -> Optional[SpamWave]:
+        now = time.time() if now is None else now
+        copy = Copy(now, chat_id, message_id, user_id)
+        wave = None
+        for fingerprint in dict.fromkeys(fingerprint for fingerprint in fingerprints if fingerprint is not None):
+            state = self._state(fingerprint)
+            chats, users = self._count(state, chat_id, user_id, now)
+            if state.wave_until > now:
+                state.wave_until = now + self.window
+                wave = wave or SpamWave(fingerprint, chats, users, [])
+                continue
+            if not self._is_wave(chats, users):
+                state.copies.append(copy)
+                continue
+            state.wave_until = now + self.window
+            earlier = [item for item in state.copies if item.seen_at >= now - self.window]
+            state.copies.clear()
+            self.waves += 1
+            logging.warning(f"Spam wave detected: {fingerprint[0]} fingerprint in {chats} chats from {users} users, "
+                            f"{len(earlier)} earlier copies")
+            if wave is None or not wave.earlier:
+                wave = SpamWave(fingerprint, chats, users, earlier)
+            else:
+                wave.earlier.extend(item for item in earlier if item not in wave.earlier)
+        self.observed += 1
+        if wave is not None:
+            self.wave_messages += 1
+        if self.observed % stats_log_every == 0:
+            stats = self.stats()
+            logging.info(f"Spam waves: {stats['fingerprints']} fingerprints, {stats['waves']} waves, "
+                         f"{stats['wave_messages']} wave messages, {stats['active_waves']} active")
+        return wave
+
+    def stats(self, now: Optional[float] = None) -> dict:
+        now = time.time() if now is None else now
+        return {
+            'fingerprints': len(self._fingerprints),
+            'waves': self.waves,
+            'wave_messages': self.wave_messages,
+            'active_waves': sum(1 for state in self._fingerprints.values() if state.wave_until > now),
+        }
@@ -0,0 +1,73 @@
+import bisect
+import logging
+from array import array
+
+# Битов фильтра Блума на один id и число хэш-функций: ~1% ложных срабатываний
+bloom_bits_per_id = 12
+bloom_hashes = 3
+bloom_min_bits = 1 << 16
+
+_mask64 = (1 << 64) - 1
+
+
+# Множество id спамеров в памяти: отсортированный массив int64 и фильтр Блума перед ним.
+# Фильтр отсекает большинство обычных пользователей без бинарного поиска; удаленные id остаются
+# в фильтре до следующей перестройки, что дает лишь редкие лишние поиски.
+class SpammerRegistry:
+    def __init__(self):
+        self._ids = array('q')
+        self._bloom = bytearray(bloom_min_bits // 8)
+        self._bloom_bits = bloom_min_bits
+
+    def _bloom_positions(self, user_id):
+        h1 = (user_id * 0x9E3779B97F4A7C15) & _mask64
+        h2 = (h1 >> 32) | 1
+        return [(h1 + i * h2) % self._bloom_bits for i in range(bloom_hashes)]
+
+    def _bloom_add(self, user_id):
+        for position in self._bloom_positions(user_id):
+            self._bloom[position >> 3] |= 1 << (position & 7)
+
+    def _rebuild_bloom(self):
+        self._bloom_bits = max(bloom_min_bits, len(self._ids) * bloom_bits_per_id)
+        self._bloom = bytearray(self._bloom_bits // 8 + 1)
+        for user_id in self._ids:
+            self._bloom_add(user_id)
+
+    def load(self, user_ids):
+        self._ids = array('q', sorted(set(user_ids)))
+        self._rebuild_bloom()
+        logging.info(f"Spammer registry loaded: {len(self._ids)} ids, {self.memory_usage()} bytes")
+
+    def add(self, user_id):
+        index = bisect.bisect_left(self._ids, user_id)
+        if index < len(self._ids) and self._ids[index] == user_id:
+            return
+        self._ids.insert(index, user_id)
+        if len(self._ids) * bloom_bits_per_id > self._bloom_bits * 2:
+            self._rebuild_bloom()
+        else:
+            self._bloom_add(user_id)
+
+    def remove(self, user_id):
+        index = bisect.bisect_left(self._ids, user_id)
+        if index < len(self._ids) and self._ids[index] == user_id:
+            del self._ids[index]
+
+    def __contains__(self, user_id):
+        # Проверка фильтра развернута вручную: это горячий путь каждого сообщения
+        h1 = (user_id * 0x9E3779B97F4A7C15) & _mask64
+        h2 = (h1 >> 32) | 1
+        bloom, bloom_bits = self._bloom, self._bloom_bits
+        for i in range(bloom_hashes):
+            position = (h1 + i * h2) % bloom_bits
+            if not bloom[position >> 3] & (1 << (position & 7)):
+                return False
+        index = bisect.bisect_left(self._ids, user_id)
+        return index < len(self._ids) and self._ids[index] == user_id
+
+    def __len__(self):
+        return len(self._ids)
+
+    def memory_usage(self):
+        return self._ids.buffer_info()[1] * self._ids.itemsize + len(self._bloom)
@@ -0,0 +1,253 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Hashable, Optional
+
+from aiogram import Bot
+from aiogram.utils.exceptions import RetryAfter
+
+# deleteMessages принимает до 100 сообщений одного чата
+max_bulk_delete = 100
+# Одинаковое уведомление (тот же dedup_key) не отправляется повторно в течение этого времени
+notification_dedup_window = 60
+latency_samples = 1000
+# Сколько секунд при выключении дожидаться отправки оставшейся очереди
+close_timeout = 10
+stats_log_every = 500
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now) -> float:
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class _Action:
+    def __init__(self, kind, chat_id, payload):
+        self.kind = kind
+        self.chat_id = chat_id
+        self.payload = payload
+        self.futures = [asyncio.get_running_loop().create_future()]
+        self.enqueued_at = time.monotonic()
+
+
+# Очередь исходящих действий бота в Telegram (ограничения, удаления, сообщения) с общим лимитом запросов
+# в секунду и отдельным лимитом на каждый чат. Чаты обслуживаются по кругу; после 429 чат ждет retry_after.
+# Удаления в одном чате склеиваются в один deleteMessages, повторное ограничение того же пользователя
+# заменяет ожидающее, а одинаковые уведомления (по dedup_key) отправляются один раз.
+class TelegramOutbox:
+    def __init__(self, bot: Bot, global_rate=25, chat_rate=1.0, chat_burst=5):
+        self.bot = bot
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._chat_buckets = {}
+        self._queues = OrderedDict()  # chat_id -> deque действий
+        self._paused_until = {}  # chat_id -> monotonic, до которого чат ждет после 429
+        self._pending_deletes = {}  # chat_id -> _Action, которое еще можно дополнить
+        self._pending_restricts = {}  # (chat_id, user_id) -> _Action
+        self._pending_notifications = {}  # dedup_key -> _Action
+        self._sent_notifications = OrderedDict()  # dedup_key -> время отправки
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._closing = False
+        self._close_deadline = None
+        self._running = set()
+        self._latencies = deque(maxlen=latency_samples)
+        self.sent = 0
+        self.coalesced_deletes = 0
+        self.replaced_restricts = 0
+        self.dropped_notifications = 0
+        self.throttled = 0
+        self.failed = 0
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def close(self):
+        # Перед выключением отправляем все, что уже в очереди
+        self._closing = True
+        self._close_deadline = time.monotonic() + close_timeout
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+        if self._running:
+            await asyncio.gather(*self._running, return_exceptions=True)
+
+    def _enqueue(self, action: _Action) -> asyncio.Future:
+        self._queues.setdefault(action.chat_id, deque()).append(action)
+        self._wakeup.set()
+        return action.futures[0]
+
+    def delete_message(self, chat_id, message_id) -> asyncio.Future:
+        action = self._pending_deletes.get(chat_id)
+        if action is not None and len(action.payload) < max_bulk_delete:
+            self.coalesced_deletes += 1
+            action.payload.append(message_id)
+            action.futures.append(asyncio.get_running_loop().create_future())
+            return action.futures[-1]
+        action = _Action('delete', chat_id, [message_id])
+        self._pending_deletes[chat_id] = action
+        return self._enqueue(action)
+
+    def restrict_chat_member(self, chat_id, user_id, permissions, until_date=None) -> asyncio.Future:
+        action = self._pending_restricts.get((chat_id, user_id))
+        if action is not None:
+            # Ограничение еще не отправлено - достаточно отправить последнее
+            self.replaced_restricts += 1
+            action.payload = (user_id, permissions, until_date)
+            action.futures.append(asyncio.get_running_loop().create_future())
+            return action.futures[-1]
+        action = _Action('restrict', chat_id, (user_id, permissions, until_date))
+        self._pending_restricts[(chat_id, user_id)] = action
+        return self._enqueue(action)
+
+    def send_message(self, chat_id, text, dedup_key: Optional[Hashable] = None, **kwargs) -> asyncio.Future:
+        if dedup_key is not None:
+            sent_at = self._sent_notifications.get(dedup_key)
+            pending = self._pending_notifications.get(dedup_key)
+            if pending is not None or (sent_at is not None and time.monotonic() - sent_at < notification_dedup_window):
+                self.dropped_notifications += 1
+                future = asyncio.get_running_loop().create_future()
+                future.set_result(None)
+                return future
+        action = _Action('send', chat_id, (text, dedup_key, kwargs))
+        if dedup_key is not None:
+            self._pending_notifications[dedup_key] = action
+        return self._enqueue(action)
+
+    def _next_action(self):
+        # Следующее действие, которое можно отправить сейчас, или время до ближайшей возможности
+        now = time.monotonic()
+        global_wait = self.global_bucket.wait_time(now)
+        if global_wait > 0:
+            return None, global_wait
+        wait = None
+        for chat_id in list(self._queues):
+            paused = self._paused_until.get(chat_id, 0) - now
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            chat_wait = max(paused, bucket.wait_time(now))
+            if chat_wait > 0:
+                wait = chat_wait if wait is None else min(wait, chat_wait)
+                continue
+            queue = self._queues.pop(chat_id)
+            action = queue.popleft()
+            if queue:
+                self._queues[chat_id] = queue
+            self.global_bucket.take()
+            bucket.take()
+            self._detach(action)
+            return action, 0.0
+        return None, wait
+
+    def _detach(self, action):
+        # После отправки к действию уже нельзя присоединить новые удаления/ограничения
+        if action.kind == 'delete' and self._pending_deletes.get(action.chat_id) is action:
+            del self._pending_deletes[action.chat_id]
+        elif action.kind == 'restrict' and self._pending_restricts.get((action.chat_id, action.payload[0])) is action:
+            del self._pending_restricts[(action.chat_id, action.payload[0])]
+        elif action.kind == 'send' and action.payload[1] is not None:
+            self._pending_notifications.pop(action.payload[1], None)
+
+    async def _loop(self):
+        while True:
+            if self._closing and (not self._queues or time.monotonic() > self._close_deadline):
+                if self._queues:
+                    logging.warning(f"Telegram outbox closed with {self.stats()['queued']} actions not sent")
+                return
+            self._wakeup.clear()
+            action, wait = self._next_action()
+            if action is None:
+                if self._closing:
+                    wait = min(wait or 0.1, max(self._close_deadline - time.monotonic(), 0))
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            task = asyncio.create_task(self._execute(action))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _call(self, action):
+        if action.kind == 'delete':
+            if len(action.payload) == 1:
+                return await self.bot.delete_message(action.chat_id, action.payload[0])
+            return await self.bot.request('deleteMessages', {'chat_id': action.chat_id,
+                                                             'message_ids': json.dumps(action.payload)})
+        if action.kind == 'restrict':
+            user_id, permissions, until_date = action.payload
+            return await self.bot.restrict_chat_member(action.chat_id, user_id, permissions, until_date=until_date)
+        text, dedup_key, kwargs = action.payload
+        result = await self.bot.send_message(action.chat_id, text, **kwargs)
+        if dedup_key is not None:
+            self._sent_notifications[dedup_key] = time.monotonic()
+            while self._sent_notifications and \
+                    time.monotonic() - next(iter(self._sent_notifications.values())) > notification_dedup_window:
+                self._sent_notifications.popitem(last=False)
+        return result
+
+    async def _execute(self, action):
+        try:
+            result = await self._call(action)
+        except RetryAfter as e:
+            # Чат ждет retry_after, действие возвращается в начало его очереди
+            self.throttled += 1
+            logging.warning(f"Telegram flood control in chat {action.chat_id}: retry in {e.timeout}s")
+            self._paused_until[action.chat_id] = time.monotonic() + e.timeout
+            self._queues.setdefault(action.chat_id, deque()).appendleft(action)
+            self._queues.move_to_end(action.chat_id, last=False)
+            self._wakeup.set()
+            return
+        except Exception as e:
+            self.failed += 1
+            logging.warning(f"Telegram {action.kind} in chat {action.chat_id} failed: {e}")
+            for future in action.futures:
+                if not future.done():
+                    future.set_exception(e)
+                    # Ошибка нужна только тем, кто ждет результат; остальным достаточно лога
+                    future.exception()
+            return
+        self.sent += 1
+        self._latencies.append(time.monotonic() - action.enqueued_at)
+        for future in action.futures:
+            if not future.done():
+                future.set_result(result)
+        if self.sent % stats_log_every == 0:
+            stats = self.stats()
+            logging.info(f"Telegram outbox: {stats['queued']} queued, {stats['sent']} sent, latency avg "
+                         f"{stats['latency_avg']:.2f}s / p95 {stats['latency_p95']:.2f}s, "
+                         f"{stats['throttled']} throttled, {stats['coalesced_deletes']} deletes coalesced, "
+                         f"{stats['dropped_notifications']} notifications dropped")
+
+    def stats(self) -> dict:
+        latencies = sorted(self._latencies)
+        return {
+            'queued': sum(len(queue) for queue in self._queues.values()),
+            'sent': self.sent,
+            'failed': self.failed,
+            'throttled': self.throttled,
+            'coalesced_deletes': self.coalesced_deletes,
+            'replaced_restricts': self.replaced_restricts,
+            'dropped_notifications': self.dropped_notifications,
+            'latency_avg': sum(latencies) / len(latencies) if latencies else 0.0,
+            'latency_p95': latencies[int(len(latencies) * 0.95)] if latencies else 0.0,
+            'latency_max': latencies[-1] if latencies else 0.0,
+        }
@@ -0,0 +1,52 @@
+import logging
+from typing import Iterable, Optional, Tuple
+
+
+def normalize_username(username: Optional[str]) -> Optional[str]:
+    # Username в Telegram не зависит от регистра; @ в начале допускается
+    if not username:
+        return None
+    return username.lstrip('@').lower() or None
+
+
+# Справочник username -> user_id в памяти. У пользователя один актуальный username: при смене старый
+# освобождается, а если username перешел к другому пользователю, справочник указывает на нового владельца.
+class UsernameDirectory:
+    def __init__(self):
+        self._ids = {}  # username -> user_id
+        self._names = {}  # user_id -> username
+
+    def load(self, rows: Iterable[Tuple[int, Optional[str]]]):
+        # Строки (user_id, username) по возрастанию времени обновления: более поздние перекрывают ранние
+        self._ids = {}
+        self._names = {}
+        for user_id, username in rows:
+            self.update(user_id, username)
+        logging.info(f"Username directory loaded: {len(self._ids)} usernames")
+
+    def update(self, user_id: int, username: Optional[str]) -> bool:
+        # True, если справочник изменился и запись нужно сохранить
+        username = normalize_username(username)
+        old_username = self._names.get(user_id)
+        if old_username == username and (username is None or self._ids.get(username) == user_id):
+            return False
+        if old_username is not None and self._ids.get(old_username) == user_id:
+            del self._ids[old_username]
+        if username is None:
+            self._names.pop(user_id, None)
+            return old_username is not None
+        previous_owner = self._ids.get(username)
+        if previous_owner is not None and previous_owner != user_id:
+            self._names.pop(previous_owner, None)
+        self._ids[username] = user_id
+        self._names[user_id] = username
+        return True
+
+    def name_of(self, user_id: int) -> Optional[str]:
+        return self._names.get(user_id)
+
+    def get(self, username: Optional[str]) -> Optional[int]:
+        return self._ids.get(normalize_username(username))
+
+    def __len__(self):
+        return len(self._ids)
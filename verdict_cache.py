@@ -0,0 +1,169 @@
+import asyncio
+import hashlib
+import logging
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+import numpy as np
+
+cacheable_verdicts = ('spam', 'ok')
+# SimHash делится на 6 полос (11 и 10 бит): при расстоянии Хэмминга <= 5 хотя бы одна полоса совпадает целиком
+simhash_band_widths = (11, 11, 11, 11, 10, 10)
+max_hamming_distance = len(simhash_band_widths) - 1
+# Короткие тексты сравниваются только точно: на них SimHash дает слишком много ложных совпадений
+min_simhash_length = 20
+shingle_size = 3
+stats_log_every = 100
+
+_band_offsets = [sum(simhash_band_widths[:band]) for band in range(len(simhash_band_widths))]
+
+
+def normalize_text(text: str) -> str:
+    text = unicodedata.normalize('NFKC', text).lower().replace('ё', 'е')
+    text = re.sub(r'[^\w\s]|_', ' ', text)
+    # Волны спама часто отличаются только суммами, телефонами и номерами
+    text = re.sub(r'\d+', '0', text)
+    return ' '.join(text.split())
+
+
+def text_hash(normalized: str) -> str:
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+
+def simhash(normalized: str) -> Optional[int]:
+    if len(normalized) < min_simhash_length:
+        return None
+    shingles = {normalized[i:i + shingle_size] for i in range(len(normalized) - shingle_size + 1)}
+    hashes = np.array([int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'little')
+                       for shingle in shingles], dtype=np.uint64)
+    bits = np.unpackbits(hashes.view(np.uint8).reshape(-1, 8), axis=1, bitorder='little')
+    fingerprint = np.packbits(bits.sum(axis=0) * 2 > len(shingles), bitorder='little')
+    return int.from_bytes(fingerprint.tobytes(), 'little')
+
+
+# Кэш вердиктов модерации: точное совпадение по нормализованному тексту, затем поиск почти-дубликата
+# по SimHash. Вердикты живут ttl секунд и сохраняются в SQLite через db, чтобы пережить перезапуск.
+class VerdictCache:
+    def __init__(self, db, ttl=86400, max_size=100000):
+        self.db = db
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # text_hash -> (simhash, verdict, created_at)
+        self._bands = [{} for _ in simhash_band_widths]  # значение полосы -> множество text_hash
+        self._in_flight = {}
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def _band_values(self, fingerprint):
+        return [(fingerprint >> offset) & ((1 << width) - 1)
+                for offset, width in zip(_band_offsets, simhash_band_widths)]
+
+    def _add(self, key, fingerprint, verdict, created_at):
+        self._remove(key)
+        self._entries[key] = (fingerprint, verdict, created_at)
+        if fingerprint is not None:
+            for band, value in zip(self._bands, self._band_values(fingerprint)):
+                band.setdefault(value, set()).add(key)
+        while len(self._entries) > self.max_size:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None or entry[0] is None:
+            return
+        for band, value in zip(self._bands, self._band_values(entry[0])):
+            keys = band.get(value)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del band[value]
+
+    def _lookup(self, key, fingerprint) -> Optional[str]:
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            if now - entry[2] < self.ttl:
+                self.exact_hits += 1
+                return entry[1]
+            self._remove(key)
+        if fingerprint is not None:
+            best = None
+            for band, value in zip(self._bands, self._band_values(fingerprint)):
+                for candidate_key in list(band.get(value, ())):
+                    candidate = self._entries[candidate_key]
+                    if now - candidate[2] >= self.ttl:
+                        self._remove(candidate_key)
+                        continue
+                    distance = bin(candidate[0] ^ fingerprint).count('1')
+                    if distance <= max_hamming_distance and (best is None or distance < best[0]):
+                        best = (distance, candidate[1])
+            if best is not None:
+                self.near_hits += 1
+                return best[1]
+        self.misses += 1
+        return None
+
+    def stats(self) -> dict:
+        lookups = self.exact_hits + self.near_hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'exact_hits': self.exact_hits,
+            'near_hits': self.near_hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'hit_rate': (self.exact_hits + self.near_hits) / lookups if lookups else 0.0,
+        }
+
+    def _log_stats(self):
+        stats = self.stats()
+        if (stats['exact_hits'] + stats['near_hits'] + stats['misses']) % stats_log_every == 0:
+            logging.info(f"Verdict cache: {stats['entries']} entries, {stats['exact_hits']} exact hits, "
+                         f"{stats['near_hits']} near-duplicate hits, {stats['misses']} misses "
+                         f"({stats['coalesced']} coalesced with a running check), "
+                         f"hit rate {stats['hit_rate']:.1%}")
+
+    async def load(self):
+        rows = await self.db.get_moderation_verdicts(since=time.time() - self.ttl)
+        for key, fingerprint, verdict, created_at in rows:
+            self._add(key, fingerprint & ((1 << 64) - 1) if fingerprint is not None else None, verdict, created_at)
+        logging.info(f"Verdict cache loaded: {len(self._entries)} verdicts")
+
+    async def get_or_check(self, text: str, check: Callable[[str], Awaitable[str]]) -> str:
+        normalized = normalize_text(text)
+        key = text_hash(normalized)
+        fingerprint = simhash(normalized)
+        verdict = self._lookup(key, fingerprint)
+        self._log_stats()
+        if verdict is not None:
+            return verdict
+        # Одинаковые сообщения волны спама приходят одновременно: ждем уже начатую проверку вместо новой
+        if key in self._in_flight:
+            self.coalesced += 1
+            return await asyncio.shield(self._in_flight[key])
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            verdict = await check(text)
+            future.set_result(verdict)
+        except Exception as e:
+            future.set_exception(e)
+            # Исключение получат ожидающие дубликаты; сам future больше никто не прочитает
+            future.exception()
+            raise
+        finally:
+            del self._in_flight[key]
+            if not future.done():
+                # Проверку отменили (CancelledError не Exception): ожидающие дубликаты не должны зависнуть
+                future.set_exception(RuntimeError('Moderation check of a duplicate message was cancelled'))
+                future.exception()
+        if verdict in cacheable_verdicts:
+            created_at = time.time()
+            self._add(key, fingerprint, verdict, created_at)
+            signed = fingerprint - (1 << 64) if fingerprint is not None and fingerprint >= 1 << 63 else fingerprint
+            await self.db.insert_moderation_verdict(key, signed, verdict, created_at)
+        return verdict
@@ -0,0 +1,150 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from typing import Dict, Iterable, List, Optional
+
+from word_matcher import WordMatcher
+
+ban_list = 'ban'
+check_list = 'check'
+word_list_files = {
+    ban_list: 'ban_words.txt',
+    check_list: 'gpt_check_words.txt',
+}
+# Как часто (в секундах) сверять mtime файлов со списками, чтобы подхватить ручные правки без перезапуска
+reload_check_interval = 5
+
+
+# Списки слов в памяти и собранный по ним WordMatcher. Матчер пересобирается только при изменении файла
+# (mtime/размер, затем sha1 содержимого) или через add_words/remove_words. Чтение файлов и сборка индекса
+# идут в пуле потоков, а не в event loop: пока новый матчер собирается, сообщения проверяются старым,
+# затем он подменяется одной ссылкой.
+class WordListStore:
+    def __init__(self, data_dir, ban_accuracy, check_accuracy):
+        self.data_dir = data_dir
+        self.ban_accuracy = ban_accuracy
+        self.check_accuracy = check_accuracy
+        self._words: Dict[str, List[str]] = {name: [] for name in word_list_files}
+        self._stats = {name: None for name in word_list_files}
+        self._digests = {name: None for name in word_list_files}
+        self._matcher: Optional[WordMatcher] = None
+        self._last_check = 0.0
+        # Обновления применяются по одному: фоновая проверка файлов не перезапишет более новую правку из админки
+        self._lock = asyncio.Lock()
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    def _path(self, name):
+        return os.path.join(self.data_dir, word_list_files[name])
+
+    @staticmethod
+    def _file_stat(path):
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def _read_changes(self, stats, digests) -> dict:
+        # Выполняется в пуле потоков: {name: (stat, digest, words или None, если содержимое не изменилось)}
+        changes = {}
+        for name in word_list_files:
+            path = self._path(name)
+            file_stat = self._file_stat(path)
+            if file_stat == stats[name]:
+                continue
+            with open(path, 'rb') as file:
+                content = file.read()
+            digest = hashlib.sha1(content).hexdigest()
+            words = None
+            if digest != digests[name]:
+                words = [word.strip().lower() for word in content.decode('utf-8').splitlines() if word.strip()]
+            changes[name] = (file_stat, digest, words)
+        return changes
+
+    def _build(self, words) -> WordMatcher:
+        return WordMatcher(words[ban_list], words[check_list], self.ban_accuracy, self.check_accuracy)
+
+    async def _rebuild(self):
+        words = {name: list(self._words[name]) for name in word_list_files}
+        self._matcher = await asyncio.get_running_loop().run_in_executor(None, self._build, words)
+        logging.info(f"Word matcher rebuilt: {len(words[ban_list])} ban words, {len(words[check_list])} check words")
+
+    async def _refresh(self):
+        async with self._lock:
+            changes = await asyncio.get_running_loop().run_in_executor(
+                None, self._read_changes, dict(self._stats), dict(self._digests))
+            changed = False
+            for name, (file_stat, digest, words) in changes.items():
+                self._stats[name] = file_stat
+                if words is not None:
+                    self._words[name] = words
+                    self._digests[name] = digest
+                    changed = True
+            if changed or self._matcher is None:
+                await self._rebuild()
+
+    async def _safe_refresh(self):
+        try:
+            await self._refresh()
+        except (OSError, UnicodeDecodeError) as e:
+            logging.error(f'ERROR READING WORD LISTS: {e}')
+            if self._matcher is None:
+                raise ValueError(f'ERROR READING WORD LISTS: {e}')
+
+    async def matcher(self) -> WordMatcher:
+        if self._matcher is None:
+            # Первая загрузка: без матчера проверять нечем, ждем ее
+            self._last_check = time.monotonic()
+            await self._safe_refresh()
+            return self._matcher
+        now = time.monotonic()
+        if now - self._last_check >= reload_check_interval and \
+                (self._refresh_task is None or self._refresh_task.done()):
+            self._last_check = now
+            self._refresh_task = asyncio.create_task(self._safe_refresh())
+        return self._matcher
+
+    async def words(self, name) -> List[str]:
+        await self.matcher()
+        return list(self._words[name])
+
+    def _write(self, path, content):
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as file:
+            file.write(content)
+        os.replace(tmp_path, path)
+        return self._file_stat(path)
+
+    async def _save(self, name, words):
+        path = self._path(name)
+        content = ''.join(f'{word}\n' for word in words).encode('utf-8')
+        self._stats[name] = await asyncio.get_running_loop().run_in_executor(None, self._write, path, content)
+        self._words[name] = words
+        self._digests[name] = hashlib.sha1(content).hexdigest()
+        await self._rebuild()
+
+    async def add_words(self, name, words: Iterable[str]) -> List[str]:
+        await self.matcher()
+        async with self._lock:
+            current = list(self._words[name])
+            known = set(current)
+            added = []
+            for word in words:
+                word = word.strip().lower()
+                if word and word not in known:
+                    known.add(word)
+                    added.append(word)
+            if added:
+                await self._save(name, current + added)
+                logging.info(f"Words added to {name} list: {added}")
+        return added
+
+    async def remove_words(self, name, words: Iterable[str]) -> List[str]:
+        to_remove = {word.strip().lower() for word in words if word.strip()}
+        await self.matcher()
+        async with self._lock:
+            current = list(self._words[name])
+            removed = [word for word in current if word in to_remove]
+            if removed:
+                await self._save(name, [word for word in current if word not in to_remove])
+                logging.info(f"Words removed from {name} list: {removed}")
+        return removed
@@ -0,0 +1,87 @@
+from collections import Counter, OrderedDict
+from typing import List, Optional, Tuple
+
+import numpy as np
+from fuzzywuzzy import fuzz
+
+# Результаты по отдельным словам сообщения кэшируются: в чатах одни и те же слова повторяются постоянно
+word_cache_size = 50000
+
+
+# Нечеткий поиск слова по списку с тем же результатом, что и перебор fuzz.ratio(word, list_word) > threshold.
+# fuzz.ratio = 200 * M / (len(a) + len(b)), где M (совпавшие символы) не больше min(len(a), len(b)) и не больше
+# пересечения мультимножеств символов. Эти оценки считаются векторно по матрице частот символов и отсекают
+# почти весь список, а точный fuzz.ratio вызывается только для оставшихся кандидатов в исходном порядке списка.
+class FuzzyWordIndex:
+    def __init__(self, words: List[str], threshold):
+        self.words = list(words)
+        self.threshold = threshold
+        # Запас на округление fuzz.ratio до целого: оценка должна оставаться верхней границей
+        self._bound = threshold - 0.5
+        order = sorted(range(len(self.words)), key=lambda index: len(self.words[index]))
+        self._order = np.array(order, dtype=np.int64)
+        self._lengths = np.array([len(self.words[index]) for index in order], dtype=np.int64)
+        self._columns = {}
+        for word in self.words:
+            for char in word:
+                self._columns.setdefault(char, len(self._columns))
+        self._counts = np.zeros((len(order), max(len(self._columns), 1)), dtype=np.int32, order='F')
+        for row, index in enumerate(order):
+            for char, count in Counter(self.words[index]).items():
+                self._counts[row, self._columns[char]] = count
+        self._cache = OrderedDict()
+
+    def _length_window(self, length):
+        if self._bound <= 0:
+            return 0, len(self._lengths)
+        if self._bound >= 200:
+            return 0, 0
+        min_length = length * self._bound / (200 - self._bound)
+        max_length = length * (200 / self._bound - 1)
+        lo = int(np.searchsorted(self._lengths, min_length - 1, side='left'))
+        hi = int(np.searchsorted(self._lengths, max_length + 1, side='right'))
+        return lo, hi
+
+    def _search(self, word):
+        lo, hi = self._length_window(len(word))
+        if lo >= hi:
+            return None
+        overlap = np.zeros(hi - lo, dtype=np.int32)
+        for char, count in Counter(word).items():
+            column = self._columns.get(char)
+            if column is not None:
+                overlap += np.minimum(self._counts[lo:hi, column], count)
+        total = self._lengths[lo:hi] + len(word)
+        candidates = np.nonzero(200 * overlap > self._bound * total)[0]
+        for index in np.sort(self._order[candidates + lo]):
+            list_word = self.words[index]
+            if fuzz.ratio(word, list_word) > self.threshold:
+                return list_word
+        return None
+
+    def first_match(self, word: str) -> Optional[str]:
+        if word in self._cache:
+            self._cache.move_to_end(word)
+            return self._cache[word]
+        result = self._search(word) if self.words else None
+        self._cache[word] = result
+        if len(self._cache) > word_cache_size:
+            self._cache.popitem(last=False)
+        return result
+
+    def find(self, message_words: List[str]) -> Optional[str]:
+        for word in message_words:
+            result = self.first_match(word)
+            if result is not None:
+                return result
+        return None
+
+
+class WordMatcher:
+    def __init__(self, ban_words: List[str], check_words: List[str], ban_accuracy, check_accuracy):
+        self.ban_index = FuzzyWordIndex(ban_words, ban_accuracy)
+        self.check_index = FuzzyWordIndex(check_words, check_accuracy)
+
+    def match(self, message: str) -> Tuple[Optional[str], Optional[str]]:
+        words = message.lower().split()
+        return self.ban_index.find(words), self.check_index.find(words)